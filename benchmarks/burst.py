@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+
+# Copyright 2014 Dave Hughes <dave@waveform.org.uk>.
+#
+# This file is part of compoundpi.
+#
+# compoundpi is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# compoundpi is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# compoundpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compares the sustained frame rate of burst captures stored in individually
+allocated buffers (the default image store) against the memory-mapped ring.
+
+On a Pi, frames are captured from the camera's video port. Elsewhere (or with
+--synthetic) frames of a fixed size are generated to measure the store alone.
+"""
+
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    print_function,
+    division,
+    )
+str = type('')
+
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from compoundpi.store import ImageStore, MemoryBackend, RingBackend
+
+
+def synthetic_capture(size):
+    frame = b'\xff\xd8' + b'\x00' * (size - 2)
+    def capture(outputs):
+        for output in outputs:
+            # Mimic the camera, which writes each frame in several blocks
+            for offset in range(0, size, 65536):
+                output.write(frame[offset:offset + 65536])
+    return capture
+
+def camera_capture(resolution, framerate):
+    import picamera
+    camera = picamera.PiCamera()
+    camera.resolution = resolution
+    camera.framerate = framerate
+    time.sleep(2)
+    def capture(outputs):
+        camera.capture_sequence(outputs, format='jpeg', use_video_port=True)
+    return capture
+
+def outputs(store, count):
+    for i in range(count):
+        image = store.create(time.time())
+        try:
+            yield image.stream
+        finally:
+            image.finish()
+
+def run(name, store, capture, count):
+    start = time.time()
+    capture(outputs(store, count))
+    elapsed = time.time() - start
+    used, limit = store.usage('memory')
+    print('%-8s %5d frames in %6.2fs: %6.1ffps (%.1fMB stored)' % (
+        name, len(store), elapsed, len(store) / elapsed, used / 1048576))
+    store.clear()
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '-n', '--frames', type=int, default=200,
+        help='the number of frames to capture in each burst '
+        '(default: %(default)s)')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=3,
+        help='the number of bursts to capture with each store '
+        '(default: %(default)s)')
+    parser.add_argument(
+        '--resolution', default='1280x720',
+        help='the camera resolution (default: %(default)s)')
+    parser.add_argument(
+        '--framerate', type=int, default=30,
+        help='the camera framerate (default: %(default)s)')
+    parser.add_argument(
+        '--synthetic', type=int, default=0, metavar='BYTES',
+        help='generate frames of the specified size instead of using the '
+        'camera')
+    parser.add_argument(
+        '--slot-size', type=int, default=4, metavar='MB',
+        help='the size of each ring slot (default: %(default)s)')
+    args = parser.parse_args(args)
+    if args.synthetic:
+        capture = synthetic_capture(args.synthetic)
+    else:
+        width, height = (int(i) for i in args.resolution.split('x'))
+        capture = camera_capture((width, height), args.framerate)
+    stores = [
+        ('bytesio', ImageStore([MemoryBackend()])),
+        ('ring', ImageStore([RingBackend(args.frames, args.slot_size * 1048576)])),
+        ]
+    for i in range(args.repeat):
+        for name, store in stores:
+            run(name, store, capture, args.frames)
+
+
+if __name__ == '__main__':
+    main()
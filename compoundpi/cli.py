@@ -33,18 +33,22 @@ import sys
 import io
 import os
 import re
+import zlib
 import logging
 import warnings
 import datetime
 import socket
+import time
 import fractions
+import functools
 try:
     from ipaddress import IPv4Address, IPv4Network
 except ImportError:
     from ipaddr import IPv4Address, IPv4Network
 
 from . import __version__
-from .client import CompoundPiClient
+from .client import CompoundPiClient, CompoundPiWriterPool
+from .exc import CompoundPiTransactionFailed
 from .terminal import TerminalApplication
 from .cmdline import Cmd, CmdSyntaxError, CmdError, ENCODING
 
@@ -82,6 +86,11 @@ network_timeout = numeric_range(conversion=int, min_value=1)
 capture_count = numeric_range(conversion=int, min_value=1)
 capture_delay = numeric_range(conversion=float, min_value=0.0)
 time_delta = numeric_range(conversion=float, inclusive=False, min_value=0.0)
+find_quiet = numeric_range(conversion=float, min_value=0.0)
+multicast_ttl = numeric_range(conversion=int, min_value=1, max_value=255)
+sync_interval = numeric_range(conversion=float, min_value=0.0)
+record_segment = numeric_range(
+    conversion=float, inclusive=False, min_value=0.0)
 
 def path(s):
     s = os.path.expanduser(s)
@@ -144,6 +153,16 @@ class CompoundPiClientApplication(TerminalApplication):
             default='15', metavar='SECS',
             help='specifies the timeout (in seconds) for network '
             'transactions (default: %(default)s)')
+        self.parser.add_argument(
+            '--multicast-ttl', type=multicast_ttl, default='1', metavar='HOPS',
+            help='specifies the time-to-live of commands sent to multicast '
+            'groups; increase this to reach servers beyond a router '
+            '(default: %(default)s)')
+        self.parser.add_argument(
+            '--data-channels', action='store_true', default=False,
+            help='if specified, download images over persistent connections '
+            'opened by the client to each server (rather than connections '
+            'opened by the servers to the client)')
         self.parser.add_argument(
             '--capture-delay', type=capture_delay, default='0.0', metavar='SECS',
             help='specifies the delay (in seconds) used to synchronize '
@@ -156,10 +175,30 @@ class CompoundPiClientApplication(TerminalApplication):
         self.parser.add_argument(
             '--video-port', action='store_true', default=False,
             help="if specified, use the camera's video port for rapid capture")
+        self.parser.add_argument(
+            '--record-segment', type=record_segment, default='10.0',
+            metavar='SECS',
+            help='specifies the length of the segments that recordings are '
+            'divided into on the servers (default: %(default)ss)')
         self.parser.add_argument(
             '--time-delta', type=time_delta, default='0.25', metavar='SECS',
             help='specifies the maximum delta between server timestamps that '
             'the client will tolerate (default: %(default)ss)')
+        self.parser.add_argument(
+            '--sync-interval', type=sync_interval, default='60', metavar='SECS',
+            help='specifies the age after which server clock estimates are '
+            'refreshed before a synchronized capture; 0 disables clock '
+            'correction (default: %(default)ss)')
+        self.parser.add_argument(
+            '--find-quiet', type=find_quiet, default='1.0', metavar='SECS',
+            help='specifies how long find waits after the last new server '
+            'replies before finishing; 0 waits for the full timeout '
+            '(default: %(default)ss)')
+        self.parser.add_argument(
+            '--server-cache', default='', metavar='FILE',
+            help='specifies a file in which discovered servers are recorded '
+            'so that subsequent finds can finish as soon as the recorded '
+            'servers reply (default: none)')
         self.parser.set_defaults(log_level=logging.INFO)
 
     def main(self, args):
@@ -168,10 +207,16 @@ class CompoundPiClientApplication(TerminalApplication):
         proc.client.port = args.port
         proc.client.bind = args.bind
         proc.client.timeout = args.timeout
+        proc.client.multicast_ttl = args.multicast_ttl
+        proc.client.sync_interval = args.sync_interval
+        proc.client.data_channels = args.data_channels
         proc.capture_delay = args.capture_delay
         proc.capture_count = args.capture_count
         proc.video_port = args.video_port
+        proc.record_segment = args.record_segment
         proc.time_delta = args.time_delta
+        proc.find_quiet = args.find_quiet
+        proc.server_cache = os.path.expanduser(args.server_cache)
         proc.output = args.output
         proc.cmdloop()
 
@@ -185,6 +230,15 @@ class CompoundPiCmd(Cmd):
     response_re = re.compile(
             r'(?P<seqno>\d+) '
             r'(?P<result>OK|ERROR)(\n(?P<data>.*))?', flags=re.DOTALL)
+    # The number of times the download command attempts to retrieve each
+    # image; each retry resumes from wherever the previous attempt stopped
+    download_attempts = 3
+    # The number of threads writing downloaded images to disk, the number of
+    # blocks (of up to 1MB) each may have queued before downloads wait for
+    # it, and the number of files each syncs to disk at once
+    download_writers = 2
+    download_queue = 8
+    download_sync = 16
 
     def __init__(self):
         Cmd.__init__(self)
@@ -200,7 +254,10 @@ class CompoundPiCmd(Cmd):
         self.capture_delay = 0.0
         self.capture_count = 1
         self.video_port = False
+        self.record_segment = 10.0
         self.time_delta = 0.25
+        self.find_quiet = 1.0
+        self.server_cache = ''
         self.output = '/tmp'
         self.warnings = False
         warnings.simplefilter('always')
@@ -306,10 +363,16 @@ class CompoundPiCmd(Cmd):
                 ('port',          self.client.port),
                 ('bind',          '%s:%d' % self.client.bind),
                 ('timeout',       self.client.timeout),
+                ('multicast_ttl', self.client.multicast_ttl),
+                ('sync_interval', self.client.sync_interval),
+                ('data_channels', self.client.data_channels),
                 ('capture_delay', self.capture_delay),
                 ('capture_count', self.capture_count),
                 ('video_port',    self.video_port),
+                ('record_segment', self.record_segment),
                 ('time_delta',    self.time_delta),
+                ('find_quiet',    self.find_quiet),
+                ('server_cache',  self.server_cache),
                 ('output',        self.output),
                 ('warnings',      self.warnings),
                 ]
@@ -343,10 +406,16 @@ class CompoundPiCmd(Cmd):
                 'port':          service,
                 'bind':          address,
                 'timeout':       network_timeout,
+                'multicast_ttl': multicast_ttl,
+                'sync_interval': sync_interval,
+                'data_channels': boolean,
                 'capture_delay': capture_delay,
                 'capture_count': capture_count,
                 'video_port':    boolean,
+                'record_segment': record_segment,
                 'time_delta':    time_delta,
+                'find_quiet':    find_quiet,
+                'server_cache':  os.path.expanduser,
                 'output':        path,
                 'warnings':      boolean,
                 }[name](value)
@@ -354,7 +423,9 @@ class CompoundPiCmd(Cmd):
             raise CmdSyntaxError('Invalid configuration variable: %s' % name)
         except ValueError as e:
             raise CmdSyntaxError(e)
-        if name in ('network', 'port', 'bind', 'timeout'):
+        if name in (
+                'network', 'port', 'bind', 'timeout', 'multicast_ttl',
+                'sync_interval', 'data_channels'):
             setattr(self.client, name, value)
         else:
             setattr(self, name, value)
@@ -368,7 +439,10 @@ class CompoundPiCmd(Cmd):
             value = match.group('value').strip()
             if name.startswith('output'):
                 return self.complete_path(text, value, start, finish)
-            elif name.startswith('video_port') or name.startswith('warnings'):
+            elif (
+                    name.startswith('video_port') or
+                    name.startswith('data_channels') or
+                    name.startswith('warnings')):
                 values = ['on', 'off', 'true', 'false', 'yes', 'no', '0', '1']
                 return [value for value in values if value.startswith(text)]
             else:
@@ -379,10 +453,16 @@ class CompoundPiCmd(Cmd):
                 'port',
                 'bind',
                 'timeout',
+                'multicast_ttl',
+                'sync_interval',
+                'data_channels',
                 'capture_delay',
                 'capture_count',
                 'video_port',
+                'record_segment',
                 'time_delta',
+                'find_quiet',
+                'server_cache',
                 'output',
                 'warnings',
                 ]
@@ -421,7 +501,11 @@ class CompoundPiCmd(Cmd):
         The 'find' command is typically the first command used in a client
         session to locate all Pis on the configured subnet. If a count is
         specified, the command will display an error if the expected number of
-        Pis is not located.
+        Pis is not located. Otherwise, the command finishes once no new Pi has
+        replied for the period given by the 'find_quiet' setting. If the
+        'server_cache' setting is not blank, the Pis found are recorded in the
+        specified file, and subsequent finds finish as soon as that many Pis
+        have replied.
 
         See also: add, remove, servers, identify.
 
@@ -437,7 +521,8 @@ class CompoundPiCmd(Cmd):
                 raise CmdSyntaxError('Invalid find count "%d"' % arg)
         else:
             count = 0
-        self.client.find(count)
+        self.client.find(
+            count, quiet=self.find_quiet, cache=self.server_cache or None)
         if not len(self.client):
             raise CmdError('Failed to find any servers')
         logging.info('Found %d servers' % len(self.client))
@@ -497,6 +582,97 @@ class CompoundPiCmd(Cmd):
     def complete_remove(self, text, line, start, finish):
         return self.complete_server(text, line, start, finish)
 
+    def parse_group(self, s):
+        try:
+            group = IPv4Address(s.strip())
+        except ValueError:
+            raise CmdSyntaxError('Invalid group address "%s"' % s)
+        if not group.is_multicast:
+            raise CmdSyntaxError('"%s" is not a multicast address' % s)
+        return group
+
+    def do_group(self, arg):
+        """
+        Assign servers to a multicast group.
+
+        Syntax: group <group> [addresses]
+
+        The 'group' command is used to assign the specified servers to a
+        multicast group (an address between 224.0.0.0 and 239.255.255.255).
+        Servers previously assigned to the group which are not specified are
+        removed from it. If no addresses are specified, all defined servers
+        are assigned to the group.
+
+        Thereafter, commands sent to exactly the servers in a group are sent as
+        a single datagram to the group rather than one datagram per server.
+        Unlike broadcasts, multicast datagrams can be routed between networks
+        (see the 'multicast_ttl' setting).
+
+        See also: ungroup, groups, set.
+
+        cpi> group 239.0.0.1 192.168.0.1-192.168.0.10
+        cpi> capture 192.168.0.1-192.168.0.10
+        """
+        if not arg:
+            raise CmdSyntaxError('You must specify a group address')
+        arg = arg.split(' ', 1)
+        self.client.group(
+            self.parse_group(arg[0]),
+            self.parse_arg(arg[1] if len(arg) > 1 else None))
+
+    def complete_group(self, text, line, start, finish):
+        cmd_re = re.compile(r'group(?P<group> +[^ ]+(?P<addr> +.*)?)?')
+        match = cmd_re.match(line)
+        assert match
+        if match.start('addr') < finish <= match.end('addr'):
+            return self.complete_server(text, line, start, finish)
+        return []
+
+    def do_ungroup(self, arg):
+        """
+        Remove all servers from a multicast group.
+
+        Syntax: ungroup <group>
+
+        The 'ungroup' command is used to remove all defined servers from the
+        specified multicast group.
+
+        See also: group, groups.
+
+        cpi> ungroup 239.0.0.1
+        """
+        if not arg:
+            raise CmdSyntaxError('You must specify a group address')
+        self.client.ungroup(self.parse_group(arg))
+
+    def do_groups(self, arg=''):
+        """
+        Display the multicast groups of the defined servers.
+
+        Syntax: groups [addresses]
+
+        The 'groups' command queries the specified servers for the multicast
+        groups they belong to, including those joined by the server on
+        startup. If no addresses are specified, all defined servers are
+        queried.
+
+        See also: group, ungroup.
+
+        cpi> groups
+        cpi> groups 192.168.0.1-192.168.0.10
+        """
+        responses = self.client.groups(self.parse_arg(arg))
+        self.pprint_table(
+            [('Address', 'Groups')] +
+            [
+                (address, ', '.join(str(g) for g in sorted(groups)))
+                for (address, groups) in sorted(responses.items())
+                ]
+            )
+
+    def complete_groups(self, text, line, start, finish):
+        return self.complete_server(text, line, start, finish)
+
     def do_status(self, arg=''):
         """
         Retrieves status from the defined servers.
@@ -525,6 +701,7 @@ class CompoundPiCmd(Cmd):
                     'Flip',
                     'Clock',
                     '#',
+                    'Store',
                     )
             ] + [
                 (
@@ -557,6 +734,9 @@ class CompoundPiCmd(Cmd):
                         ),
                     status.timestamp - min_time,
                     status.images,
+                    '%.1fMB' % (
+                        (status.store.memory_used + status.store.disk_used) /
+                        1048576),
                     )
                 for address in sorted(self.client)
                 if address in responses
@@ -1251,6 +1431,79 @@ class CompoundPiCmd(Cmd):
                 if value.startswith(text)
                 ]
 
+    def do_configure(self, arg):
+        """
+        Sets several camera settings at once on the defined servers.
+
+        Syntax: configure <setting>=<value>... [addresses]
+
+        The 'configure' command is used to change several camera settings on
+        all or some of the defined servers with a single command, which is
+        considerably faster than using the individual commands for each
+        setting. The following settings can be specified:
+
+        resolution, framerate, awb_mode, awb_red, awb_blue, agc_mode,
+        exposure_mode, exposure_speed, metering_mode, iso, brightness,
+        contrast, saturation, ev, hflip, vflip
+
+        Values are given in the same form as the corresponding individual
+        commands (e.g. resolution=1280x720, iso=auto). The hflip and vflip
+        settings accept 0 or 1.
+
+        If no address is specified then all currently defined servers will be
+        targetted. Multiple addresses can be specified with dash-separated
+        ranges, comma-separated lists, or any combination of the two.
+
+        See also: status, resolution, framerate, awb, exposure.
+
+        cpi> configure resolution=1280x720 framerate=30
+        cpi> configure awb_mode=off awb_red=1.5 awb_blue=1.3 192.168.0.1
+        cpi> configure iso=100 exposure_mode=off exposure_speed=20 192.168.0.1-192.168.0.10
+        """
+        settings = {}
+        addresses = []
+        for token in arg.split():
+            key, sep, value = token.partition('=')
+            if not sep:
+                addresses.append(token)
+                continue
+            key = key.lower()
+            try:
+                if key == 'resolution':
+                    width, height = value.lower().split('x')
+                    value = (int(width), int(height))
+                elif key == 'framerate':
+                    value = fractions.Fraction(value)
+                elif key in ('awb_red', 'awb_blue', 'exposure_speed'):
+                    value = float(value)
+                elif key == 'iso' and value.lower() == 'auto':
+                    value = 0
+                elif key in ('iso', 'brightness', 'contrast', 'saturation', 'ev'):
+                    value = int(value)
+                elif key in ('hflip', 'vflip'):
+                    value = bool(int(value))
+                elif key in ('awb_mode', 'agc_mode', 'exposure_mode', 'metering_mode'):
+                    value = value.lower()
+                else:
+                    raise CmdSyntaxError('Unknown setting "%s"' % key)
+            except ValueError:
+                raise CmdSyntaxError('Invalid %s "%s"' % (key, value))
+            settings[key] = value
+        if not settings:
+            raise CmdSyntaxError('You must specify at least one setting')
+        self.client.configure(
+            addresses=self.parse_arg(','.join(addresses) or None), **settings)
+
+    def complete_configure(self, text, line, start, finish):
+        if '=' in text:
+            return []
+        settings = [
+            '%s=' % key
+            for key in CompoundPiClient.configure_settings
+            if key.startswith(text)
+            ]
+        return settings or self.complete_server(text, line, start, finish)
+
     def do_capture(self, arg=''):
         """
         Captures images from the defined servers.
@@ -1268,19 +1521,180 @@ class CompoundPiCmd(Cmd):
         still reasonably quick there will be a measurable difference between
         the timestamps of the last and first captures.
 
-        See also: download, clear.
+        If the 'capture_delay' setting is non-zero, the servers synchronize
+        their captures to a time that many seconds in the future, translated
+        to each server's clock (see the 'sync' command). After the capture,
+        the spread of the servers' actual capture times is reported.
+
+        See also: download, clear, sync.
 
         cpi> capture
         cpi> capture 192.168.0.1
         cpi> capture 192.168.0.50-192.168.0.53
         """
-        self.client.capture(
+        skew = self.client.capture(
             self.capture_count, self.video_port, self.capture_delay,
             self.parse_arg(arg))
+        if skew:
+            self.report_skew(skew)
+
+    def report_skew(self, skew):
+        for address, delta in sorted(skew.items()):
+            logging.debug('%s captured at %+.3fms', address, delta * 1000)
+        logging.info(
+            'Capture skew: spread %.3fms, mean %+.3fms, stdev %.3fms',
+            skew.spread * 1000, skew.mean * 1000, skew.stdev * 1000)
 
     def complete_capture(self, text, line, start, finish):
         return self.complete_server(text, line, start, finish)
 
+    def do_arm(self, arg=''):
+        """
+        Arms the cameras of the defined servers.
+
+        Syntax: arm [addresses]
+
+        The 'arm' command causes the servers to start capturing continuously
+        from their camera's video port, retaining the last few frames. The
+        'trigger' command can then take an image within a frame or so, rather
+        than waiting for the camera to start capturing as the 'capture'
+        command does. While armed, the 'capture', 'resolution', and
+        'framerate' commands will fail; use the 'disarm' command first.
+
+        See also: trigger, disarm, capture.
+
+        cpi> arm
+        cpi> arm 192.168.0.1-192.168.0.10
+        """
+        self.client.arm(addresses=self.parse_arg(arg))
+
+    def complete_arm(self, text, line, start, finish):
+        return self.complete_server(text, line, start, finish)
+
+    def do_disarm(self, arg=''):
+        """
+        Disarms the cameras of the defined servers.
+
+        Syntax: disarm [addresses]
+
+        The 'disarm' command stops the continuous capture started by the 'arm'
+        command.
+
+        See also: arm, trigger.
+
+        cpi> disarm
+        """
+        self.client.disarm(self.parse_arg(arg))
+
+    def complete_disarm(self, text, line, start, finish):
+        return self.complete_server(text, line, start, finish)
+
+    def do_trigger(self, arg=''):
+        """
+        Takes an image with the armed cameras of the defined servers.
+
+        Syntax: trigger [addresses]
+
+        The 'trigger' command causes each server to store the frame its armed
+        camera captured closest to the time the command was received. If the
+        'capture_delay' setting is non-zero, the frame closest to that many
+        seconds in the future is stored instead. The spread of the frames'
+        times is reported afterward.
+
+        See also: arm, disarm, capture, download.
+
+        cpi> arm
+        cpi> trigger
+        cpi> trigger 192.168.0.1
+        """
+        skew = self.client.trigger(self.capture_delay, self.parse_arg(arg))
+        if skew:
+            self.report_skew(skew)
+
+    def complete_trigger(self, text, line, start, finish):
+        return self.complete_server(text, line, start, finish)
+
+    def do_record(self, arg=''):
+        """
+        Starts recording video on the defined servers.
+
+        Syntax: record [addresses]
+
+        The 'record' command causes the servers to start recording H.264
+        video. Each server divides its recording into segments of
+        'record_segment' seconds, which are downloaded (as .h264 files) by
+        the 'download' command once complete, even while recording continues.
+        If the 'capture_delay' setting is non-zero, the recordings start
+        simultaneously that many seconds in the future, and the spread of the
+        servers' start times is reported. While recording, the 'capture',
+        'resolution', and 'framerate' commands will fail; use the 'stop'
+        command first.
+
+        See also: stop, download, capture.
+
+        cpi> record
+        cpi> record 192.168.0.1-192.168.0.10
+        """
+        skew = self.client.record(
+            self.record_segment, delay=self.capture_delay,
+            addresses=self.parse_arg(arg))
+        if skew:
+            self.report_skew(skew)
+
+    def complete_record(self, text, line, start, finish):
+        return self.complete_server(text, line, start, finish)
+
+    def do_stop(self, arg=''):
+        """
+        Stops recording video on the defined servers.
+
+        Syntax: stop [addresses]
+
+        The 'stop' command ends the recordings started by the 'record'
+        command, completing their final segments.
+
+        See also: record, download.
+
+        cpi> stop
+        """
+        self.client.stop(self.parse_arg(arg))
+
+    def complete_stop(self, text, line, start, finish):
+        return self.complete_server(text, line, start, finish)
+
+    def do_sync(self, arg=''):
+        """
+        Estimates the clock offsets of the defined servers.
+
+        Syntax: sync [addresses]
+
+        The 'sync' command measures the offset of each server's clock from
+        the client's clock with several round-trip exchanges, and displays
+        the estimates along with the round-trip time of the exchange each was
+        derived from. The estimates are used to correct the sync time sent
+        to each server when 'capture_delay' is non-zero. Estimates are
+        refreshed automatically before a capture when older than the
+        'sync_interval' setting, so this command is typically only used to
+        check the servers' clocks.
+
+        See also: capture, status.
+
+        cpi> sync
+        cpi> sync 192.168.0.1-192.168.0.10
+        """
+        clocks = self.client.sync(self.parse_arg(arg))
+        self.pprint_table(
+            [('Address', 'Offset (ms)', 'RTT (ms)')] +
+            [
+                (address, '%+.3f' % (clock.offset * 1000),
+                    '%.3f' % (clock.rtt * 1000))
+                for (address, clock) in sorted(clocks.items())
+                ]
+            )
+
+    def complete_sync(self, text, line, start, finish):
+        return self.complete_server(text, line, start, finish)
+
     def do_download(self, arg=''):
         """
         Downloads captured images from the defined servers.
@@ -1288,26 +1702,184 @@ class CompoundPiCmd(Cmd):
         Syntax: download [addresses]
 
         The 'download' command causes each server to send its captured images
-        to the client. Servers are contacted consecutively to avoid saturating
-        the network bandwidth. Once images are successfully downloaded from a
-        server, they are wiped from the server.
+        to the client. Several servers transfer images simultaneously, each
+        streaming all of its requested images over a single connection
+        (partially downloaded images are instead resumed one at a time). Once
+        all transfers are complete, each image which has been written to disk
+        and verified is wiped from its server, releasing the server's memory.
 
-        See also: capture, clear.
+        Completed segments of recordings are downloaded as .h264 files. Images
+        still being written, such as the segment currently being recorded,
+        are skipped; use 'download' again after 'stop' to retrieve it.
+
+        Images are written to disk by background threads so that slow storage
+        does not hold up the network; the sustained rate at which they were
+        written is reported once all writes are complete.
+
+        Transfers which fail are retried, resuming from wherever they
+        stopped. Likewise, files left incomplete by an earlier 'download'
+        are resumed rather than downloaded again. Each file is verified
+        against the checksum calculated by the server when the image was
+        captured; files which don't match are downloaded again, and images
+        are only wiped from their servers once verified.
+
+        See also: capture, record, clear.
 
         cpi> download
         cpi> download 192.168.0.1
         """
+        # Only images the server has finished writing (and hence listed a
+        # checksum for) can be downloaded
         responses = self.client.list(self.parse_arg(arg))
+        responses = {
+            address: [image for image in images if image.checksum is not None]
+            for (address, images) in responses.items()
+            }
+        filenames = {
+            (address, image.index): os.path.join(
+                self.output, '{ts:%Y%m%d-%H%M%S%f}-{addr}.{ext}'.format(
+                    ts=image.timestamp, addr=address,
+                    ext='jpg' if image.format == 'jpeg' else image.format))
+            for (address, images) in responses.items()
+            for image in images
+            }
+        started = time.time()
+        written = 0
+        verified = set()
+        streamed = {}
+        for attempt in range(self.download_attempts):
+            pending = self.pending_downloads(
+                responses, filenames, verified, streamed)
+            if not pending:
+                break
+            # Images with nothing downloaded yet are streamed from each server
+            # over a single connection; partial images must be resumed one
+            # at a time
+            for resume in (False, True):
+                downloads = {}
+                for (address, index), size in pending.items():
+                    if bool(size) == resume:
+                        downloads.setdefault(address, []).append(index)
+                if downloads:
+                    written += self.download_pending(
+                        downloads, filenames, streamed, resume)
+        # Verify the files completed by the final attempt
+        self.pending_downloads(responses, filenames, verified, streamed)
+        elapsed = max(time.time() - started, 1e-6)
+        if written:
+            logging.info(
+                'Wrote %d bytes to disk in %.2fs (%.2fMB/s sustained)',
+                written, elapsed, written / elapsed / 1000000)
+        # Only images safely on disk are wiped from their servers; anything
+        # else is left for another attempt
+        with self.client.pipeline():
+            for (address, images) in responses.items():
+                indexes = [
+                    image.index for image in images
+                    if (address, image.index) in verified
+                    ]
+                if indexes:
+                    self.client.clear([address], indexes)
         for (address, images) in responses.items():
             for image in images:
-                filename = '{ts:%Y%m%d-%H%M%S%f}-{addr}.jpg'.format(
-                        ts=image.timestamp, addr=address)
-                with io.open(os.path.join(self.output, filename), 'wb') as output:
-                    self.client.download(address, image.index, output)
-                    if output.tell() != image.size:
-                        raise CmdError('Wrong size for image %s' % filename)
-                logging.info('Downloaded %s' % filename)
-        self.client.clear(self.parse_arg(arg))
+                if (address, image.index) not in verified:
+                    raise CmdError(
+                        'Failed to download %s' %
+                        filenames[(address, image.index)])
+
+    def pending_downloads(self, responses, filenames, verified, streamed):
+        # Returns a mapping of (address, index) to the size of the partial
+        # download of each image in *responses* which is not yet in the set
+        # of *verified* images. Complete files are added to *verified* if
+        # *streamed* shows that all their bytes passed the checksums of the
+        # transfers that received them. Other complete files (e.g. resumed
+        # from an earlier run) are read back and checked against the checksum
+        # calculated when the image was captured; files which don't match are
+        # removed to be downloaded again. Images without a checksum (which
+        # the server is still writing) are never verified
+        result = {}
+        for (address, images) in responses.items():
+            for image in images:
+                key = (address, image.index)
+                if key in verified or image.checksum is None:
+                    continue
+                filename = filenames[key]
+                size = self.partial_size(filename, image.size)
+                if size == image.size:
+                    if (
+                            streamed.get(key) == image.size or
+                            self.file_checksum(filename) == image.checksum):
+                        logging.info('Downloaded %s', filename)
+                        verified.add(key)
+                        continue
+                    logging.warning('Checksum mismatch in %s', filename)
+                    os.unlink(filename)
+                    streamed.pop(key, None)
+                    size = 0
+                result[key] = size
+        return result
+
+    def download_pending(self, downloads, filenames, streamed, resume):
+        # Download the images specified by *downloads* (a mapping of address
+        # to a list of indexes), appending them to the files in *filenames*.
+        # Returns the number of bytes written to disk. Images are received
+        # into a pool of writer threads so that the network isn't held up by
+        # slow storage; the pool is closed (waiting for all writes to be
+        # synced) before returning so that the files can be verified.
+        # *streamed* maps each image to the number of bytes from its start
+        # which were received (and written) by transfers whose checksums
+        # matched
+        pool = CompoundPiWriterPool(
+            self.download_writers, self.download_queue, self.download_sync)
+        try:
+            with pool:
+                results = self.client.download_many({
+                    address: [
+                        (index, functools.partial(
+                            pool.open, filenames[(address, index)], 'ab'))
+                        for index in indexes
+                        ]
+                    for (address, indexes) in downloads.items()
+                    }, resume=resume)
+        except CompoundPiTransactionFailed as e:
+            for error in e.errors:
+                logging.warning(str(error))
+        except IOError as e:
+            # Files the writers failed to complete are resumed (or, if
+            # corrupt, downloaded again) by the next attempt
+            logging.warning('Failed to write images: %s', e)
+        else:
+            for key, download in results.items():
+                # A transfer only extends the verified bytes if it continued
+                # from them; otherwise it follows unverified data (e.g. left
+                # by a transfer which failed part way through)
+                if download.offset == streamed.get(key, 0):
+                    streamed[key] = download.offset + download.size
+            logging.info(
+                'Received %d images (%d bytes) in %.2fs (%.2fMB/s)',
+                len(results), results.size, results.elapsed,
+                results.rate / 1000000)
+        return pool.written
+
+    def file_checksum(self, filename):
+        # Returns the CRC32 of the content of *filename*
+        result = 0
+        with io.open(filename, 'rb') as f:
+            for data in iter(lambda: f.read(1048576), b''):
+                result = zlib.crc32(data, result)
+        return result & 0xFFFFFFFF
+
+    def partial_size(self, filename, size):
+        # Returns the size of the partially downloaded *filename*, removing
+        # it if it is larger than the image (*size* bytes) it should hold
+        try:
+            result = os.path.getsize(filename)
+        except OSError:
+            return 0
+        if result > size:
+            os.unlink(filename)
+            return 0
+        return result
 
     def complete_download(self, text, line, start, finish):
         return self.complete_server(text, line, start, finish)
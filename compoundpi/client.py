@@ -29,7 +29,11 @@ str = type('')
 range = xrange
 
 import sys
+import io
+import os
+import errno
 import re
+import zlib
 import warnings
 import datetime
 import time
@@ -37,9 +41,11 @@ import random
 import threading
 import logging
 import select
-import struct
 import socket
 import SocketServer as socketserver
+import Queue as queue
+import collections
+import contextlib
 from fractions import Fraction
 from collections import namedtuple
 try:
@@ -48,9 +54,15 @@ except ImportError:
     from ipaddr import IPv4Address, IPv4Network
 
 from . import __version__
-from .common import NetworkRepeater
+from .common import (
+    NetworkRepeater,
+    SEND_HEADER,
+    SEND_TRAILER,
+    PREVIEW_HEADER,
+    )
 from .exc import (
     CompoundPiBadResponse,
+    CompoundPiChecksumError,
     CompoundPiFutureResponse,
     CompoundPiHelloError,
     CompoundPiInvalidResponse,
@@ -108,6 +120,7 @@ class CompoundPiStatus(namedtuple('CompoundPiStatus', (
     'vflip',
     'timestamp',
     'images',
+    'store',
     ))):
     """
     This class is a namedtuple derivative used to store the status of a
@@ -228,6 +241,41 @@ class CompoundPiStatus(namedtuple('CompoundPiStatus', (
 
         Returns an integer number indicating the number of images currently
         stored in the server's memory.
+
+    .. attribute:: store
+
+        Returns a :class:`StoreUsage` tuple describing how much of the server's
+        image store is currently in use.
+    """
+
+
+class StoreUsage(namedtuple('StoreUsage', (
+    'memory_used',
+    'memory_limit',
+    'disk_used',
+    'disk_limit',
+    ))):
+    """
+    Represents the usage of a server's image store.
+
+    .. attribute:: memory_used
+
+        The number of bytes of RAM occupied by stored images.
+
+    .. attribute:: memory_limit
+
+        The maximum number of bytes of RAM the server will use for images, or
+        0 if unlimited.
+
+    .. attribute:: disk_used
+
+        The number of bytes of images which have been spilled to files.
+
+    .. attribute:: disk_limit
+
+        The maximum number of bytes of images the server will spill to files,
+        or 0 if unlimited (or if the server does not spill images to files, in
+        which case :attr:`disk_used` will always be 0).
     """
 
 
@@ -235,6 +283,10 @@ class CompoundPiImage(namedtuple('CompoundPiImage', (
     'index',
     'timestamp',
     'size',
+    'trigger',
+    'format',
+    'duration',
+    'checksum',
     ))):
     """
     This class is a namedtuple derivative used to store information about an
@@ -256,7 +308,423 @@ class CompoundPiImage(namedtuple('CompoundPiImage', (
     .. attribute:: size
 
         Specifies the size of the image as an integer number of bytes.
+
+    .. attribute:: trigger
+
+        Specifies the timestamp on the server of the trigger (a
+        :meth:`~CompoundPiClient.trigger` command, or an edge on the server's
+        GPIO trigger pin) in response to which the image was taken, as a
+        :class:`~datetime.datetime` instance, or ``None`` if the image was not
+        triggered.
+
+    .. attribute:: format
+
+        Specifies the format of the image data: ``'jpeg'`` for still images,
+        or ``'h264'`` for segments of a recording (see
+        :meth:`CompoundPiClient.record`).
+
+    .. attribute:: duration
+
+        Specifies the length in seconds of a recording segment as a
+        :class:`float`. This is ``None`` for still images, and for the
+        segment still being recorded (which cannot be downloaded until it is
+        complete).
+
+    .. attribute:: checksum
+
+        Specifies the CRC32 of the image data (as calculated by the server
+        while the image was captured) as an unsigned integer, or ``None`` for
+        the segment still being recorded. This can be compared with the
+        :attr:`~CompoundPiDownload.checksum` of a completed download.
+    """
+
+
+class CompoundPiDownload(namedtuple('CompoundPiDownload', (
+    'address',
+    'index',
+    'size',
+    'started',
+    'first_byte',
+    'finished',
+    'offset',
+    'checksum',
+    ))):
+    """
+    This class is a namedtuple derivative used to report the outcome of an
+    image transfer by :meth:`CompoundPiClient.download` and
+    :meth:`CompoundPiClient.download_many`.
+
+    .. attribute:: address
+
+        Specifies the address of the server the image was downloaded from.
+
+    .. attribute:: index
+
+        Specifies the index of the image on the server.
+
+    .. attribute:: size
+
+        Specifies the number of bytes received.
+
+    .. attribute:: started
+
+        Specifies the time (as a UNIX timestamp) at which the image was
+        requested from the server.
+
+    .. attribute:: first_byte
+
+        Specifies the time (as a UNIX timestamp) at which the first byte of the
+        image was received, or ``None`` if no bytes were received.
+
+    .. attribute:: finished
+
+        Specifies the time (as a UNIX timestamp) at which the last byte of the
+        image was received.
+
+    .. attribute:: offset
+
+        Specifies the offset within the image at which the transfer began;
+        this is non-zero when a partial download was resumed, in which case
+        :attr:`size` only counts the bytes received by this transfer.
+
+    .. attribute:: checksum
+
+        Specifies the CRC32 (as an unsigned integer) of the bytes received by
+        the transfer, which has already been verified against the checksum
+        sent by the server. For a complete (not resumed) download this equals
+        the :attr:`~CompoundPiImage.checksum` the server listed for the image.
+    """
+
+    @property
+    def rate(self):
+        """
+        Returns the throughput of the transfer in bytes per second.
+        """
+        return self.size / max(self.finished - self.started, 1e-6)
+
+    @property
+    def ttfb(self):
+        """
+        Returns the number of seconds between the image being requested and
+        the first byte of it being received (the "time to first byte").
+        """
+        if self.first_byte is None:
+            return None
+        return self.first_byte - self.started
+
+
+class CompoundPiDownloads(dict):
+    """
+    This class is a :class:`dict` derivative returned by
+    :meth:`CompoundPiClient.download_many`. It maps ``(address, index)``
+    tuples to :class:`CompoundPiDownload` instances, and provides additional
+    attributes summarizing all the transfers it contains.
+    """
+
+    @property
+    def size(self):
+        """
+        Returns the total number of bytes received by all transfers.
+        """
+        return sum(download.size for download in self.values())
+
+    @property
+    def elapsed(self):
+        """
+        Returns the number of seconds between the start of the first transfer
+        and the end of the last.
+        """
+        if not self:
+            return 0.0
+        return (
+            max(download.finished for download in self.values()) -
+            min(download.started for download in self.values()))
+
+    @property
+    def rate(self):
+        """
+        Returns the aggregate throughput of all transfers in bytes per second.
+        """
+        return self.size / max(self.elapsed, 1e-6)
+
+
+class CompoundPiLatency(namedtuple('CompoundPiLatency', (
+    'seqno',
+    'sent',
+    'last_response',
+    'returned',
+    ))):
+    """
+    This class is a namedtuple derivative which records the timing of a
+    transaction (see :attr:`CompoundPiClient.latencies`).
+
+    .. attribute:: seqno
+
+        Specifies the sequence number of the transaction's command.
+
+    .. attribute:: sent
+
+        Specifies the time (as a UNIX timestamp) at which the command was
+        sent.
+
+    .. attribute:: last_response
+
+        Specifies the time (as a UNIX timestamp) at which the last response
+        was received, or ``None`` if no server responded.
+
+    .. attribute:: returned
+
+        Specifies the time (as a UNIX timestamp) at which the client finished
+        waiting for the transaction and returned control to its caller.
+    """
+
+    @property
+    def response(self):
+        """
+        Returns the number of seconds between the command being sent and the
+        last response being received, or ``None`` if no server responded.
+        """
+        if self.last_response is None:
+            return None
+        return self.last_response - self.sent
+
+    @property
+    def overhead(self):
+        """
+        Returns the number of seconds between the last response being received
+        and control returning to the caller, or ``None`` if no server
+        responded. For transactions which wait for a fixed number of servers
+        this should be negligible; transactions which time out (or wait for a
+        quiet period) include that delay.
+        """
+        if self.last_response is None:
+            return None
+        return self.returned - self.last_response
+
+
+class CompoundPiClock(namedtuple('CompoundPiClock', (
+    'offset',
+    'rtt',
+    'updated',
+    ))):
+    """
+    This class is a namedtuple derivative used to store the clock estimate for
+    a server, as returned by :meth:`CompoundPiClient.sync`.
+
+    .. attribute:: offset
+
+        The estimated difference (in seconds) between the server's clock and
+        the client's clock; positive values indicate the server's clock is
+        ahead of the client's.
+
+    .. attribute:: rtt
+
+        The round-trip time (in seconds) of the exchange the estimate was
+        derived from, excluding the time the server spent processing it. The
+        error in :attr:`offset` is at most half of this.
+
+    .. attribute:: updated
+
+        The time (in seconds since the epoch, by the client's clock) at which
+        the estimate was made.
+    """
+
+
+class CompoundPiSkew(dict):
     """
+    This class is a :class:`dict` derivative returned by
+    :meth:`CompoundPiClient.capture` when a synchronized capture is requested.
+    It maps each server's address to the difference (in seconds) between the
+    time the server began capturing (translated to the client's clock with
+    the server's clock estimate) and the :attr:`target` time. Properties
+    summarize the distribution of these differences.
+    """
+
+    def __init__(self, target, *args, **kwargs):
+        super(CompoundPiSkew, self).__init__(*args, **kwargs)
+        self.target = target
+
+    @property
+    def mean(self):
+        """
+        Returns the mean difference from the target time in seconds.
+        """
+        return sum(self.values()) / len(self) if self else 0.0
+
+    @property
+    def stdev(self):
+        """
+        Returns the standard deviation of the differences in seconds.
+        """
+        if not self:
+            return 0.0
+        mean = self.mean
+        return (sum((d - mean) ** 2 for d in self.values()) / len(self)) ** 0.5
+
+    @property
+    def spread(self):
+        """
+        Returns the time between the earliest and latest captures in seconds.
+        """
+        return max(self.values()) - min(self.values()) if self else 0.0
+
+
+class NetworkAddresses(object):
+    """
+    Represents the set of addresses belonging to *network* for the purposes of
+    membership tests. Unlike the network itself, membership and length are
+    computed from the integer value of the addresses without enumerating the
+    network (which would construct 65,536 address objects for a /16 network).
+    """
+
+    def __init__(self, network):
+        self.first = int(network.network)
+        self.last = int(network.broadcast)
+
+    def __len__(self):
+        return self.last - self.first + 1
+
+    def __contains__(self, address):
+        return self.first <= int(address) <= self.last
+
+
+class CompoundPiFuture(object):
+    """
+    Represents the eventual outcome of a command sent to one or more servers.
+    Instances of this class are returned by methods of
+    :class:`CompoundPiClient` called within a :meth:`~CompoundPiClient.pipeline`
+    block.
+
+    Futures are also returned by the ``_async`` variants of several methods
+    (:meth:`~CompoundPiClient.status_async`,
+    :meth:`~CompoundPiClient.list_async`, etc.), in which case :meth:`result`
+    returns the same value as the corresponding synchronous method.
+
+    Futures are resolved as the client reads responses from the network
+    (which it does while waiting for any outstanding command), hence
+    :meth:`result` must be called to guarantee progress. The futures of an
+    :class:`AsyncCompoundPiClient` are resolved by a background thread
+    instead.
+    """
+
+    def __init__(
+            self, client, seqno, servers, count, addresses, deadline, quiet=0):
+        self._client = client
+        self.seqno = seqno
+        self.servers = servers
+        self.count = count
+        self.addresses = addresses
+        self.deadline = deadline
+        self.quiet = quiet
+        self.senders = set()
+        self.raw = {}
+        self.received = {}
+        self.sent = None
+        self.returned = None
+        self.errors = None
+        self._responses = None
+        self._fragments = {}
+        self._last = None
+        self._gap = 0.0
+        self._parse = None
+        self._callbacks = []
+
+    def expiry(self):
+        """
+        Returns the time at which the command will time out. If the future
+        was created with a *quiet* period, this is brought forward once any
+        server has responded to the later of *quiet* seconds, or three times
+        the largest interval between responses so far, after the last
+        response.
+        """
+        if self.quiet and self._last is not None:
+            return min(
+                self.deadline,
+                self._last + max(self.quiet, self._gap * 3))
+        return self.deadline
+
+    def done(self):
+        """
+        Returns ``True`` if all servers have responded to the command, or the
+        command has timed out.
+        """
+        return self._responses is not None
+
+    def result(self):
+        """
+        Waits for the command to complete, and returns a mapping of server
+        address to response data. If any server failed to respond, or
+        responded with an error, :exc:`CompoundPiTransactionFailed` is raised.
+        """
+        self._client._wait(self)
+        if self.errors:
+            raise CompoundPiTransactionFailed(self.errors)
+        if self._parse is not None:
+            return self._parse(self._responses)
+        return self._responses
+
+    def add_done_callback(self, fn):
+        """
+        Arranges for *fn* to be called with the future as its only parameter
+        when the future completes (immediately, if it already has). Callbacks
+        are called by whichever thread reads the final response; with an
+        :class:`AsyncCompoundPiClient` this is its background thread, hence
+        callbacks must not block or wait for other commands.
+        """
+        # The client's lock is held while futures are completed, hence
+        # holding it here ensures the callback is neither lost nor called
+        # twice
+        with self._client._lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        self._callback(fn)
+
+    def _callback(self, fn):
+        try:
+            fn(self)
+        except Exception as e:
+            logging.warning('Future callback failed: %s', e)
+
+    def _receive(self, address, match, now):
+        if address in self.raw:
+            warnings.warn(CompoundPiMultiResponse(address))
+        elif address not in self.servers:
+            warnings.warn(CompoundPiUnknownAddress(address))
+        else:
+            data = match.group('data')
+            fragment = match.group('fragment')
+            if fragment is not None:
+                # Accumulate fragments until all have been received; repeated
+                # fragments simply overwrite their earlier copy
+                chunks = self._fragments.setdefault(address, {})
+                chunks[int(fragment)] = data or ''
+                total = int(match.group('fragments'))
+                if len(chunks) < total:
+                    return
+                data = ''.join(chunks[i] for i in range(total))
+                del self._fragments[address]
+            self.raw[address] = (match.group('result'), data)
+            self.received[address] = now
+            if self._last is not None:
+                self._gap = max(self._gap, now - self._last)
+            self._last = now
+            if len(self.raw) >= self.count:
+                self._complete()
+
+    def _complete(self):
+        if self._responses is None:
+            self._client._pending.pop(self.seqno, None)
+            while self.senders:
+                self._client._repeater.cancel(self.senders.pop())
+            if self.addresses is None:
+                self._responses, self.errors = dict(self.raw), []
+            else:
+                self._responses, self.errors = self._client._check_responses(
+                    self.addresses, dict(self.raw))
+            callbacks, self._callbacks = self._callbacks, []
+            for fn in callbacks:
+                self._callback(fn)
 
 
 class CompoundPiClient(object):
@@ -307,6 +775,22 @@ class CompoundPiClient(object):
     exception to this is the :meth:`download` method for retrieving captured
     images. For the sake of efficiency this is expected to operate against one
     server at a time, so the *address* parameter is mandatory.
+
+    Synchronized captures (see :meth:`capture`) rely upon estimates of each
+    server's clock offset obtained by :meth:`sync`. The :attr:`sync_interval`
+    attribute (default 60) specifies the age in seconds after which an
+    estimate is refreshed; setting it to 0 disables the use of estimates.
+
+    Live previews (see :meth:`preview`) share the bandwidth specified by the
+    :attr:`preview_bandwidth` attribute (default 20000000 bits per second);
+    as more previews are opened, the bitrate and quality of each is reduced
+    to keep the total within this limit.
+
+    The timing of recent transactions is recorded in the :attr:`latencies`
+    attribute, a :class:`~collections.deque` of the last 100
+    :class:`CompoundPiLatency` records (most recent last), which may be used
+    to compare how long servers took to respond with how long the client took
+    to return control afterward.
     """
 
     request_re = re.compile(
@@ -314,7 +798,9 @@ class CompoundPiClient(object):
             r'(?P<command>[A-Z]+)( (?P<params>.*))?')
     response_re = re.compile(
             r'(?P<seqno>\d+) '
-            r'(?P<result>OK|ERROR)(\n(?P<data>.*))?', flags=re.DOTALL)
+            r'(?P<result>OK|ERROR)'
+            r'( (?P<fragment>\d+)/(?P<fragments>\d+))?'
+            r'(\n(?P<data>.*))?', flags=re.DOTALL)
 
     def __init__(self, progress=None):
         self._seqno = 0
@@ -326,7 +812,25 @@ class CompoundPiClient(object):
         self._server = None
         self._server_thread = None
         self._servers = set()
-        self._senders = {}
+        self._groups = {}
+        self._clocks = {}
+        self._previews = {}
+        self._preview_server = None
+        self._preview_command = None
+        self._transfers = {}
+        self._channels = {}
+        self._data_channels = False
+        self._lock = threading.RLock()
+        self._repeater = NetworkRepeater(self._socket)
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            self._poller.register(self._socket.fileno(), select.EPOLLIN)
+        else:
+            self._poller = None
+        self._pending = {}
+        self.latencies = collections.deque(maxlen=100)
+        self._pipeline = None
+        self.window = 8
         self._progress_start = self._progress_update = self._progress_finish = None
         if progress is not None:
             (
@@ -338,6 +842,9 @@ class CompoundPiClient(object):
         self.port = 5647
         self.bind = ('0.0.0.0', 5647)
         self.timeout = 5
+        self.multicast_ttl = 1
+        self.sync_interval = 60
+        self.preview_bandwidth = 20000000
 
     def _get_bind(self):
         if self._server:
@@ -347,15 +854,16 @@ class CompoundPiClient(object):
             self._server.shutdown()
             self._server.socket.close()
             self._server_thread = None
+        if self._preview_server:
+            # The preview listener is re-created (on the new interface) by
+            # the next call to preview()
+            self._preview_server.shutdown()
+            self._preview_server.socket.close()
+            self._preview_server = None
+            self._preview_command = None
         if value is not None:
             self._server = CompoundPiDownloadServer(value, CompoundPiDownloadHandler)
-            self._server.event = threading.Event()
-            self._server.source = None
-            self._server.output = None
-            self._server.exception = None
-            self._server.progress_start = self._progress_start
-            self._server.progress_update = self._progress_update
-            self._server.progress_finish = self._progress_finish
+            self._server.transfers = self._transfers
             self._server_thread = threading.Thread(target=self._server.serve_forever)
             self._server_thread.daemon = True
             self._server_thread.start()
@@ -385,6 +893,31 @@ class CompoundPiClient(object):
             simplicity.
         """)
 
+    def _get_data_channels(self):
+        return self._data_channels
+    def _set_data_channels(self, value):
+        self._data_channels = bool(value)
+        if not self._data_channels:
+            for channel in self._channels.values():
+                channel.close()
+            self._channels = {}
+    data_channels = property(_get_data_channels, _set_data_channels, doc="""
+        Defines whether images are downloaded over persistent connections
+        opened by the client.
+
+        By default (when this attribute is ``False``) each server connects to
+        the client (on the port given by :attr:`bind`) to send images, which
+        requires that servers are able to open connections to the client.
+        When this attribute is ``True``, the client instead opens a single
+        connection to each server's :attr:`port`, which is kept open and
+        used for all subsequent downloads (see :ref:`protocol_send`). This
+        permits downloads where the client cannot accept connections (e.g.
+        behind NAT), and avoids the cost of establishing (and ramping up the
+        throughput of) a connection for each transfer. Connections are opened
+        when first required, re-opened if they fail, and closed when this
+        attribute is set to ``False``.
+        """)
+
     def _get_port(self):
         return self._port
     def _set_port(self, value):
@@ -414,6 +947,8 @@ class CompoundPiClient(object):
     def _set_network(self, value):
         self._network = IPv4Network(value)
         self._servers = set()
+        self._groups = {}
+        self._clocks = {}
     network = property(_get_network, _set_network, doc="""
         Defines the network that all servers belong to.
 
@@ -438,99 +973,279 @@ class CompoundPiClient(object):
         all potential addresses within the defined network.
         """)
 
+    def _get_multicast_ttl(self):
+        return self._socket.getsockopt(
+            socket.IPPROTO_IP, socket.IP_MULTICAST_TTL)
+    def _set_multicast_ttl(self, value):
+        self._socket.setsockopt(
+            socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, value)
+    multicast_ttl = property(_get_multicast_ttl, _set_multicast_ttl, doc="""
+        Defines the time-to-live of commands sent to multicast groups.
+
+        This attribute defaults to 1, which confines multicast commands to the
+        local network. If servers are spread across routed networks (e.g.
+        several VLANs) and the routers forward multicast traffic, increase
+        this to the number of hops required. See :meth:`group` for more
+        information on multicast groups.
+        """)
+
     def _send_command(self, address, seqno, data):
         assert self.request_re.match(data)
         logging.debug('%s Tx %s', address, data)
         if isinstance(data, str):
             data = data.encode('utf-8')
-        self._senders[(address, seqno)] = NetworkRepeater(
-            self._socket, address, data)
-
-    def _responses(self, servers=None, count=0):
+        self._repeater.send((address, seqno), address, data)
+
+    def _start(
+            self, commands, servers=None, count=0, addresses=None, quiet=0):
+        # Begin a transaction by sending each command in the sequence of
+        # (destination, command) tuples with a new sequence number. The
+        # returned future tracks the responses from *servers* (defaults to all
+        # defined servers, or the whole network if none are defined) until
+        # *count* have been received, the transaction times out, or *quiet*
+        # seconds (if non-zero) pass without a new response
+        while len(self._pending) >= self.window:
+            self._wait(min(self._pending.values(), key=lambda f: f.seqno))
         if servers is None:
             servers = self._servers
         if not count:
             count = len(servers)
         if not servers:
-            servers = self.network
+            servers = NetworkAddresses(self.network)
             if not count:
-                count = sum(1 for a in self.network)
-        if self._progress_start:
-            self._progress_start(count)
-        result = {}
-        start = time.time()
+                count = len(servers)
+        self._seqno += 1
+        future = CompoundPiFuture(
+            self, self._seqno, servers, count, addresses,
+            time.time() + self.timeout, quiet)
+        self._pending[future.seqno] = future
+        future.sent = time.time()
+        for destination, data in commands:
+            future.senders.add((destination, future.seqno))
+            self._send_command(
+                destination, future.seqno, '%d %s' % (future.seqno, data))
+        return future
+
+    def _wait(self, future, progress=False):
+        # Read responses until *future* completes or times out. Responses to
+        # other outstanding transactions received in the meantime are
+        # dispatched to their own futures
+        if progress and self._progress_start:
+            self._progress_start(future.count)
         try:
-            while time.time() - start < self.timeout:
-                if self._progress_update:
-                    self._progress_update(len(result))
-                if select.select([self._socket], [], [], 1)[0]:
-                    data, server_address = self._socket.recvfrom(512)
-                    data = data.decode('utf-8')
-                    logging.debug('%s Rx %s', server_address, data)
-                    match = self.response_re.match(data)
-                    address, port = server_address
-                    address = IPv4Address(address)
-                    if port != self.port:
-                        warnings.warn(CompoundPiWrongPort(address, port))
-                    elif address in result:
-                        warnings.warn(CompoundPiMultiResponse(address))
-                    elif address not in servers:
-                        warnings.warn(CompoundPiUnknownAddress(address))
-                    elif not match:
-                        warnings.warn(CompoundPiBadResponse(address))
-                    else:
-                        seqno = int(match.group('seqno'))
-                        # Unconditionally send an ACK to silence the responder
-                        # of whatever server sent the message
-                        self._socket.sendto('%d ACK' % seqno, server_address)
-                        # Silence the sender that the response corresponds
-                        # to (if any)
-                        sender = self._senders.get((server_address, seqno))
-                        if sender:
-                            sender.terminate = True
-                            # We deliberately don't join() the sender here
-                            # to ensure we don't delay receiving the next
-                            # response
-                        if seqno < self._seqno:
-                            warnings.warn(CompoundPiStaleResponse(address))
-                        elif seqno > self._seqno:
-                            warnings.warn(CompoundPiFutureResponse(address))
-                        else:
-                            result[address] = (
-                                    match.group('result'),
-                                    match.group('data'),
-                                    )
-                            if len(result) == count:
-                                break
-            if self._progress_update:
-                self._progress_update(len(result))
-            return result
+            while not future.done():
+                now = time.time()
+                self._expire(now)
+                if future.done():
+                    break
+                if progress and self._progress_update:
+                    self._progress_update(len(future.raw))
+                if self._socket.fileno() in self._poll(future.expiry() - now):
+                    self._drain()
+            if progress and self._progress_update:
+                self._progress_update(len(future.raw))
+            self._returned(future)
+            return future
         finally:
-            while self._senders:
-                _, sender = self._senders.popitem()
-                sender.terminate = True
-                sender.join()
-            if self._progress_finish:
+            if progress and self._progress_finish:
                 self._progress_finish()
 
-    def _transact(self, data, addresses=None):
+    def _poll(self, timeout):
+        # Wait up to *timeout* seconds (indefinitely if None) for any of the
+        # polled descriptors to become readable, returning the set of those
+        # which are
+        if self._poller is not None:
+            if timeout is None:
+                timeout = -1
+            else:
+                timeout = max(0, timeout)
+            while True:
+                try:
+                    return {fd for (fd, events) in self._poller.poll(timeout)}
+                except IOError as e:
+                    # Python 2's epoll doesn't retry interrupted waits
+                    if e.errno != errno.EINTR:
+                        raise
+        if timeout is not None:
+            timeout = max(0, timeout)
+        return set(select.select(self._polled(), [], [], timeout)[0])
+
+    def _polled(self):
+        # Returns the descriptors waited upon by _poll where epoll is
+        # unavailable
+        return [self._socket.fileno()]
+
+    def _drain(self):
+        # Read every datagram queued on the socket, so that a burst of
+        # responses is dispatched in one wakeup
+        while True:
+            self._receive()
+            if self._socket.fileno() not in self._poll(0):
+                break
+
+    def _returned(self, future):
+        # Record the timing of *future* the first time control returns to a
+        # caller waiting for it
+        if future.returned is None:
+            future.returned = time.time()
+            latency = CompoundPiLatency(
+                future.seqno, future.sent, future._last, future.returned)
+            self.latencies.append(latency)
+            if latency.last_response is not None:
+                logging.debug(
+                    'Transaction %d: last response after %.1fms, '
+                    'returned %.1fms later',
+                    latency.seqno, latency.response * 1000,
+                    latency.overhead * 1000)
+
+    def _expire(self, now):
+        for future in list(self._pending.values()):
+            if now >= future.expiry():
+                future._complete()
+
+    def _receive(self):
+        data, server_address = self._socket.recvfrom(65535)
+        now = time.time()
+        data = data.decode('utf-8')
+        logging.debug('%s Rx %s', server_address, data)
+        match = self.response_re.match(data)
+        address, port = server_address
+        address = IPv4Address(address)
+        if port != self.port:
+            warnings.warn(CompoundPiWrongPort(address, port))
+        elif not match:
+            warnings.warn(CompoundPiBadResponse(address))
+        else:
+            seqno = int(match.group('seqno'))
+            fragment = match.group('fragment')
+            # Unconditionally send an ACK to silence the responder of whatever
+            # server sent the message (or fragment)
+            if fragment is None:
+                self._socket.sendto('%d ACK' % seqno, server_address)
+            else:
+                self._socket.sendto(
+                    '%d ACK %s' % (seqno, fragment), server_address)
+            try:
+                future = self._pending[seqno]
+            except KeyError:
+                if seqno > self._seqno:
+                    warnings.warn(CompoundPiFutureResponse(address))
+                else:
+                    warnings.warn(CompoundPiStaleResponse(address))
+            else:
+                # Silence the sender that the response corresponds to (if
+                # any)
+                if (server_address, seqno) in future.senders:
+                    future.senders.remove((server_address, seqno))
+                    self._repeater.cancel((server_address, seqno))
+                future._receive(address, match, now)
+
+    def _transact_async(self, data, addresses=None):
         if addresses is None:
             if not self._servers:
                 raise CompoundPiNoServers()
             addresses = self._servers
         elif set(addresses) - self._servers:
             raise CompoundPiUndefinedServers(set(addresses) - self._servers)
-        errors = []
-        self._seqno += 1
-        data = '%d %s' % (self._seqno, data)
-        if set(addresses) == self._servers:
-            self._send_command(
-                (str(self.network.broadcast), self.port), self._seqno, data)
+        addresses = set(addresses)
+        group = self._find_group(addresses)
+        if addresses == self._servers:
+            commands = [((str(self.network.broadcast), self.port), data)]
+        elif group is not None:
+            commands = [((str(group), self.port), data)]
         else:
-            for address in addresses:
-                self._send_command(
-                    (str(address), self.port), self._seqno, data)
-        responses = self._responses(addresses)
+            commands = [
+                ((str(address), self.port), data)
+                for address in addresses
+                ]
+        return self._start(commands, addresses, addresses=addresses)
+
+    def _find_group(self, addresses):
+        for group, members in self._groups.items():
+            if members == addresses:
+                return group
+
+    def _transact(self, data, addresses=None):
+        return self._wait(
+            self._transact_async(data, addresses), progress=True).result()
+
+    def _command(self, data, addresses=None):
+        # Execute a command which returns no data. Within a pipeline block
+        # the command's future is returned immediately, otherwise the command
+        # is executed synchronously
+        future = self._transact_async(data, addresses)
+        if self._pipeline is not None:
+            self._pipeline.append(future)
+            return future
+        self._wait(future, progress=True).result()
+
+    def _transact_each_async(self, commands):
+        # Variant of _transact_async which sends a different command to each
+        # server (commands is a mapping of address to command) within a single
+        # transaction
+        if set(commands) - self._servers:
+            raise CompoundPiUndefinedServers(set(commands) - self._servers)
+        return self._start(
+            [
+                ((str(address), self.port), data)
+                for (address, data) in commands.items()
+                ],
+            set(commands), addresses=set(commands))
+
+    def _transact_each(self, commands):
+        # Rather than raising an exception, any errors are returned alongside
+        # the responses
+        future = self._wait(self._transact_each_async(commands), progress=True)
+        return future._responses, future.errors
+
+    @contextlib.contextmanager
+    def pipeline(self):
+        """
+        Returns a context manager which pipelines the commands issued within
+        it. Ordinarily each method waits for all servers to respond before
+        returning. Within a pipeline block, methods which return no data
+        (:meth:`resolution`, :meth:`framerate`, :meth:`capture`, etc.) return
+        a :class:`CompoundPiFuture` immediately after sending their command,
+        permitting up to :attr:`window` commands to be outstanding at once.
+        Methods which return data (:meth:`status`, :meth:`list`, etc.) still
+        wait for their responses. When the block exits, the client waits for
+        all outstanding commands to complete and raises
+        :exc:`CompoundPiTransactionFailed` detailing any errors. For example::
+
+            from compoundpi.client import CompoundPiClient
+
+            client = CompoundPiClient()
+            client.network = '192.168.0.0/24'
+            client.find(10)
+            with client.pipeline():
+                client.resolution(1280, 720)
+                client.framerate(30)
+                client.agc('auto')
+                client.awb('auto')
+                client.exposure('auto')
+        """
+        if self._pipeline is not None:
+            # Nested pipeline blocks simply join the outer block
+            yield
+            return
+        self._pipeline = []
+        try:
+            yield
+        except:
+            futures, self._pipeline = self._pipeline, None
+            for future in futures:
+                self._wait(future)
+            raise
+        else:
+            futures, self._pipeline = self._pipeline, None
+            errors = []
+            for future in futures:
+                errors.extend(self._wait(future).errors)
+            if errors:
+                raise CompoundPiTransactionFailed(errors)
+
+    def _check_responses(self, addresses, responses):
+        errors = []
         for address in addresses:
             try:
                 result, response = responses[address]
@@ -542,9 +1257,7 @@ class CompoundPiClient(object):
                     errors.append(CompoundPiServerError(address, response))
                 elif result != 'OK':
                     errors.append(CompoundPiInvalidResponse(address))
-        if errors:
-            raise CompoundPiTransactionFailed(errors)
-        return responses
+        return responses, errors
 
     def __len__(self):
         return len(self._servers)
@@ -591,11 +1304,10 @@ class CompoundPiClient(object):
             address = IPv4Address(address)
         if address in self:
             raise CompoundPiRedefinedServer(address)
-        self._seqno += 1
-        data = '%d HELLO %f' % (self._seqno, time.time())
-        self._send_command(
-            (str(address), self.port), self._seqno, data)
-        response = self._parse_ping(self._responses({address}))
+        future = self._wait(self._start(
+            [((str(address), self.port), 'HELLO %f' % time.time())],
+            {address}), progress=True)
+        response = self._parse_ping(dict(future.raw))
         if not address in response:
             raise CompoundPiTransactionFailed([
                 CompoundPiMissingResponse(address)
@@ -626,16 +1338,115 @@ class CompoundPiClient(object):
         if not isinstance(address, IPv4Address):
             address = IPv4Address(address)
         self._servers.remove(address)
+        self._previews.pop(address, None)
+        channel = self._channels.pop(address, None)
+        if channel:
+            channel.close()
 
-    def find(self, count=0):
+    def group(self, group, addresses=None):
+        """
+        Called to assign servers to the multicast *group* (an address between
+        224.0.0.0 and 239.255.255.255). If *addresses* is omitted, all
+        servers in the client's list are assigned to the group. Servers
+        previously assigned to the group (by this method, or as reported by
+        :meth:`groups`) which are not in *addresses* are removed from it. The
+        :ref:`protocol_group` commands required are sent in a single
+        transaction. For example::
+
+            from compoundpi.client import CompoundPiClient
+
+            client = CompoundPiClient()
+            client.network = '192.168.0.0/24'
+            client.find(10)
+            client.group('239.0.0.1', [
+                '192.168.0.%d' % i for i in range(2, 7)])
+            # The following sends a single datagram to the group
+            client.capture(addresses=[
+                '192.168.0.%d' % i for i in range(2, 7)])
+
+        Subsequently, whenever a command is sent to exactly the set of servers
+        in a group, the client sends a single datagram to the group instead
+        of one datagram per server. Unlike broadcasts, multicast datagrams can
+        cross routers (see :attr:`multicast_ttl`). Note that servers forget
+        groups assigned by the client when they restart; call this method
+        again in that case.
+        """
+        if not isinstance(group, IPv4Address):
+            group = IPv4Address(group)
+        if not group.is_multicast:
+            raise ValueError('%s is not a multicast address' % group)
+        if addresses is None:
+            addresses = self._servers
+        addresses = {
+            address if isinstance(address, IPv4Address) else
+            IPv4Address(address)
+            for address in addresses
+            }
+        if addresses - self._servers:
+            raise CompoundPiUndefinedServers(addresses - self._servers)
+        current = self._groups.pop(group, set()) & self._servers
+        commands = {
+            address: 'GROUP JOIN %s' % group
+            for address in addresses - current
+            }
+        commands.update({
+            address: 'GROUP LEAVE %s' % group
+            for address in current - addresses
+            })
+        if commands:
+            responses, errors = self._transact_each(commands)
+            if errors:
+                # Membership of the group is uncertain; leave it unrecorded so
+                # that commands fall back to unicast
+                raise CompoundPiTransactionFailed(errors)
+        if addresses:
+            self._groups[group] = addresses
+
+    def ungroup(self, group):
+        """
+        Called to remove all servers from the multicast *group*. This is
+        equivalent to calling :meth:`group` with an empty list of addresses.
+        """
+        self.group(group, [])
+
+    def groups(self, addresses=None):
+        """
+        Called to query the multicast groups the servers specified by
+        *addresses* (or all servers in the client's list if omitted) belong
+        to, including any joined by the server on startup. The return value
+        is a mapping of server address to a set of group addresses. The
+        client's record of group membership (used to select a group in place
+        of unicast datagrams) is updated from the result.
+        """
+        responses = self._transact('GROUP', addresses)
+        result = {
+            address: {
+                IPv4Address(line.split()[1])
+                for line in response.splitlines()
+                if line.startswith('GROUP ')
+                }
+            for (address, response) in responses.items()
+            }
+        for group in set(self._groups).union(*result.values()):
+            members = (self._groups.get(group, set()) - set(result)) | {
+                address
+                for (address, groups) in result.items()
+                if group in groups
+                }
+            if members:
+                self._groups[group] = members
+            else:
+                self._groups.pop(group, None)
+        return result
+
+    def find(self, count=0, quiet=1.0, cache=None):
         """
         Called to discover servers on the client's network. The :meth:`find`
         method broadcasts a :ref:`protocol_hello` message to the currently
-        configured network. If called with no expected *count*, the method then
-        waits for the network :attr:`timeout` (default 15 seconds) and adds all
-        servers that replied to the broadcast to the client's list. If called
-        with an expected *count* value, the method will terminate as soon as
-        *count* servers have replied. For example::
+        configured network and adds all servers that reply to the client's
+        list. If called with an expected *count* value, the method will
+        terminate as soon as *count* servers have replied, or once the network
+        :attr:`timeout` has elapsed. For example::
 
             from compoundpi.client import CompoundPiClient
 
@@ -646,15 +1457,77 @@ class CompoundPiClient(object):
             for addr in client:
                 print(str(addr))
 
+        If called with no expected *count*, the method terminates once no new
+        server has replied for *quiet* seconds (default 1 second) or three
+        times the largest interval seen between replies, whichever is longer.
+        If no server replies at all, the method waits for the network
+        :attr:`timeout`. Specify 0 for *quiet* to always wait for the full
+        timeout.
+
+        The optional *cache* parameter specifies the filename of a server
+        cache. If the file exists, it is expected to contain one server
+        address per line, and (if *count* is not specified) the method
+        terminates as soon as that many servers have replied. After discovery,
+        the addresses of all servers found are written to the file. Note that
+        with a warm cache, servers beyond those recorded may not be found if
+        they reply after the cached servers; call the method without *cache*
+        to perform a full discovery.
+
         This method or the :meth:`add` method are usually the first methods
         called after construction and configuration of the client instance.
         """
+        self._wait(self.find_async(count, quiet, cache), progress=True)
+
+    def find_async(self, count=0, quiet=1.0, cache=None):
+        """
+        Variant of :meth:`find` which returns a :class:`CompoundPiFuture`
+        immediately after broadcasting the :ref:`protocol_hello` message. The
+        client's list of servers is replaced when the future completes, and
+        the future's result is the set of addresses found.
+        """
+        # An explicit count waits up to the timeout for that many servers;
+        # the quiet period only applies to open-ended discovery, or where
+        # the count is merely a guess from the cache
+        if count:
+            quiet = 0
+        elif cache:
+            count = len(self._read_cache(cache))
         self._servers = set()
-        self._seqno += 1
-        data = '%d HELLO %f' % (self._seqno, time.time())
-        self._send_command(
-            (str(self.network.broadcast), self.port), self._seqno, data)
-        self._servers = self._parse_ping(self._responses(count=count))
+        future = self._start(
+            [((str(self.network.broadcast), self.port), 'HELLO %f' % time.time())],
+            count=count, quiet=quiet)
+        def found(future):
+            self._servers = self._parse_ping(dict(future.raw))
+            if cache:
+                self._write_cache(cache)
+        future.add_done_callback(found)
+        future._parse = lambda responses: set(self._servers)
+        return future
+
+    def _read_cache(self, filename):
+        addresses = NetworkAddresses(self.network)
+        result = set()
+        try:
+            with io.open(filename, 'r', encoding='ascii') as f:
+                for line in f:
+                    try:
+                        address = IPv4Address(line.strip())
+                    except ValueError:
+                        continue
+                    if address in addresses:
+                        result.add(address)
+        except IOError as e:
+            logging.debug('Unable to read server cache %s: %s', filename, e)
+        return result
+
+    def _write_cache(self, filename):
+        try:
+            with io.open(filename, 'w', encoding='ascii') as f:
+                for address in sorted(self._servers):
+                    f.write('%s\n' % address)
+        except IOError as e:
+            logging.warning(
+                'Unable to write server cache %s: %s', filename, e)
 
     status_re = re.compile(
             r'RESOLUTION (?P<width>\d+) (?P<height>\d+)\n'
@@ -670,7 +1543,9 @@ class CompoundPiClient(object):
             r'EV (?P<ev>-?\d+)\n'
             r'FLIP (?P<hflip>0|1) (?P<vflip>0|1)\n'
             r'TIMESTAMP (?P<time>\d+(\.\d+)?)\n'
-            r'IMAGES (?P<images>\d{,3})\n')
+            r'IMAGES (?P<images>\d+)\n'
+            r'STORE (?P<memory_used>\d+) (?P<memory_limit>\d+) '
+            r'(?P<disk_used>\d+) (?P<disk_limit>\d+)\n')
     def status(self, addresses=None):
         """
         Called to determine the status of servers. The :meth:`status` method
@@ -692,9 +1567,22 @@ class CompoundPiClient(object):
                     status.resolution.height,
                     ))
         """
+        return self._wait(self.status_async(addresses), progress=True).result()
+
+    def status_async(self, addresses=None):
+        """
+        Variant of :meth:`status` which returns a :class:`CompoundPiFuture`
+        immediately after sending the :ref:`protocol_status` command. The
+        future's result is the mapping that :meth:`status` would return.
+        """
+        future = self._transact_async('STATUS', addresses)
+        future._parse = self._parse_status
+        return future
+
+    def _parse_status(self, responses):
         responses = [
             (address, self.status_re.match(data))
-            for (address, data) in self._transact('STATUS', addresses).items()
+            for (address, data) in responses.items()
             ]
         errors = []
         result = {}
@@ -723,12 +1611,94 @@ class CompoundPiClient(object):
                     vflip=bool(int(match.group('vflip'))),
                     timestamp=datetime.datetime.fromtimestamp(float(match.group('time'))),
                     images=int(match.group('images')),
+                    store=StoreUsage(
+                        int(match.group('memory_used')),
+                        int(match.group('memory_limit')),
+                        int(match.group('disk_used')),
+                        int(match.group('disk_limit')),
+                        ),
                     )
         if errors:
             raise CompoundPiTransactionFailed(
                 errors, '%d invalid status responses' % len(errors))
         return result
 
+    # The settings accepted by configure, in the order they are transmitted
+    configure_settings = (
+        'resolution',
+        'framerate',
+        'awb_mode',
+        'awb_red',
+        'awb_blue',
+        'agc_mode',
+        'exposure_mode',
+        'exposure_speed',
+        'metering_mode',
+        'iso',
+        'brightness',
+        'contrast',
+        'saturation',
+        'ev',
+        'hflip',
+        'vflip',
+        )
+
+    def configure(self, addresses=None, **settings):
+        """
+        Called to change several camera settings at once on the servers at the
+        specified *addresses* (or all defined servers if *addresses* is
+        omitted). All settings are sent in a single :ref:`protocol_configure`
+        command, which is considerably faster than calling :meth:`resolution`,
+        :meth:`framerate`, :meth:`awb`, etc. individually. The settings are
+        specified as keyword arguments named after the attributes of
+        :class:`CompoundPiStatus`:
+
+        * *resolution* - a ``(width, height)`` tuple
+        * *framerate* - a number or :class:`~fractions.Fraction`
+        * *awb_mode*, *awb_red*, *awb_blue* - see :meth:`awb`
+        * *agc_mode* - see :meth:`agc`
+        * *exposure_mode*, *exposure_speed* - see :meth:`exposure`
+        * *metering_mode* - see :meth:`metering`
+        * *iso* - see :meth:`iso`
+        * *brightness*, *contrast*, *saturation* - see :meth:`brightness`,
+          :meth:`contrast`, and :meth:`saturation`
+        * *ev* - see :meth:`ev`
+        * *hflip*, *vflip* - see :meth:`flip`
+
+        Settings which are omitted are left unchanged. The method returns a
+        mapping of address to :class:`CompoundPiStatus` tuples describing the
+        resulting configuration of each server. For example::
+
+            from compoundpi.client import CompoundPiClient
+
+            client = CompoundPiClient()
+            client.network = '192.168.0.0/24'
+            client.find(10)
+            client.configure(
+                resolution=(1280, 720), framerate=30, awb_mode='off',
+                awb_red=1.5, awb_blue=1.3, iso=100)
+        """
+        params = []
+        for key in self.configure_settings:
+            if key in settings:
+                value = settings.pop(key)
+                if key == 'resolution':
+                    value = '%dx%d' % tuple(value)
+                elif key == 'framerate':
+                    value = str(Fraction(value).limit_denominator(1000))
+                elif key in ('awb_red', 'awb_blue', 'exposure_speed'):
+                    value = '%f' % value
+                elif key in ('hflip', 'vflip'):
+                    value = '%d' % bool(value)
+                elif key in ('iso', 'brightness', 'contrast', 'saturation', 'ev'):
+                    value = '%d' % value
+                params.append('%s=%s' % (key, value))
+        if settings:
+            raise ValueError(
+                'Invalid setting(s): %s' % ', '.join(sorted(settings)))
+        return self._parse_status(
+            self._transact('CONFIGURE %s' % ' '.join(params), addresses))
+
     def resolution(self, width, height, addresses=None):
         """
         Called to change the camera resolution on the servers at the specified
@@ -743,7 +1713,7 @@ class CompoundPiClient(object):
             client.find(10)
             client.resolution(1280, 720)
         """
-        self._transact('RESOLUTION %d %d' % (width, height), addresses)
+        return self._command('RESOLUTION %d %d' % (width, height), addresses)
 
     def framerate(self, rate, addresses=None):
         """
@@ -760,7 +1730,7 @@ class CompoundPiClient(object):
             client.find(10)
             client.framerate(24)
         """
-        self._transact('FRAMERATE %s' % rate, addresses)
+        return self._command('FRAMERATE %s' % rate, addresses)
 
     def awb(self, mode, red=0.0, blue=0.0, addresses=None):
         """
@@ -803,7 +1773,7 @@ class CompoundPiClient(object):
             status = client.status(addresses=addr)[addr]
             client.awb('off', status.awb_red, status.awb_blue)
         """
-        self._transact('AWB %s %f %f' % (mode, red, blue), addresses)
+        return self._command('AWB %s %f %f' % (mode, red, blue), addresses)
 
     def agc(self, mode, addresses=None):
         """
@@ -835,7 +1805,7 @@ class CompoundPiClient(object):
             gains to a particular value (in contrast to AWB and exposure
             speed).
         """
-        self._transact('AGC %s' % mode, addresses)
+        return self._command('AGC %s' % mode, addresses)
 
     def exposure(self, mode, speed=0, addresses=None):
         """
@@ -870,7 +1840,7 @@ class CompoundPiClient(object):
             client.exposure('off', speed=status.exposure_speed)
 
         """
-        self._transact('EXPOSURE %s %f' % (mode, speed), addresses)
+        return self._command('EXPOSURE %s %f' % (mode, speed), addresses)
 
     def metering(self, mode, addresses=None):
         """
@@ -884,7 +1854,7 @@ class CompoundPiClient(object):
         * ``'matrix'``
         * ``'spot'``
         """
-        self._transact('METERING %s' % mode, addresses)
+        return self._command('METERING %s' % mode, addresses)
 
     def iso(self, value, addresses=None):
         """
@@ -893,7 +1863,7 @@ class CompoundPiClient(object):
         *mode* parameter specifies the new ISO settings as an integer value.
         values are 0 (meaning auto), 100, 200, 320, 400, 500, 640, and 800.
         """
-        self._transact('ISO %d' % value, addresses)
+        return self._command('ISO %d' % value, addresses)
 
     def brightness(self, value, addresses=None):
         """
@@ -901,7 +1871,7 @@ class CompoundPiClient(object):
         *addresses* (or all defined servers if *addresses* is omitted). The
         new level is specified an integer between 0 and 100.
         """
-        self._transact('BRIGHTNESS %d' % value, addresses)
+        return self._command('BRIGHTNESS %d' % value, addresses)
 
     def contrast(self, value, addresses=None):
         """
@@ -909,7 +1879,7 @@ class CompoundPiClient(object):
         *addresses* (or all defined servers if *addresses* is omitted). The
         new level is specified an integer between -100 and 100.
         """
-        self._transact('CONTRAST %d' % value, addresses)
+        return self._command('CONTRAST %d' % value, addresses)
 
     def saturation(self, value, addresses=None):
         """
@@ -917,7 +1887,7 @@ class CompoundPiClient(object):
         *addresses* (or all defined servers if *addresses* is omitted). The
         new level is specified an integer between -100 and 100.
         """
-        self._transact('SATURATION %d' % value, addresses)
+        return self._command('SATURATION %d' % value, addresses)
 
     def ev(self, value, addresses=None):
         """
@@ -926,7 +1896,7 @@ class CompoundPiClient(object):
         omitted). The new level is specified an integer between -24 and 24
         where each increment represents 1/6th of a stop.
         """
-        self._transact('EV %d' % value, addresses)
+        return self._command('EV %d' % value, addresses)
 
     def flip(self, horizontal, vertical, addresses=None):
         """
@@ -936,8 +1906,64 @@ class CompoundPiClient(object):
         whether to flip the camera's output along the corresponding axis. The
         default for both parameters is ``False``.
         """
-        self._transact('FLIP %d %d' % (horizontal, vertical), addresses)
+        return self._command('FLIP %d %d' % (horizontal, vertical), addresses)
+
+    sync_re = re.compile(
+            r'TIMESTAMP (?P<receive>\d+(\.\d+)?) (?P<transmit>\d+(\.\d+)?)')
+    def sync(self, addresses=None, samples=5):
+        """
+        Called to estimate the offset of the clocks of the servers at the
+        specified *addresses* (or all defined servers if *addresses* is
+        omitted) from the client's clock. The method returns a mapping of
+        address to :class:`CompoundPiClock` named tuples, and retains the
+        estimates for use by :meth:`capture`.
+
+        Each of *samples* (default 5) :ref:`protocol_sync` exchanges yields the
+        times at which the command was sent and the response received
+        (measured by the client's clock), and the times at which the server
+        received the command and sent the response (measured by the server's
+        clock). From these the offset is calculated as in NTP, under the
+        assumption that the network delay is symmetric. The estimate from the
+        exchange with the smallest round-trip time (and hence the least room
+        for asymmetric delay) is kept for each server. For example::
+
+            from compoundpi.client import CompoundPiClient
 
+            client = CompoundPiClient()
+            client.network = '192.168.0.0/24'
+            client.find(10)
+            for address, clock in client.sync().items():
+                print('%s: %+.3fms (rtt %.3fms)' % (
+                    address, clock.offset * 1000, clock.rtt * 1000))
+        """
+        best = {}
+        for sample in range(samples):
+            future = self._wait(self._transact_async('SYNC', addresses))
+            errors = []
+            for address, response in future.result().items():
+                match = self.sync_re.match(response)
+                if not match:
+                    errors.append(CompoundPiInvalidResponse(address))
+                    continue
+                sent = future.sent
+                received = future.received[address]
+                server_received = float(match.group('receive'))
+                server_sent = float(match.group('transmit'))
+                clock = CompoundPiClock(
+                    offset=(
+                        (server_received - sent) +
+                        (server_sent - received)) / 2,
+                    rtt=(received - sent) - (server_sent - server_received),
+                    updated=received,
+                    )
+                if address not in best or clock.rtt < best[address].rtt:
+                    best[address] = clock
+            if errors:
+                raise CompoundPiTransactionFailed(errors)
+        self._clocks.update(best)
+        return best
+
+    capture_re = re.compile(r'TIMESTAMP (?P<time>\d+(\.\d+)?)')
     def capture(self, count=1, video_port=False, delay=None, addresses=None):
         """
         Called to capture images on the servers at the specified *addresses*
@@ -959,10 +1985,30 @@ class CompoundPiClient(object):
         If *delay* is set to a small floating point value measured in seconds,
         it indicates that the servers should synchronize their captures to a
         timestamp (the client calculates the timestamp as *now* + *delay*
-        seconds). This functionality assumes that the servers all have accurate
-        clocks which are reasonably in sync with the client's clock; a typical
-        configuration is to run an NTP server on the client machine, and an NTP
-        client on each of the Compound Pi servers.
+        seconds). Each server is sent the timestamp translated to its own
+        clock using the estimate obtained by :meth:`sync`; estimates which are
+        missing, or older than :attr:`sync_interval` seconds, are refreshed
+        first. Because each server receives a different timestamp, the
+        command is sent to each server individually. In this case the method
+        returns a :class:`CompoundPiSkew` mapping detailing how closely each
+        server met the timestamp. For example::
+
+            from compoundpi.client import CompoundPiClient
+
+            client = CompoundPiClient()
+            client.network = '192.168.0.0/24'
+            client.find(10)
+            skew = client.capture(delay=0.5)
+            print('Captures spread over %.3fms' % (skew.spread * 1000))
+
+        If :attr:`sync_interval` is 0, clock estimates are not used and all
+        servers are sent the client's timestamp. This assumes that the servers
+        all have accurate clocks which are reasonably in sync with the
+        client's clock; a typical configuration is to run an NTP server on the
+        client machine, and an NTP client on each of the Compound Pi servers.
+
+        Within a :meth:`pipeline` block, the method returns a
+        :class:`CompoundPiFuture` instead of the skew.
 
         .. note::
 
@@ -970,15 +2016,296 @@ class CompoundPiClient(object):
             The captured images are stored in RAM on the servers for later
             retrieval with the :meth:`download` method.
         """
-        cmd = 'CAPTURE %d %d'
-        params = [count, video_port]
+        if not delay:
+            return self._command(
+                'CAPTURE %d %d' % (count, video_port), addresses)
+        return self._deliver(self.capture_async(
+            count, video_port, delay, addresses))
+
+    def capture_async(
+            self, count=1, video_port=False, delay=None, addresses=None):
+        """
+        Variant of :meth:`capture` which returns a :class:`CompoundPiFuture`
+        immediately after sending the :ref:`protocol_capture` command. With a
+        *delay*, the future's result is the :class:`CompoundPiSkew` that
+        :meth:`capture` would return (any stale clock estimates are refreshed
+        by :meth:`sync` before the command is sent); otherwise it is ``None``.
+        """
+        if not delay:
+            future = self._transact_async(
+                'CAPTURE %d %d' % (count, video_port), addresses)
+            future._parse = lambda responses: None
+            return future
+        return self._synchronized(
+            'CAPTURE %d %d %%f' % (count, video_port), delay, addresses)
+
+    def record(
+            self, segment=10.0, bitrate=17000000, delay=None, addresses=None):
+        """
+        Called to start recording H.264 video on the servers at the specified
+        *addresses* (or all defined servers if *addresses* is omitted) at the
+        specified *bitrate* (default 17000000 bits per second). Each server
+        stores its recording as a series of segments approximately *segment*
+        seconds long (default 10), each of which is listed by :meth:`list`
+        (with a :attr:`~CompoundPiImage.format` of ``'h264'``) and can be
+        downloaded like an image once complete. Hence a long recording can be
+        retrieved while it is still being recorded. Call :meth:`stop` to end
+        the recording.
+
+        The optional *delay* parameter synchronizes the start of the
+        recordings as described for :meth:`capture`, in which case the method
+        returns a :class:`CompoundPiSkew` mapping. While a server is
+        recording, its camera's resolution and framerate cannot be changed,
+        and :meth:`capture` cannot be used. For example::
+
+            import time
+            from compoundpi.client import CompoundPiClient
+
+            client = CompoundPiClient()
+            client.network = '192.168.0.0/24'
+            client.find(10)
+            client.record(segment=5, delay=0.5)
+            time.sleep(60)
+            client.stop()
+        """
+        if not delay:
+            return self._command(
+                'RECORD %f %d' % (segment, bitrate), addresses)
+        return self._deliver(self._synchronized(
+            'RECORD %f %d %%f' % (segment, bitrate), delay, addresses))
+
+    def stop(self, addresses=None):
+        """
+        Called to stop the recordings started by :meth:`record` on the
+        servers at the specified *addresses* (or all defined servers if
+        *addresses* is omitted), completing their final segments. Stopping a
+        server which is not recording has no effect.
+        """
+        return self._command('STOP', addresses)
+
+    def _synchronized(self, command, delay, addresses=None):
+        # Send *command* (which must contain a %f placeholder for the target
+        # time) to the servers at *addresses*, targetting *delay* seconds from
+        # now translated to each server's clock (unless sync_interval is 0).
+        # The returned future's result is a CompoundPiSkew built from the
+        # servers' responses (which must report the time they acted)
+        if addresses is None:
+            if not self._servers:
+                raise CompoundPiNoServers()
+            addresses = self._servers
+        addresses = set(addresses)
+        if self.sync_interval:
+            now = time.time()
+            stale = {
+                address for address in addresses
+                if address not in self._clocks
+                or now - self._clocks[address].updated > self.sync_interval
+                }
+            if stale:
+                self.sync(stale)
+            offsets = {
+                address: self._clocks[address].offset
+                for address in addresses
+                }
+            target = time.time() + delay
+            future = self._transact_each_async({
+                address: command % (target + offsets[address])
+                for address in addresses
+                })
+        else:
+            offsets = {address: 0.0 for address in addresses}
+            target = time.time() + delay
+            future = self._transact_async(command % target, addresses)
+        return self._skew(future, target, offsets)
+
+    def _skew(self, future, target, offsets):
+        def parse(responses):
+            skew = CompoundPiSkew(future.sent if target is None else target)
+            for address, response in responses.items():
+                match = self.capture_re.match(response)
+                if match:
+                    skew[address] = (
+                        float(match.group('time')) - offsets[address] -
+                        skew.target)
+            return skew
+        future._parse = parse
+        return future
+
+    def _deliver(self, future):
+        # Within a pipeline block *future* is returned immediately, otherwise
+        # the client waits for it and returns its result
+        if self._pipeline is not None:
+            self._pipeline.append(future)
+            return future
+        return self._wait(future, progress=True).result()
+
+    def arm(self, frames=3, addresses=None):
+        """
+        Called to arm the cameras of the servers at the specified *addresses*
+        (or all defined servers if *addresses* is omitted). Armed cameras
+        capture continuously from their video port, retaining the last
+        *frames* (default 3) frames, so that :meth:`trigger` can take an image
+        without waiting for the camera to start capturing. This reduces the
+        latency of a capture from the time taken to switch the camera's mode
+        and settle its gains (often hundreds of milliseconds) to a frame
+        interval or so.
+
+        While armed, the camera's resolution and framerate cannot be changed,
+        and :meth:`capture` cannot be used; call :meth:`disarm` first. Arming
+        an armed camera restarts its capture.
+        """
+        return self._command('ARM %d' % frames, addresses)
+
+    def disarm(self, addresses=None):
+        """
+        Called to stop the continuous capture started by :meth:`arm` on the
+        servers at the specified *addresses* (or all defined servers if
+        *addresses* is omitted). Disarming a camera which is not armed has no
+        effect.
+        """
+        return self._command('DISARM', addresses)
+
+    def trigger(self, delay=None, addresses=None):
+        """
+        Called to take an image with the armed cameras (see :meth:`arm`) of
+        the servers at the specified *addresses* (or all defined servers if
+        *addresses* is omitted). Each server stores the buffered frame closest
+        to the time it received the command, or if *delay* is specified, the
+        frame closest to *now* + *delay* seconds (translated to each server's
+        clock as described for :meth:`capture`).
+
+        The method returns a :class:`CompoundPiSkew` mapping detailing the
+        difference between the time of each server's frame and the target
+        time. Without a *delay*, the target is the time at which the command
+        was sent, so the mapping gives the latency of each server. Within a
+        :meth:`pipeline` block, the method returns a :class:`CompoundPiFuture`
+        instead. For example::
+
+            from compoundpi.client import CompoundPiClient
+
+            client = CompoundPiClient()
+            client.network = '192.168.0.0/24'
+            client.find(10)
+            client.arm()
+            latency = client.trigger()
+            print('Worst latency %.3fms' % (max(latency.values()) * 1000))
+            client.disarm()
+        """
         if delay:
-            cmd += ' %f'
-            params.append(time.time() + delay)
-        self._transact(cmd % tuple(params), addresses)
+            return self._deliver(
+                self._synchronized('TRIGGER %f', delay, addresses))
+        future = self._transact_async('TRIGGER', addresses)
+        offsets = {
+            address: self._clocks[address].offset
+            if address in self._clocks else 0.0
+            for address in future.servers
+            }
+        return self._deliver(self._skew(future, None, offsets))
+
+    def preview(
+            self, resolution=(320, 240), framerate=5, bitrate=1000000,
+            quality=50, addresses=None):
+        """
+        Called to start a live preview from the cameras of the servers at the
+        specified *addresses* (or all defined servers if *addresses* is
+        omitted). Each server streams MJPEG frames of the specified
+        *resolution* (default 320x240) from its camera's video port to the
+        client, at no more than *framerate* (default 5) frames per second.
+
+        The *bitrate* parameter (default 1000000) caps the bits per second of
+        each preview, and *quality* (default 50) specifies its JPEG quality.
+        If the previews open would together exceed :attr:`preview_bandwidth`
+        the cap of each is reduced to its share of that bandwidth, and its
+        quality is reduced in proportion. Previews already open are restarted
+        with the new settings when these change; all open previews share the
+        same settings.
+
+        The method returns a mapping of address to :class:`CompoundPiPreview`
+        instances for all open previews; the ``frame`` attribute of each is
+        updated as frames are received. While a server's camera is
+        previewing, its resolution and framerate cannot be changed and
+        :meth:`capture` cannot be used; call :meth:`unpreview` first. For
+        example::
+
+            import time
+            from compoundpi.client import CompoundPiClient
+
+            client = CompoundPiClient()
+            client.network = '192.168.0.0/24'
+            client.find(10)
+            previews = client.preview()
+            time.sleep(5)
+            for address, preview in previews.items():
+                print('%s: %.1ffps' % (address, preview.frames / 5))
+            client.unpreview()
+        """
+        if addresses is None:
+            if not self._servers:
+                raise CompoundPiNoServers()
+            addresses = self._servers
+        elif set(addresses) - self._servers:
+            raise CompoundPiUndefinedServers(set(addresses) - self._servers)
+        addresses = set(addresses) - set(self._previews)
+        for address in addresses:
+            self._previews[address] = CompoundPiPreview(address)
+        try:
+            self._start_previews(
+                Resolution(*resolution), framerate, bitrate, quality,
+                addresses)
+        except:
+            for address in addresses:
+                self._previews.pop(address, None)
+            raise
+        return self._previews.copy()
+
+    def unpreview(self, addresses=None):
+        """
+        Called to stop the live previews (see :meth:`preview`) of the servers
+        at the specified *addresses* (or all open previews if *addresses* is
+        omitted). If this leaves a larger share of :attr:`preview_bandwidth`
+        for the remaining previews, they are restarted to take advantage of
+        it. Stopping a preview which is not open has no effect.
+        """
+        if addresses is None:
+            addresses = set(self._previews)
+        addresses = set(addresses) & set(self._previews)
+        if addresses:
+            for address in addresses:
+                del self._previews[address]
+            self._command('PREVIEW STOP', addresses)
+            if self._previews:
+                self._start_previews(*self._preview_settings)
+
+    def _start_previews(self, resolution, framerate, bitrate, quality, new=()):
+        # Start the previews of the *new* addresses; if the share of the
+        # bandwidth (or the settings) have changed, all open previews are
+        # (re)started
+        self._preview_settings = (resolution, framerate, bitrate, quality)
+        share = min(bitrate, self.preview_bandwidth // len(self._previews))
+        if share < bitrate:
+            quality = max(10, quality * share // bitrate)
+        if self._preview_server is None:
+            self._preview_server = CompoundPiPreviewServer(
+                (self.bind[0], 0), CompoundPiPreviewHandler)
+            self._preview_server.previews = self._previews
+            thread = threading.Thread(
+                target=self._preview_server.serve_forever)
+            thread.daemon = True
+            thread.start()
+        command = 'PREVIEW START %d %d %d %f %d %d' % (
+            self._preview_server.socket.getsockname()[1],
+            resolution.width, resolution.height, framerate, share, quality)
+        if command != self._preview_command:
+            new = set(self._previews)
+        if new:
+            # Should any server fail to start, the next call restarts all
+            self._preview_command = None
+            self._command(command, new)
+        self._preview_command = command
 
     list_line_re = re.compile(
-            r'IMAGE (?P<index>\d+) (?P<time>\d+(\.\d+)?) (?P<size>\d+)')
+            r'IMAGE (?P<index>\d+) (?P<time>\d+(\.\d+)?) (?P<size>\d+)'
+            r'(?P<attrs>( [a-z0-9_]+=[^ ]+)*)$')
     def list(self, addresses=None):
         """
         Called to list images available for download from the servers at the
@@ -1001,12 +2328,25 @@ class CompoundPiClient(object):
                 )
             print('%d bytes available for download' % size)
         """
+        return self._wait(self.list_async(addresses), progress=True).result()
+
+    def list_async(self, addresses=None):
+        """
+        Variant of :meth:`list` which returns a :class:`CompoundPiFuture`
+        immediately after sending the :ref:`protocol_list` command. The
+        future's result is the mapping that :meth:`list` would return.
+        """
+        future = self._transact_async('LIST', addresses)
+        future._parse = self._parse_list
+        return future
+
+    def _parse_list(self, responses):
         responses = {
             address: [
                 self.list_line_re.match(line)
                 for line in data.splitlines()
                 ]
-            for (address, data) in self._transact('LIST', addresses).items()
+            for (address, data) in responses.items()
             }
         errors = []
         result = {}
@@ -1016,25 +2356,70 @@ class CompoundPiClient(object):
                 if match is None:
                     errors.append(CompoundPiInvalidResponse(address))
                 else:
-                    result[address].append(CompoundPiImage(
-                        int(match.group('index')),
-                        datetime.datetime.fromtimestamp(float(match.group('time'))),
-                        int(match.group('size')),
-                        ))
+                    # Attributes the client doesn't recognize are ignored
+                    attrs = dict(
+                        attr.split('=', 1)
+                        for attr in match.group('attrs').split()
+                        )
+                    try:
+                        result[address].append(CompoundPiImage(
+                            int(match.group('index')),
+                            datetime.datetime.fromtimestamp(
+                                float(match.group('time'))),
+                            int(match.group('size')),
+                            datetime.datetime.fromtimestamp(
+                                float(attrs['trigger']))
+                            if 'trigger' in attrs else None,
+                            attrs.get('format', 'jpeg'),
+                            float(attrs['duration'])
+                            if 'duration' in attrs else None,
+                            int(attrs['crc32'], 16)
+                            if 'crc32' in attrs else None,
+                            ))
+                    except ValueError:
+                        errors.append(CompoundPiInvalidResponse(address))
         if errors:
             raise CompoundPiTransactionFailed(
                 errors, '%d invalid lines in responses' % len(errors))
         return result
 
-    def clear(self, addresses=None):
+    def clear(self, addresses=None, indexes=None):
         """
         Called to clear captured images from the RAM of the servers at the
         specified *addresses* (or all defined servers if *addresses* is
-        omitted). Currently the protocol for the :ref:`protocol_clear` message
-        is fairly crude: it simply clears all captured images on the server;
-        there is no method for specifying a subset of images to wipe.
+        omitted). If *indexes* is specified, only the images with those
+        indexes (a sequence of integers) are cleared from each server;
+        otherwise all images are cleared. As image indexes differ between
+        servers, selective clearing is typically applied to one server at a
+        time. For example, to clear only the images listed by a server::
+
+            for addr, images in client.list().items():
+                client.clear([addr], [image.index for image in images])
+
+        Note that the :meth:`download` and :meth:`download_many` methods can
+        also clear images as they are retrieved.
         """
-        self._transact('CLEAR', addresses)
+        if indexes is None:
+            return self._command('CLEAR', addresses)
+        return self._command(
+            'CLEAR %s' % self._format_indexes(indexes), addresses)
+
+    def _format_indexes(self, indexes):
+        # Formats a sequence of indexes as a comma-separated list in which
+        # runs of consecutive indexes are abbreviated to ranges, keeping the
+        # command within a single datagram
+        ranges = []
+        for index in sorted(set(indexes)):
+            if ranges and ranges[-1][1] == index - 1:
+                ranges[-1][1] = index
+            else:
+                ranges.append([index, index])
+        if not ranges:
+            raise ValueError('No image indexes specified')
+        return ','.join(
+            '%d' % start if start == finish else '%d-%d' % (start, finish)
+            for start, finish in ranges
+            )
 
     def identify(self, addresses=None):
         """
@@ -1043,22 +2428,22 @@ class CompoundPiClient(object):
         Currently, the identification takes the form of the server blinking
         the camera's LED for 5 seconds.
         """
-        self._transact('BLINK', addresses)
+        return self._command('BLINK', addresses)
 
-    def download(self, address, index, output):
+    def download(self, address, index, output, resume=False, clear=False):
         """
         Called to download the image with the specified *index* from the server
         at *address*, writing the content to the file-like object provided by
         the *output* parameter.
 
         The :meth:`download` method differs from all other client methods in
-        that it targets a single server at a time (attempting to simultaneously
-        download images from multiple servers would be extremely inefficient).
-        The available image indices can be determined by calling the
-        :meth:`list` method beforehand. Note that downloading images from
-        servers does *not* wipe the image from the server's RAM. Once all
-        images have been successfully retrieved, you should use the
-        :meth:`clear` method to free up memory on the servers. For example::
+        that it targets a single server at a time (see :meth:`download_many`
+        for retrieving images from several servers simultaneously).  The
+        available image indices can be determined by calling the :meth:`list`
+        method beforehand. Note that downloading images from servers does
+        *not* wipe the image from the server's RAM. Once all images have been
+        successfully retrieved, you should use the :meth:`clear` method to
+        free up memory on the servers. For example::
 
             import io
             from compoundpi.client import CompoundPiClient
@@ -1079,66 +2464,937 @@ class CompoundPiClient(object):
                         client.download(addr, image.index, f)
             # Wipe all images on all servers
             client.clear()
+
+        If *resume* is ``True``, *output* is assumed to hold the beginning of
+        the image from a previous, failed, download. The remainder of the
+        image is requested from the server (from the offset given by the size
+        of *output*) and appended to *output*, which must be seekable.
+
+        Each transfer ends with a checksum of the data sent; if the data
+        received does not match, it is truncated from *output* (which must be
+        seekable) and :exc:`CompoundPiChecksumError` is raised.
+
+        If *clear* is ``True``, the client confirms receipt of the image to
+        the server once its checksum has been verified, and the server wipes
+        the image from its RAM immediately, avoiding the need to call
+        :meth:`clear` afterward. A transfer which fails leaves the image on
+        the server.
+
+        The method returns a :class:`CompoundPiDownload` instance describing
+        the completed transfer.
         """
-        self._server.source = address
-        self._server.output = output
-        self._server.event.clear()
+        if not isinstance(address, IPv4Address):
+            address = IPv4Address(address)
         # As download is a long operation that always targets a single server,
         # we re-purpose progress notifications from counting server responses
         # to counting bytes received
+        transfer = CompoundPiTransfer(address, index, output, progress=(
+                self._progress_start,
+                self._progress_update,
+                self._progress_finish,
+                ), resume=resume, clear=clear)
+        results, errors = self._download_batch([transfer])
+        if errors:
+            raise CompoundPiTransactionFailed(errors)
+        return results[0]
+
+    def download_async(
+            self, address, index, output, resume=False, clear=False):
+        """
+        Variant of :meth:`download` which returns a :class:`CompoundPiFuture`
+        immediately after sending the :ref:`protocol_send` command. The future
+        completes when the server reports the transfer has been sent, and its
+        result is the :class:`CompoundPiDownload` that :meth:`download` would
+        return (waiting, if necessary, for the last of the data to be
+        written to *output*). Progress is not reported for such downloads.
+        """
+        if not isinstance(address, IPv4Address):
+            address = IPv4Address(address)
+        transfer = CompoundPiTransfer(
+            address, index, output, resume=resume, clear=clear)
+        key = (address, index)
+        port = self._data_port(address)
+        self._transfers[key] = transfer
+        try:
+            transfer.open()
+            future = self._transact_each_async({
+                address: 'SEND %d %d %d 0 %d' % (
+                    index, port, transfer.offset, clear)})
+        except:
+            self._transfers.pop(key, None)
+            transfer.close()
+            raise
+        def finish(future):
+            if future.errors:
+                self._transfers.pop(key, None)
+                transfer.close()
+        def parse(responses):
+            try:
+                if not transfer.event.wait(self.timeout):
+                    raise CompoundPiTransactionFailed(
+                        [CompoundPiSendTimeout(address)])
+                if transfer.exception:
+                    raise CompoundPiTransactionFailed([transfer.exception])
+                return transfer.result()
+            finally:
+                self._transfers.pop(key, None)
+                transfer.close()
+        future.add_done_callback(finish)
+        future._parse = parse
+        return future
+
+    def download_many(
+            self, downloads, concurrency=8, resume=False, clear=False):
+        """
+        Called to download many images from several servers simultaneously.
+        The *downloads* parameter is a mapping of server address to a sequence
+        of ``(index, output)`` tuples, where *index* is the index of an image
+        on the server and *output* is either a file-like object to write the
+        image to, or a callable (taking no parameters) which returns such an
+        object. In the latter case, the callable is only called when the
+        transfer is about to begin, and the object it returns is closed when
+        the transfer ends. This permits, for example, files to be opened for
+        writing only while their content is being received.
+
+        The optional *concurrency* parameter specifies the maximum number of
+        servers that will be transferring images at any one time. Each server
+        streams all its requested images, one after another, over a single
+        connection (see :ref:`protocol_sendall`), avoiding the cost of
+        setting up a transfer for each image. For example::
+
+            import io
+            from functools import partial
+            from compoundpi.client import CompoundPiClient
+
+            client = CompoundPiClient()
+            client.network = '192.168.0.0/24'
+            client.find(10)
+            client.capture()
+            results = client.download_many({
+                addr: [
+                    (image.index, partial(
+                        io.open, '%s-%d.jpg' % (addr, image.index), 'wb'))
+                    for image in images
+                    ]
+                for addr, images in client.list().items()
+                })
+            print('Downloaded %d bytes at %.1fMB/s' % (
+                results.size, results.rate / 1000000))
+
+        If *resume* is ``True``, each output is assumed to hold the beginning
+        of its image from a previous download, which is resumed as described
+        for :meth:`download` (a callable should open its file for appending in
+        this case). As resumed images must each be requested individually,
+        servers instead take turns to transfer one image at a time. If *clear*
+        is ``True``, each image is wiped from its server as soon as it has been
+        successfully received, as described for :meth:`download`, so that
+        servers' RAM is released as the downloads progress.
+
+        The method returns a :class:`CompoundPiDownloads` mapping of
+        ``(address, index)`` tuples to :class:`CompoundPiDownload` instances.
+        If any transfers fail, the remaining transfers are still attempted
+        before a :exc:`CompoundPiTransactionFailed` exception is raised
+        detailing all errors encountered.
+        """
+        queues = collections.OrderedDict(
+            (
+                address if isinstance(address, IPv4Address) else
+                IPv4Address(address),
+                collections.deque(items),
+                )
+            for (address, items) in downloads.items()
+            if items
+            )
+        total = sum(len(queue) for queue in queues.values())
+        results = CompoundPiDownloads()
+        errors = []
+        if self._progress_start:
+            self._progress_start(total)
+        try:
+            while queues:
+                # Take the next image from each of the first *concurrency*
+                # servers, then rotate those servers to the end of the queue
+                batch = []
+                for address in list(queues)[:concurrency]:
+                    queue = queues.pop(address)
+                    while queue:
+                        index, output = queue.popleft()
+                        batch.append(CompoundPiTransfer(
+                            address, index, output, resume=resume,
+                            clear=clear))
+                        if resume:
+                            break
+                    if queue:
+                        queues[address] = queue
+                batch_results, batch_errors = self._download_batch(batch)
+                for result in batch_results:
+                    results[(result.address, result.index)] = result
+                errors.extend(batch_errors)
+                if self._progress_update:
+                    self._progress_update(len(results) + len(errors))
+        finally:
+            if self._progress_finish:
+                self._progress_finish()
+        if errors:
+            raise CompoundPiTransactionFailed(errors)
+        return results
+
+    def _download_batch(self, transfers):
+        # Request each transfer in a single transaction, and wait for them all
+        # to complete. A server with a single transfer is sent SEND; a server
+        # with several is sent SENDALL, and each of its transfers is opened as
+        # its data arrives. Progress notifications of the transaction are
+        # suppressed as download methods report their own progress
         progress = (
                 self._progress_start,
                 self._progress_update,
                 self._progress_finish,
                 )
         self._progress_start = self._progress_update = self._progress_finish = None
+        results = []
+        groups = collections.OrderedDict()
+        for transfer in transfers:
+            groups.setdefault(transfer.address, []).append(transfer)
         try:
-            self._transact('SEND %d %d' % (index, self.port), [address])
-            if not self._server.event.wait(self.timeout):
-                raise CompoundPiSendTimeout(address)
-            elif self._server.exception:
-                raise self._server.exception
+            commands = {}
+            errors = []
+            for address, group in groups.items():
+                try:
+                    port = self._data_port(address)
+                except CompoundPiServerError as e:
+                    errors.append(e)
+                    continue
+                for transfer in group:
+                    self._transfers[
+                        (transfer.address, transfer.index)] = transfer
+                if len(group) == 1:
+                    transfer = group[0]
+                    transfer.open()
+                    commands[address] = 'SEND %d %d %d 0 %d' % (
+                        transfer.index, port, transfer.offset,
+                        transfer.clear)
+                else:
+                    commands[address] = 'SENDALL %d %s %d' % (
+                        port,
+                        self._format_indexes(t.index for t in group),
+                        group[0].clear)
+            if commands:
+                responses, command_errors = self._transact_each(commands)
+                errors.extend(command_errors)
+            failed = {error.address for error in errors}
+            for transfer in transfers:
+                # Images streamed before a server failed part way through a
+                # SENDALL are still reported
+                if transfer.address in failed and not transfer.event.is_set():
+                    continue
+                elif not transfer.event.wait(self.timeout):
+                    errors.append(CompoundPiSendTimeout(transfer.address))
+                elif transfer.exception:
+                    errors.append(transfer.exception)
+                else:
+                    results.append(transfer.result())
+            return results, errors
         finally:
-            self._server.source = None
-            self._server.output = None
-            self._server.exception = None
+            for transfer in transfers:
+                self._transfers.pop(
+                    (transfer.address, transfer.index), None)
+                transfer.close()
             (
                 self._progress_start,
                 self._progress_update,
                 self._progress_finish,
                 ) = progress
 
+    def _data_port(self, address):
+        # Returns the port the server at *address* should send images to; with
+        # data channels, port 0 requests that the server sends over the
+        # channel (which is opened if necessary)
+        if not self.data_channels:
+            return self.bind[1]
+        try:
+            self._open_channel(address)
+        except socket.error as e:
+            raise CompoundPiServerError(
+                address, 'unable to open data channel: %s' % e)
+        return 0
+
+    def _open_channel(self, address):
+        # Ensure a data channel to the server at *address* is open, replacing
+        # any which has failed
+        channel = self._channels.get(address)
+        if channel is None or not channel.is_alive():
+            self._channels[address] = CompoundPiChannel(
+                address, self.port, self._transfers, self.timeout)
+
+
+class AsyncCompoundPiClient(CompoundPiClient):
+    """
+    Variant of :class:`CompoundPiClient` which reads responses in the
+    background.
+
+    A :class:`CompoundPiClient` only reads responses from the network while
+    one of its methods is waiting for a command to complete, hence the
+    futures returned by its ``_async`` methods
+    (:meth:`~CompoundPiClient.find_async`,
+    :meth:`~CompoundPiClient.status_async`,
+    :meth:`~CompoundPiClient.capture_async`,
+    :meth:`~CompoundPiClient.list_async`,
+    :meth:`~CompoundPiClient.download_async`) only progress when their
+    :meth:`~CompoundPiFuture.result` is requested. This class starts a
+    background thread which reads responses as they arrive, resolving futures
+    and calling any callbacks registered with
+    :meth:`~CompoundPiFuture.add_done_callback` without anything waiting upon
+    them. This permits the client to be driven by an event loop; for
+    example::
+
+        from compoundpi.client import AsyncCompoundPiClient
+
+        def report(future):
+            for address, status in future.result().items():
+                print('%s: %d images' % (address, status.images))
+
+        client = AsyncCompoundPiClient()
+        client.network = '192.168.0.0/24'
+        client.find(10)
+        client.status_async().add_done_callback(report)
+
+    The synchronous methods inherited from :class:`CompoundPiClient` simply
+    wait for the futures resolved by the background thread, and may be used
+    from any thread other than that one (i.e. not from callbacks). Call
+    :meth:`close` (or use the client as a context manager) to terminate the
+    background thread when the client is no longer required.
+    """
 
-class CompoundPiDownloadHandler(socketserver.StreamRequestHandler):
-    def handle(self):
-        if self.client_address[0] != str(self.server.source):
-            warnings.warn(CompoundPiUnknownAddress(self.client_address[0]))
+    def __init__(self, progress=None):
+        self._wakeup = os.pipe()
+        self._woken = False
+        self._closed = False
+        super(AsyncCompoundPiClient, self).__init__(progress)
+        self._changed = threading.Condition(self._lock)
+        if self._poller is not None:
+            self._poller.register(self._wakeup[0], select.EPOLLIN)
+        self._reactor = threading.Thread(target=self._run)
+        self._reactor.daemon = True
+        self._reactor.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Terminates the background thread. Any outstanding commands are
+        completed immediately (their futures reporting missing responses).
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            os.write(self._wakeup[1], b'\0')
+        self._reactor.join()
+        with self._lock:
+            for future in list(self._pending.values()):
+                future._complete()
+            self._changed.notify_all()
+        if self._poller is not None:
+            self._poller.unregister(self._wakeup[0])
+        for fd in self._wakeup:
+            os.close(fd)
+
+    def _start(self, *args, **kwargs):
+        with self._lock:
+            future = super(AsyncCompoundPiClient, self)._start(*args, **kwargs)
+        # The background thread may be waiting for a later deadline than the
+        # new future's
+        self._wake()
+        return future
+
+    def _wait(self, future, progress=False):
+        # Wait for the background thread to resolve *future*
+        if progress and self._progress_start:
+            self._progress_start(future.count)
+        try:
+            while True:
+                with self._lock:
+                    if not future.done():
+                        if threading.current_thread() is self._reactor:
+                            raise RuntimeError(
+                                'Cannot wait for a command within a callback')
+                        elif self._closed:
+                            future._complete()
+                        else:
+                            self._changed.wait()
+                    done = future.done()
+                    received = len(future.raw)
+                if progress and self._progress_update:
+                    self._progress_update(received)
+                if done:
+                    self._returned(future)
+                    return future
+        finally:
+            if progress and self._progress_finish:
+                self._progress_finish()
+
+    def _wake(self):
+        with self._lock:
+            if not (self._woken or self._closed):
+                self._woken = True
+                os.write(self._wakeup[1], b'\0')
+
+    def _polled(self):
+        return [self._socket.fileno(), self._wakeup[0]]
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._closed:
+                    return
+                now = time.time()
+                self._expire(now)
+                self._changed.notify_all()
+                if self._pending:
+                    timeout = min(
+                        future.expiry() for future in self._pending.values()
+                        ) - now
+                else:
+                    timeout = None
+            ready = self._poll(timeout)
+            with self._lock:
+                if self._wakeup[0] in ready:
+                    os.read(self._wakeup[0], 1)
+                    self._woken = False
+                if self._socket.fileno() in ready:
+                    try:
+                        self._drain()
+                    except (socket.error, ValueError) as e:
+                        logging.warning('Failed to read response: %s', e)
+
+
+class CompoundPiTransfer(object):
+    """
+    Tracks the state of a single image transfer from the server at *address*.
+    The *index* parameter specifies the index of the image on the server, and
+    *output* is either a file-like object to write the image to, or a callable
+    returning such an object (which will be closed when the transfer ends).
+    The optional *progress* parameter is a ``(start, update, finish)`` tuple
+    of routines which will be called to report the number of bytes received.
+    If *resume* is ``True``, the transfer begins from the offset given by the
+    size of the output (which must be seekable) rather than the start of the
+    image. If *clear* is ``True``, receipt of the image is confirmed to the
+    server (which then wipes it) once its checksum is verified.
+
+    Data is received directly into a pre-allocated buffer which is written to
+    the output whenever it fills. Progress updates are throttled so that they
+    occur at most every :attr:`progress_interval` seconds, or whenever a
+    further :attr:`progress_fraction` of the image has been received.
+    """
+
+    block_size = 1024 * 1024
+    progress_interval = 0.1
+    progress_fraction = 0.05
+
+    def __init__(
+            self, address, index, output, progress=None, resume=False,
+            clear=False):
+        self.address = address
+        self.index = index
+        self.resume = resume
+        self.clear = clear
+        self.offset = 0
+        self.size = None
+        self.checksum = None
+        self.event = threading.Event()
+        self.exception = None
+        self.received = 0
+        self.started = None
+        self.first_byte = None
+        self.finished = None
+        if callable(output):
+            self.factory = output
+            self.output = None
+        else:
+            self.factory = None
+            self.output = output
+        if progress is None:
+            progress = (None, None, None)
+        self.progress_start, self.progress_update, self.progress_finish = progress
+
+    def open(self):
+        self.started = time.time()
+        if self.factory:
+            self.output = self.factory()
+        if self.resume:
+            self.output.seek(0, io.SEEK_END)
+            self.offset = self.output.tell()
+
+    def close(self):
+        if self.factory and self.output:
+            self.output.close()
+
+    def receive(self, sock, size, offset, length):
+        # Receive *length* bytes of the image (which is *size* bytes in total)
+        # from *offset*, followed by the checksum of those bytes
+        if self.progress_start:
+            self.progress_start(length)
+        try:
+            # Transfers requested with SENDALL are opened as they arrive
+            if self.started is None:
+                self.open()
+            if offset != self.offset:
+                raise CompoundPiInvalidResponse(self.address)
+            self.size = size
+            # The checksum is calculated as each block is written so that
+            # verifying it requires no further pass over the data
+            checksum = 0
+            buf = bytearray(max(1, min(length, self.block_size)))
+            view = memoryview(buf)
+            reported_bytes = 0
+            reported_time = time.time()
+            progress_bytes = max(1, int(length * self.progress_fraction))
+            while self.received < length:
+                # Fill the buffer (or as much of it as the remainder of the
+                # range requires) before writing it to the output
+                block = min(len(buf), length - self.received)
+                filled = 0
+                while filled < block:
+                    read = sock.recv_into(view[filled:block])
+                    if not read:
+                        raise CompoundPiServerError(
+                            self.address, 'incomplete transfer of image %d '
+                            '(%d of %d bytes)' % (
+                                self.index, self.received + filled, length))
+                    if self.first_byte is None:
+                        self.first_byte = time.time()
+                    filled += read
+                    if self.progress_update:
+                        now = time.time()
+                        if (
+                                now - reported_time >= self.progress_interval or
+                                self.received + filled - reported_bytes >= progress_bytes):
+                            reported_bytes = self.received + filled
+                            reported_time = now
+                            self.progress_update(reported_bytes)
+                self.output.write(view[:block])
+                checksum = zlib.crc32(buffer(buf, 0, block), checksum)
+                self.received += block
+            if self.progress_update and reported_bytes < self.received:
+                self.progress_update(self.received)
+            trailer = bytearray(SEND_TRAILER.size)
+            view = memoryview(trailer)
+            filled = 0
+            while filled < len(trailer):
+                read = sock.recv_into(view[filled:])
+                if not read:
+                    raise CompoundPiServerError(
+                        self.address, 'missing checksum for image %d' %
+                        self.index)
+                filled += read
+            if SEND_TRAILER.unpack(bytes(trailer))[0] != checksum & 0xFFFFFFFF:
+                # Discard the corrupt data so that a resumed transfer doesn't
+                # build upon it. If the server is awaiting confirmation of
+                # receipt, the mismatched checksum tells it to keep the image
+                self.output.seek(self.offset)
+                self.output.truncate()
+                if self.clear:
+                    sock.sendall(SEND_TRAILER.pack(checksum & 0xFFFFFFFF))
+                raise CompoundPiChecksumError(self.address, self.index)
+            self.checksum = checksum & 0xFFFFFFFF
+            if self.clear:
+                sock.sendall(SEND_TRAILER.pack(self.checksum))
+        except Exception as e:
+            self.exception = e
         else:
-            size, = struct.unpack(
-                native_str('>L'),
-                self.rfile.read(struct.calcsize(native_str('>L'))))
-            if self.server.progress_start:
-                self.server.progress_start(size)
+            self.exception = None
+        finally:
+            self.finished = time.time()
+            if self.progress_finish:
+                self.progress_finish()
+            self.event.set()
+
+    def result(self):
+        return CompoundPiDownload(
+            self.address, self.index, self.received,
+            self.started, self.first_byte, self.finished, self.offset,
+            self.checksum)
+
+
+class CompoundPiWriterPool(object):
+    """
+    Writes downloaded images to disk from a pool of background threads so that
+    receiving images from the network is not held up by slow storage.
+
+    Files opened with :meth:`open` return a file-like object suitable as an
+    output for :meth:`CompoundPiClient.download_many`. Data written to it is
+    queued for one of *threads* background writers (all writes to a given
+    file are handled by the same writer, preserving their order). Each
+    writer's queue holds at most *queue_size* writes; when it is full, the
+    thread writing (i.e. the one receiving the image) blocks until the writer
+    catches up. Files closed by the caller are flushed to the storage device
+    (with :func:`os.fsync`) in batches: when *sync_files* files are awaiting
+    it, when the writer's queue empties, or when the pool is closed.
+
+    Call :meth:`close` to wait for all queued writes to complete, which raises
+    the first error encountered by any writer. The :attr:`written` attribute
+    gives the number of bytes written by the pool. The pool can also be used
+    as a context manager. For example::
+
+        import io
+        from compoundpi.client import CompoundPiClient, CompoundPiWriterPool
+
+        client = CompoundPiClient()
+        client.network = '192.168.0.0/24'
+        client.find(10)
+        client.capture()
+        with CompoundPiWriterPool() as pool:
+            client.download_many({
+                addr: [
+                    (image.index, pool.open('%s-%d.jpg' % (addr, image.index)))
+                    for image in images
+                    ]
+                for addr, images in client.list().items()
+                })
+    """
+
+    def __init__(self, threads=2, queue_size=8, sync_files=16):
+        self.sync_files = sync_files
+        self.errors = []
+        self._lock = threading.Lock()
+        self._writers = [
+            CompoundPiWriter(self, queue_size) for i in range(threads)]
+        self._next = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    @property
+    def written(self):
+        return sum(writer.written for writer in self._writers)
+
+    def open(self, filename, mode='wb'):
+        """
+        Opens *filename* with the specified *mode* (which must be a binary
+        writing mode) and returns a file-like object which writes to it in
+        the background.
+        """
+        with self._lock:
+            writer = self._writers[self._next]
+            self._next = (self._next + 1) % len(self._writers)
+        return CompoundPiWriterFile(writer, io.open(filename, mode))
+
+    def close(self):
+        """
+        Waits for all queued writes to complete and all files to be synced
+        and closed, then raises the first error encountered, if any.
+        """
+        for writer in self._writers:
+            writer.close()
+        if self.errors:
+            raise self.errors[0]
+
+
+class CompoundPiWriter(threading.Thread):
+    """
+    Background thread of a :class:`CompoundPiWriterPool` which executes the
+    writes queued by the :class:`CompoundPiWriterFile` instances assigned to
+    it.
+    """
+
+    def __init__(self, pool, queue_size):
+        super(CompoundPiWriter, self).__init__()
+        self.daemon = True
+        self.pool = pool
+        self.queue = queue.Queue(queue_size)
+        self.written = 0
+        self._unsynced = []
+        self.start()
+
+    def submit(self, output, op, data=None):
+        self.queue.put((output, op, data))
+
+    def close(self):
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            output, op, data = item
             try:
-                received = 0
-                while received < size:
-                    data = self.rfile.read(1024)
-                    received += len(data)
-                    if not data:
-                        break
-                    self.server.output.write(data)
-                    if self.server.progress_update:
-                        self.server.progress_update(received)
+                if op == 'sync':
+                    data.set()
+                elif output.error is None:
+                    if op == 'write':
+                        output.file.write(data)
+                        self.written += len(data)
+                    elif op == 'close':
+                        self._unsynced.append(output)
             except Exception as e:
-                self.server.exception = e
-            else:
-                self.server.exception = None
+                self._fail(output, e)
+            if op == 'close' and output.error is not None:
+                output.file.close()
+            if self._unsynced and (
+                    len(self._unsynced) >= self.pool.sync_files or
+                    self.queue.empty()):
+                self._sync()
+        self._sync()
+
+    def _sync(self):
+        # Flush, sync, and close all files the caller has closed
+        for output in self._unsynced:
+            try:
+                output.file.flush()
+                os.fsync(output.file.fileno())
+            except Exception as e:
+                self._fail(output, e)
             finally:
-                if self.server.progress_finish:
-                    self.server.progress_finish()
-                self.server.event.set()
+                output.file.close()
+        self._unsynced = []
+
+    def _fail(self, output, e):
+        output.error = e
+        self.pool.errors.append(e)
+
+
+class CompoundPiWriterFile(object):
+    """
+    File-like object returned by :meth:`CompoundPiWriterPool.open`. Writes are
+    queued for the *writer* thread which owns the underlying *file*; other
+    operations wait for the queued writes to complete before executing.
+    Errors encountered by the writer are raised by subsequent operations.
+    """
+
+    def __init__(self, writer, file):
+        self.writer = writer
+        self.file = file
+        self.error = None
+        self.closed = False
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def _wait(self):
+        event = threading.Event()
+        self.writer.submit(self, 'sync', event)
+        event.wait()
+        self._check()
+
+    def write(self, data):
+        self._check()
+        # The caller may re-use its buffer once this returns, so the data
+        # must be copied before it is queued
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        else:
+            data = bytes(data)
+        self.writer.submit(self, 'write', data)
+        return len(data)
+
+    def tell(self):
+        self._wait()
+        return self.file.tell()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._wait()
+        return self.file.seek(offset, whence)
+
+    def truncate(self, size=None):
+        self._wait()
+        return self.file.truncate(size)
+
+    def flush(self):
+        self._wait()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.submit(self, 'close')
+
+
+class CompoundPiPreview(object):
+    """
+    Holds the state of the live preview streamed from the server at *address*
+    (see :meth:`CompoundPiClient.preview`).
+
+    .. attribute:: frame
+
+        The most recently received frame as a ``(timestamp, data)`` tuple,
+        where *timestamp* is a :class:`~datetime.datetime` giving the time
+        (by the server's clock) at which the frame was captured, and *data*
+        is the frame as a JPEG encoded byte-string. This is ``None`` until
+        the first frame is received.
+
+    .. attribute:: frames
+
+        The number of frames received since the preview was started.
+
+    .. attribute:: size
+
+        The number of bytes received since the preview was started.
+
+    .. attribute:: started
+
+        The time (as a UNIX timestamp) at which the preview was started.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.frame = None
+        self.frames = 0
+        self.size = 0
+        self.started = time.time()
+
+    @property
+    def rate(self):
+        """
+        Returns the throughput of the preview in bytes per second.
+        """
+        return self.size / max(time.time() - self.started, 1e-6)
+
+    def _receive(self, timestamp, data):
+        self.frame = (datetime.datetime.fromtimestamp(timestamp), data)
+        self.frames += 1
+        self.size += PREVIEW_HEADER.size + len(data)
+
+
+class CompoundPiDownloadHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # The connection is read directly (rather than via a buffered file
+        # object) so that image data can be received straight into the
+        # transfer's buffer. A connection carries a sequence of frames (one
+        # for SEND, several for SENDALL) each consisting of a header, the
+        # image data, and a trailer
+        address = IPv4Address(self.client_address[0])
+        while True:
+            header = self.read(SEND_HEADER.size)
+            if header is None:
+                return
+            index, size, offset, length = SEND_HEADER.unpack(header)
+            try:
+                transfer = self.server.transfers[(address, index)]
+            except KeyError:
+                warnings.warn(CompoundPiUnknownAddress(address))
+                # Skip the frame's data and trailer
+                remaining = length + SEND_TRAILER.size
+                while remaining:
+                    data = self.request.recv(min(remaining, 65536))
+                    if not data:
+                        return
+                    remaining -= len(data)
+            else:
+                transfer.receive(self.request, size, offset, length)
+                # Any failure other than a checksum mismatch leaves the
+                # connection part way through a frame
+                if transfer.exception and not isinstance(
+                        transfer.exception, CompoundPiChecksumError):
+                    return
+
+    def read(self, size):
+        # Read exactly *size* bytes from the connection, returning None if
+        # it closes first
+        data = bytearray(size)
+        view = memoryview(data)
+        offset = 0
+        while offset < size:
+            read = self.request.recv_into(view[offset:])
+            if not read:
+                return None
+            offset += read
+        return bytes(data)
+
+
+class CompoundPiChannel(threading.Thread):
+    """
+    Background thread which reads images sent by the server at *address* over
+    a persistent connection (a data channel, see
+    :attr:`CompoundPiClient.data_channels`) opened to *port* on the server.
+    Frames received are passed to the matching transfer in *transfers* (a
+    mapping of ``(address, index)`` tuples to :class:`CompoundPiTransfer`
+    instances) exactly as for connections made by the server. The thread ends
+    when the connection closes, or if a transfer fails part way through a
+    frame (in which case the connection cannot be used further).
+    """
+
+    def __init__(self, address, port, transfers, timeout):
+        super(CompoundPiChannel, self).__init__()
+        self.daemon = True
+        self.address = address
+        self.transfers = transfers
+        self.socket = socket.create_connection((str(address), port), timeout)
+        self.socket.settimeout(None)
+        # Only acknowledgements are sent by the client, and the server waits
+        # for each before sending any further image
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.start()
+
+    def close(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.join()
+
+    def run(self):
+        try:
+            CompoundPiDownloadHandler(
+                self.socket, self.socket.getpeername(), self)
+        except socket.error as e:
+            logging.warning('Data channel to %s failed: %s', self.address, e)
+        finally:
+            self.socket.close()
 
 
 class CompoundPiDownloadServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     allow_reuse_address = True
+    # Permit a backlog of connections from servers simultaneously sending
+    # images to download_many
+    request_queue_size = 32
+
 
+class CompoundPiPreviewHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # Frames are read until the server closes the connection, or the
+        # client stops the preview
+        address = IPv4Address(self.client_address[0])
+        if address not in self.server.previews:
+            warnings.warn(CompoundPiUnknownAddress(address))
+            return
+        while True:
+            header = self.read(PREVIEW_HEADER.size)
+            if header is None:
+                break
+            timestamp, size = PREVIEW_HEADER.unpack(header)
+            data = self.read(size)
+            if data is None:
+                break
+            try:
+                preview = self.server.previews[address]
+            except KeyError:
+                break
+            preview._receive(timestamp, data)
+
+    def read(self, size):
+        # Returns exactly *size* bytes from the connection, or None if it is
+        # closed first
+        buf = bytearray(size)
+        view = memoryview(buf)
+        offset = 0
+        while offset < size:
+            read = self.request.recv_into(view[offset:])
+            if not read:
+                return None
+            offset += read
+        return bytes(buf)
+
+
+class CompoundPiPreviewServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
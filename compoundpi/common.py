@@ -24,57 +24,167 @@ from __future__ import (
     print_function,
     division,
     )
+native_str = str
 str = type('')
 
 
+import struct
 import threading
 import time
+import heapq
 import random
+import logging
+import itertools
 
 
-class NetworkRepeater(threading.Thread):
+# The header prefixing each image sent over TCP by the server in response to
+# the SEND command: the index of the image, its total size in bytes, and the
+# offset and length in bytes of the range of the image that follows
+SEND_HEADER = struct.Struct(native_str('>LLLL'))
+
+# The trailer following the range of the image sent in response to the SEND
+# command: the CRC32 of the range
+SEND_TRAILER = struct.Struct(native_str('>L'))
+
+# The header prefixing each frame streamed over TCP by the server in response
+# to the PREVIEW command: the time the frame began (by the server's clock) and
+# its size in bytes
+PREVIEW_HEADER = struct.Struct(native_str('>dL'))
+
+
+class NetworkRepeater(object):
     """
-    Background thread for repeating a network transmission.
+    Background scheduler for repeating network transmissions.
 
-    This trivial threading class is used by both the server and client portions
-    of Compound Pi to repeat transmissions on the network (required as UDP
-    is a deliberately unreliable protocol).
+    This class is used by both the server and client portions of Compound Pi
+    to repeat transmissions on the network (required as UDP is a deliberately
+    unreliable protocol). A single instance (and a single background thread)
+    owns all pending re-transmissions for a socket, regardless of how many
+    destinations are outstanding.
 
     The *socket* parameter specifies the socket instance that will be used for
-    transmission. The *address* parameter specifies the address (as a tuple)
-    that is the destination for the transmission. The *data* parameter
-    specifies the byte string that is to be sent.
+    all transmissions.
 
     The optional *timeout* parameter specifies how many seconds must elapse
-    before the repeater will cease repeating its tranmissions. The optional
+    before the repeater will cease repeating a tranmission. The optional
     *interval* parameter specifies the largest possible interval between
     re-transmissions. The actual interval is randomly selected from a uniform
     distribution to reduce the likelihood of colliding transmissions causing
     dropped packets. Prior to use of this class the random number generator
     should be randomly seeded with :func:`random.seed`.
 
-    To terminate re-transmission early (e.g. in the event of receiving a
-    response), set the :attr:`terminate` attribute to True then
-    :meth:`~threading.join` the thread. The class initializer calls
-    :meth:`~threading.start` automatically so you only need construct the
-    class.
+    Transmissions are started with :meth:`send` and identified by a hashable
+    *key* (typically a tuple of the destination address and the sequence
+    number of the message). To terminate re-transmission early (e.g. in the
+    event of receiving a response), call :meth:`cancel` with the same key.
+    Pending re-transmissions are kept in a heap ordered by due time;
+    cancellation simply discards the key's entry from a dictionary and the
+    stale heap entry is skipped when it falls due.
+
+    The class initializer starts the background thread automatically; call
+    :meth:`close` to terminate it.
     """
 
-    def __init__(self, socket, address, data, timeout=5, interval=0.2):
-        super(NetworkRepeater, self).__init__()
+    def __init__(self, socket, timeout=5, interval=0.2):
         self.socket = socket
-        self.address = address
-        self.data = data
         self.timeout = timeout
         self.interval = interval
-        self.terminate = False
-        self.daemon = True
-        self.start()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._counter = itertools.count()
+        self._pending = {}
+        self._queue = []
+        self._closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._pending
 
-    def run(self):
-        start = time.time()
-        while not self.terminate and time.time() < start + self.timeout:
-            self.socket.sendto(self.data, self.address)
-            time.sleep(random.uniform(0.0, self.interval))
+    def send(self, key, address, data):
+        """
+        Transmit *data* to *address* immediately, and schedule its repetition
+        until :meth:`cancel` is called with *key*, or :attr:`timeout` seconds
+        have elapsed. If a transmission with the same *key* is already
+        pending, it is replaced.
+        """
+        now = time.time()
+        entry = _Transmission(key, address, data, now + self.timeout)
+        self._transmit(entry)
+        with self._lock:
+            self._pending[key] = entry
+            self._schedule(entry, now)
+            self._wakeup.notify()
 
+    def cancel(self, key):
+        """
+        Stop repeating the transmission identified by *key*. Returns ``True``
+        if the transmission was still pending, or ``False`` otherwise.
+        """
+        with self._lock:
+            return self._pending.pop(key, None) is not None
 
+    def close(self):
+        """
+        Cancel all pending transmissions and terminate the background thread.
+        """
+        with self._lock:
+            self._closed = True
+            self._pending.clear()
+            del self._queue[:]
+            self._wakeup.notify()
+        self._thread.join()
+
+    def _schedule(self, entry, now):
+        heapq.heappush(self._queue, (
+            now + random.uniform(0.0, self.interval),
+            next(self._counter),
+            entry,
+            ))
+
+    def _transmit(self, entry):
+        try:
+            self.socket.sendto(entry.data, entry.address)
+        except IOError as e:
+            logging.warning('Failed to send to %s: %s', entry.address, e)
+
+    def _run(self):
+        while True:
+            due = []
+            with self._lock:
+                while not self._closed:
+                    now = time.time()
+                    if self._queue and self._queue[0][0] <= now:
+                        break
+                    self._wakeup.wait(
+                        self._queue[0][0] - now if self._queue else None)
+                if self._closed:
+                    return
+                while self._queue and self._queue[0][0] <= now:
+                    _, _, entry = heapq.heappop(self._queue)
+                    if self._pending.get(entry.key) is not entry:
+                        # Cancelled or replaced since it was scheduled
+                        continue
+                    if now >= entry.expires:
+                        del self._pending[entry.key]
+                        continue
+                    due.append(entry)
+                    self._schedule(entry, now)
+            for entry in due:
+                self._transmit(entry)
+
+
+class _Transmission(object):
+    __slots__ = ('key', 'address', 'data', 'expires')
+
+    def __init__(self, key, address, data, expires):
+        self.key = key
+        self.address = address
+        self.data = data
+        self.expires = expires
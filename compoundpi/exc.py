@@ -207,3 +207,9 @@ class CompoundPiSendTimeout(CompoundPiServerError):
                 address, 'timed out waiting for SEND connection')
 
 
+class CompoundPiChecksumError(CompoundPiServerError):
+    "Exception raised when the data received from a SEND fails its checksum"
+
+    def __init__(self, address, index):
+        super(CompoundPiChecksumError, self).__init__(
+                address, 'checksum mismatch in transfer of image %d' % index)
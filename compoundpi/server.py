@@ -39,12 +39,14 @@ import time
 import random
 import logging
 import threading
-import struct
 import socket
 import SocketServer as socketserver
-import shutil
+import Queue as queue
 import signal
 import warnings
+import zlib
+from collections import deque
+from contextlib import contextmanager
 
 import daemon
 import daemon.runner
@@ -53,7 +55,13 @@ import RPi.GPIO as GPIO
 
 from . import __version__
 from .terminal import TerminalApplication
-from .common import NetworkRepeater
+from .common import (
+    NetworkRepeater,
+    SEND_HEADER,
+    SEND_TRAILER,
+    PREVIEW_HEADER,
+    )
+from .store import ImageStore, MemoryBackend, RingBackend, FileBackend
 from .exc import (
     CompoundPiInvalidClient,
     CompoundPiStaleSequence,
@@ -70,6 +78,18 @@ def service(s):
 def address(s):
     return socket.getaddrinfo(s, 0, 0, socket.SOCK_DGRAM)[0][-1][0]
 
+def multicast_group(s):
+    try:
+        packed = socket.inet_aton(s)
+    except (socket.error, TypeError):
+        raise ValueError('Invalid multicast address %s' % s)
+    if not 224 <= bytearray(packed)[0] <= 239:
+        raise ValueError('%s is not a multicast address' % s)
+    return str(socket.inet_ntoa(packed))
+
+def multicast_groups(s):
+    return [multicast_group(group) for group in s.split(',') if group.strip()]
+
 def user(s):
     try:
         return int(s)
@@ -85,6 +105,398 @@ def group(s):
 
 class CompoundPiUDPServer(socketserver.UDPServer):
     allow_reuse_address = True
+    # The address of the interface on which multicast groups are joined; the
+    # default permits the kernel to select an interface
+    multicast_interface = '0.0.0.0'
+
+    def __init__(self, server_address, RequestHandlerClass):
+        socketserver.UDPServer.__init__(
+            self, server_address, RequestHandlerClass)
+        self.groups = set()
+        self.armed = None
+        self.preview = None
+        self.recording = None
+        # Clients may open a persistent TCP connection to the server's port
+        # over which images are sent (rather than the server connecting to
+        # the client for each transfer); the latest such connection is the
+        # data channel
+        self.channel = None
+        self.channel_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.channel_socket.setsockopt(
+            socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.channel_socket.bind(self.server_address)
+        self.channel_socket.listen(1)
+
+    def join_group(self, group):
+        self.socket.setsockopt(
+            socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+            self._membership(group))
+        self.groups.add(group)
+
+    def leave_group(self, group):
+        self.groups.discard(group)
+        self.socket.setsockopt(
+            socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP,
+            self._membership(group))
+
+    def gpio_trigger(self, channel):
+        # Called by RPi.GPIO's event thread upon each edge of the trigger pin.
+        # The time is noted immediately as the time of the trigger; the frame
+        # is stored by the worker thread to serialize it with other camera
+        # commands (e.g. DISARM)
+        timestamp = time.time()
+        if not self.armed:
+            logging.warning('Ignoring GPIO trigger: camera is not armed')
+        else:
+            self.worker.submit(self.armed_trigger, timestamp)
+
+    def armed_trigger(self, timestamp):
+        # The camera may have been disarmed while the trigger was queued
+        if self.armed:
+            image = self.armed.take(self.images, timestamp)
+            logging.info('GPIO triggered image %d', image.index)
+
+    def _membership(self, group):
+        return (
+            socket.inet_aton(group) +
+            socket.inet_aton(self.multicast_interface))
+
+    def serve_forever(self, poll_interval=0.5):
+        # The repeater and worker threads are started here rather than in the
+        # constructor to ensure they are created after the daemon context has
+        # forked
+        self.repeater = NetworkRepeater(self.socket)
+        self.worker = CameraWorker()
+        channel_thread = threading.Thread(target=self.accept_channels)
+        channel_thread.daemon = True
+        channel_thread.start()
+        try:
+            socketserver.UDPServer.serve_forever(self, poll_interval)
+        finally:
+            self.worker.close()
+            self.repeater.close()
+
+    def server_close(self):
+        socketserver.UDPServer.server_close(self)
+        try:
+            self.channel_socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.channel_socket.close()
+        if self.channel:
+            self.close_channel(self.channel)
+
+    def accept_channels(self):
+        while True:
+            try:
+                sock, address = self.channel_socket.accept()
+            except socket.error:
+                # The listening socket has been closed
+                break
+            logging.info('Data channel opened by %s', address[0])
+            # Frame trailers are small writes which Nagle's algorithm would
+            # otherwise hold back until the client acknowledges the data
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            old, self.channel = self.channel, sock
+            if old:
+                old.close()
+
+    def close_channel(self, channel):
+        # Only the current channel is forgotten; a channel which has since
+        # been replaced is merely closed
+        if self.channel is channel:
+            self.channel = None
+        channel.close()
+
+
+class CameraWorker(threading.Thread):
+    """
+    Background thread which executes camera-bound commands.
+
+    Commands which operate the camera (or the image store it writes to) may
+    take a long time to complete, and must not be executed concurrently.
+    Rather than executing them in the thread reading the server's socket
+    (which would prevent the server from reading ACKs, repeated commands, or
+    answering STATUS queries in the meantime), they are passed to
+    :meth:`submit` which queues them for serialized execution in this thread.
+    """
+
+    def __init__(self):
+        super(CameraWorker, self).__init__()
+        self.daemon = True
+        self.queue = queue.Queue()
+        self.start()
+
+    def submit(self, func, *args):
+        self.queue.put((func, args))
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            func, args = item
+            try:
+                func(*args)
+            except Exception as e:
+                logging.exception(str(e))
+
+
+class ArmedCapture(object):
+    """
+    Keeps the camera's video port capturing continuously so that images can
+    be taken without the delay of starting a capture.
+
+    Upon construction, a background thread begins capturing JPEG frames from
+    the video port of *camera*, retaining the most recent *frames* (along
+    with the time each completed) in a buffer. Each call to :meth:`frame`
+    removes and returns the buffered frame closest to a given time, waiting
+    for one to complete at or after that time if necessary. Call
+    :meth:`close` to stop capturing.
+    """
+
+    def __init__(self, camera, frames=3, timeout=1.0):
+        self.camera = camera
+        self.timeout = timeout
+        self.running = True
+        self._frames = deque(maxlen=frames)
+        self._ready = threading.Condition()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def outputs(self):
+        # A new stream is yielded for each frame rather than recycling a
+        # fixed set; frames pushed out of the buffer are simply discarded
+        while self.running:
+            stream = io.BytesIO()
+            yield stream
+            with self._ready:
+                self._frames.append((time.time(), stream))
+                self._ready.notify_all()
+
+    def frame(self, timestamp):
+        """
+        Returns a ``(timestamp, stream)`` tuple for the buffered frame which
+        completed closest to *timestamp*. If no frame has completed at or after
+        *timestamp*, waits for one first. Raises :exc:`IOError` if no suitable
+        frame completes within :attr:`timeout` seconds of *timestamp*.
+        """
+        deadline = max(timestamp, time.time()) + self.timeout
+        with self._ready:
+            while not self._frames or self._frames[-1][0] < timestamp:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self.running:
+                    raise IOError('Timed out waiting for armed frame')
+                self._ready.wait(remaining)
+            result = min(self._frames, key=lambda f: abs(f[0] - timestamp))
+            self._frames.remove(result)
+        return result
+
+    def take(self, images, timestamp):
+        """
+        Stores the frame closest to *timestamp* (see :meth:`frame`) in the
+        :class:`~compoundpi.store.ImageStore` *images*, recording *timestamp*
+        as the image's trigger time. Returns the new
+        :class:`~compoundpi.store.StoredImage`.
+        """
+        taken, stream = self.frame(timestamp)
+        image = images.create(taken, trigger=timestamp)
+        try:
+            image.write(stream.getvalue())
+        finally:
+            image.finish()
+        return image
+
+    def close(self):
+        self.running = False
+        self._thread.join()
+
+    def _run(self):
+        try:
+            self.camera.capture_sequence(
+                self.outputs(), format='jpeg', use_video_port=True)
+        except Exception as e:
+            logging.exception(str(e))
+        finally:
+            with self._ready:
+                self.running = False
+                self._ready.notify_all()
+
+
+class Recording(object):
+    """
+    Records H.264 video from the camera's video port into an image store.
+
+    Upon construction, begins recording from a splitter port of *camera* at
+    the specified *bitrate* into a new image of :class:`~compoundpi.store.
+    ImageStore` *images*. A background thread splits the recording every
+    *segment* seconds (at the next key-frame) into a further image, so that
+    completed segments can be retrieved while recording continues. Each
+    segment begins with the stream's headers, hence can be decoded
+    independently. The timestamp of each segment is the time at which it
+    began, and its duration is set when it completes. Call :meth:`close` to
+    stop recording.
+    """
+
+    splitter_port = 1
+
+    def __init__(self, camera, images, segment=10.0, bitrate=17000000):
+        self.camera = camera
+        self.images = images
+        self.segment = segment
+        self._stopped = threading.Event()
+        self._image = images.create(time.time(), format='h264')
+        try:
+            camera.start_recording(
+                self._image, format='h264',
+                splitter_port=self.splitter_port, bitrate=bitrate,
+                inline_headers=True)
+        except:
+            self._image.finish()
+            images.remove(self._image.index)
+            raise
+        self._image.timestamp = self.started = time.time()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        try:
+            self.camera.stop_recording(splitter_port=self.splitter_port)
+        finally:
+            self._finish(self._image, time.time())
+
+    def _finish(self, image, ended):
+        image.duration = ended - image.timestamp
+        image.finish()
+        logging.info(
+            'Recorded segment %d (%.1fs, %d bytes)',
+            image.index, image.duration, image.size)
+
+    def _run(self):
+        try:
+            while not self._stopped.wait(self.segment):
+                # Surface any error encountered by the encoder
+                self.camera.wait_recording(0, splitter_port=self.splitter_port)
+                image = self.images.create(time.time(), format='h264')
+                try:
+                    self.camera.split_recording(
+                        image, splitter_port=self.splitter_port)
+                except:
+                    image.finish()
+                    self.images.remove(image.index)
+                    raise
+                image.timestamp = time.time()
+                self._finish(self._image, image.timestamp)
+                self._image = image
+        except Exception as e:
+            # The recording continues in the current segment until stopped
+            logging.error('Unable to split recording: %s', e)
+
+
+class PreviewStream(object):
+    """
+    Streams a low resolution preview from the camera's video port to a client.
+
+    Upon construction, connects to the client at *address* and begins
+    recording MJPEG from a splitter port of *camera*, resized to *resolution*,
+    with the encoder limited to *bitrate* bits per second at the specified
+    JPEG *quality*. A background thread sends each frame to the client
+    prefixed by a :data:`~compoundpi.common.PREVIEW_HEADER`, pacing them so
+    that no more than *framerate* frames or *bitrate* bits are sent per
+    second. Frames which complete while the thread is sending or pacing are
+    dropped in favour of the latest, hence a slow network reduces the
+    preview's framerate rather than increasing its latency or stalling the
+    encoder. Call :meth:`close` to stop the preview.
+    """
+
+    splitter_port = 2
+    timeout = 5.0
+
+    def __init__(self, camera, address, resolution, framerate, bitrate, quality):
+        self.camera = camera
+        self.interval = 1 / framerate
+        self.bitrate = bitrate
+        self.running = True
+        self._frame = None
+        self._started = None
+        self._buffer = io.BytesIO()
+        self._ready = threading.Condition()
+        self._sock = socket.create_connection(address, self.timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        try:
+            camera.start_recording(
+                self, format='mjpeg', splitter_port=self.splitter_port,
+                resize=resolution, bitrate=bitrate, quality=quality)
+        except:
+            self.close()
+            raise
+
+    def write(self, buf):
+        # Called by the encoder with each chunk of output; a JPEG
+        # start-of-image marker completes the frame in the buffer (if any)
+        # and begins the next
+        if buf.startswith(b'\xff\xd8'):
+            if self._buffer.tell():
+                with self._ready:
+                    self._frame = (self._started, self._buffer.getvalue())
+                    self._ready.notify()
+                self._buffer.seek(0)
+                self._buffer.truncate()
+            self._started = time.time()
+        self._buffer.write(buf)
+        return len(buf)
+
+    def close(self):
+        with self._ready:
+            self.running = False
+            self._ready.notify()
+        try:
+            self.camera.stop_recording(splitter_port=self.splitter_port)
+        except Exception as e:
+            # The recording may never have started, or may have failed
+            logging.debug(str(e))
+        try:
+            # Unblock the thread should it be stuck sending to the client
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._thread.join()
+        self._sock.close()
+
+    def _run(self):
+        next_send = 0.0
+        try:
+            while True:
+                with self._ready:
+                    while self.running:
+                        delay = next_send - time.time()
+                        if self._frame and delay <= 0:
+                            break
+                        self._ready.wait(delay if self._frame else None)
+                    if not self.running:
+                        break
+                    timestamp, data = self._frame
+                    self._frame = None
+                sent = time.time()
+                self._sock.sendall(
+                    PREVIEW_HEADER.pack(timestamp, len(data)) + data)
+                next_send = sent + max(
+                    self.interval,
+                    (PREVIEW_HEADER.size + len(data)) * 8 / self.bitrate)
+        except socket.error as e:
+            if self.running:
+                logging.warning('Preview stream failed: %s', e)
 
 
 class CompoundPiServer(TerminalApplication):
@@ -130,6 +542,65 @@ class CompoundPiServer(TerminalApplication):
             '--pidfile', metavar='FILE', default='/var/run/cpid.pid',
             help='specifies the location of the pid lock file '
             '(default: %(default)s)')
+        self.parser.add_argument(
+            '--memory-limit', type=int, default='0', metavar='MB',
+            help='specifies the maximum number of megabytes of RAM used to '
+            'store captured images; 0 means unlimited (default: %(default)s)')
+        self.parser.add_argument(
+            '--ring-slots', type=int, default='0', metavar='N',
+            help='if non-zero, store images in a pre-allocated memory-mapped '
+            'ring of N fixed-size slots instead of individually allocated '
+            'buffers; --memory-limit is ignored in this case (default: '
+            '%(default)s)')
+        self.parser.add_argument(
+            '--ring-slot-size', type=int, default='4', metavar='MB',
+            help='specifies the size of each slot in the ring; captures which '
+            'exceed this will fail (default: %(default)s)')
+        self.parser.add_argument(
+            '--spill-path', metavar='DIR', default='',
+            help='specifies a directory (e.g. a tmpfs mount or a directory '
+            'on the SD card) in which images will be stored once the memory '
+            'limit is reached (default: none)')
+        self.parser.add_argument(
+            '--spill-limit', type=int, default='0', metavar='MB',
+            help='specifies the maximum number of megabytes of images stored '
+            'under --spill-path; 0 means unlimited (default: %(default)s)')
+        self.parser.add_argument(
+            '--store-policy', choices=ImageStore.policies, default='refuse',
+            help='specifies what happens when the image store is full: '
+            'refuse further captures, or evict the oldest images that have '
+            'been downloaded (default: %(default)s)')
+        self.parser.add_argument(
+            '--multicast-groups', type=multicast_groups, default='',
+            metavar='ADDRESS[,ADDRESS...]',
+            help='specifies a comma-separated list of multicast groups that '
+            'the server will join on startup, in addition to any the client '
+            'assigns it to; --bind must be 0.0.0.0 to receive multicast '
+            'commands (default: none)')
+        self.parser.add_argument(
+            '--multicast-interface', type=address, default='0.0.0.0',
+            metavar='ADDRESS',
+            help='specifies the address of the interface on which multicast '
+            'groups are joined (default: %(default)s)')
+        self.parser.add_argument(
+            '--trigger-pin', type=int, default=None, metavar='PIN',
+            help='if specified, the BCM number of a GPIO pin; edges on this '
+            'pin cause an armed camera to store the frame closest to the '
+            'edge (default: none)')
+        self.parser.add_argument(
+            '--trigger-edge', choices=('rising', 'falling', 'both'),
+            default='rising',
+            help='specifies which edges of --trigger-pin trigger a capture '
+            '(default: %(default)s)')
+        self.parser.add_argument(
+            '--trigger-pull', choices=('off', 'up', 'down'), default='off',
+            help='specifies the pull resistor applied to --trigger-pin '
+            '(default: %(default)s)')
+        self.parser.add_argument(
+            '--trigger-bounce', type=int, default='0', metavar='MS',
+            help='specifies the number of milliseconds after an edge during '
+            'which further edges are ignored; 0 disables debouncing '
+            '(default: %(default)s)')
 
     def main(self, args):
         warnings.showwarning = self.showwarning
@@ -142,6 +613,10 @@ class CompoundPiServer(TerminalApplication):
             args.bind, args.port, 0, socket.SOCK_DGRAM)[0][-1]
         logging.info('Listening on %s:%d', address[0], address[1])
         self.server = CompoundPiUDPServer(address, CameraRequestHandler)
+        self.server.multicast_interface = args.multicast_interface
+        for group in args.multicast_groups:
+            logging.info('Joining multicast group %s', group)
+            self.server.join_group(group)
         # Test GPIO before entering the daemon context (GPIO access usually
         # requires root privileges for access to /dev/mem - better to bomb out
         # earlier than later)
@@ -149,7 +624,7 @@ class CompoundPiServer(TerminalApplication):
         GPIO.gpio_function(5)
         # Ensure the server's socket, any log file, and stderr are preserved
         # (if not forking)
-        files_preserve = [self.server.socket]
+        files_preserve = [self.server.socket, self.server.channel_socket]
         for handler in logging.getLogger().handlers:
             if isinstance(handler, logging.FileHandler):
                 files_preserve.append(handler.stream)
@@ -171,11 +646,15 @@ class CompoundPiServer(TerminalApplication):
             random.seed()
             logging.info('Initializing camera')
             self.server.seqno = 0
+            self.server.seqnos = set()
             self.server.client_address = None
             self.server.client_timestamp = None
-            self.server.responders = {}
-            self.server.images = []
+            self.server.images = self.create_store(args)
             self.server.camera = picamera.PiCamera()
+            # Edge detection starts a thread, hence it is configured within
+            # the daemon context
+            if args.trigger_pin is not None:
+                self.setup_trigger(args)
             try:
                 logging.info('Starting server thread')
                 thread = threading.Thread(target=self.server.serve_forever)
@@ -184,10 +663,47 @@ class CompoundPiServer(TerminalApplication):
                     thread.join(1)
                 logging.info('Server thread ended')
             finally:
+                if args.trigger_pin is not None:
+                    GPIO.remove_event_detect(args.trigger_pin)
+                if self.server.armed:
+                    self.server.armed.close()
+                if self.server.preview:
+                    self.server.preview.close()
+                if self.server.recording:
+                    self.server.recording.close()
                 logging.info('Closing camera')
                 self.server.camera.close()
         logging.info('Exiting daemon context')
 
+    def setup_trigger(self, args):
+        logging.info(
+            'Waiting for %s edges on GPIO%d', args.trigger_edge,
+            args.trigger_pin)
+        GPIO.setup(args.trigger_pin, GPIO.IN, pull_up_down={
+            'off':  GPIO.PUD_OFF,
+            'up':   GPIO.PUD_UP,
+            'down': GPIO.PUD_DOWN,
+            }[args.trigger_pull])
+        kwargs = {}
+        if args.trigger_bounce:
+            kwargs['bouncetime'] = args.trigger_bounce
+        GPIO.add_event_detect(args.trigger_pin, {
+            'rising':  GPIO.RISING,
+            'falling': GPIO.FALLING,
+            'both':    GPIO.BOTH,
+            }[args.trigger_edge], callback=self.server.gpio_trigger, **kwargs)
+
+    def create_store(self, args):
+        if args.ring_slots:
+            backends = [
+                RingBackend(args.ring_slots, args.ring_slot_size * 1048576)]
+        else:
+            backends = [MemoryBackend(args.memory_limit * 1048576)]
+        if args.spill_path:
+            backends.append(
+                FileBackend(args.spill_path, args.spill_limit * 1048576))
+        return ImageStore(backends, args.store_policy)
+
     def showwarning(self, message, category, filename, lineno, file=None,
             line=None):
         logging.warning(str(message))
@@ -207,9 +723,38 @@ class CameraRequestHandler(socketserver.DatagramRequestHandler):
             r'(?P<command>[A-Z]+)( (?P<params>.*))?')
     response_re = re.compile(
             r'(?P<seqno>\d+) '
-            r'(?P<result>OK|ERROR)(\n(?P<data>.*))?')
+            r'(?P<result>OK|ERROR)'
+            r'( (?P<fragment>\d+)/(?P<fragments>\d+))?'
+            r'(\n(?P<data>.*))?', flags=re.DOTALL)
+    # The maximum size of the data portion of a response datagram (chosen to
+    # keep datagrams within a typical ethernet MTU). Responses with more data
+    # than this are split into fragments of whole lines which are transmitted
+    # and acknowledged individually
+    fragment_size = 1400
+    # Commands which do not operate the camera; these are executed immediately
+    # by the thread reading the socket, even while a camera-bound command is
+    # still in progress. All other commands are queued for the server's
+    # CameraWorker
+    immediate_commands = {'GROUP', 'HELLO', 'LIST', 'STATUS', 'SYNC'}
+    # The number of sequence numbers (counting back from the highest received)
+    # within which commands are accepted out of order. This permits clients to
+    # pipeline several commands without reordering in the network causing some
+    # to be rejected as stale. Commands with sequence numbers below the window,
+    # or which have already been received, are ignored
+    sequence_window = 64
+    # The number of seconds before a synchronized capture at which the server
+    # stops sleeping and busy-waits for the sync time instead. The scheduler
+    # may oversleep by several milliseconds, whereas spinning for the tail of
+    # the wait permits the capture to begin within microseconds of the target
+    spin_time = 0.01
+    # The number of seconds the server waits for a client to confirm receipt
+    # of an image sent with the SEND command's clear flag
+    send_ack_timeout = 5.0
 
     def handle(self):
+        # The time of receipt is noted before anything else for the benefit
+        # of SYNC
+        self.received = time.time()
         data = self.rfile.read().strip()
         logging.debug(
                 '%s:%d > %r',
@@ -229,13 +774,17 @@ class CameraRequestHandler(socketserver.DatagramRequestHandler):
                 handler = {
                     'ACK':          self.do_ack,
                     'AGC':          self.do_agc,
+                    'ARM':          self.do_arm,
                     'AWB':          self.do_awb,
                     'BLINK':        self.do_blink,
                     'CAPTURE':      self.do_capture,
                     'CLEAR':        self.do_clear,
+                    'CONFIGURE':    self.do_configure,
+                    'DISARM':       self.do_disarm,
                     'EXPOSURE':     self.do_exposure,
                     'FLIP':         self.do_flip,
                     'FRAMERATE':    self.do_framerate,
+                    'GROUP':        self.do_group,
                     'HELLO':        self.do_hello,
                     'ISO':          self.do_iso,
                     'BRIGHTNESS':   self.do_brightness,
@@ -244,25 +793,35 @@ class CameraRequestHandler(socketserver.DatagramRequestHandler):
                     'EV':           self.do_ev,
                     'LIST':         self.do_list,
                     'METERING':     self.do_metering,
+                    'PREVIEW':      self.do_preview,
+                    'RECORD':       self.do_record,
                     'RESOLUTION':   self.do_resolution,
                     'SEND':         self.do_send,
+                    'SENDALL':      self.do_sendall,
                     'STATUS':       self.do_status,
+                    'STOP':         self.do_stop,
+                    'SYNC':         self.do_sync,
+                    'TRIGGER':      self.do_trigger,
                     }[command]
             except KeyError:
                 raise ValueError('Unknown command %s' % command)
             if handler == self.do_ack:
-                self.do_ack(seqno)
+                self.do_ack(seqno, *params)
                 return
             elif handler != self.do_hello:
                 if self.client_address != self.server.client_address:
                     raise CompoundPiInvalidClient(self.client_address[0])
-                elif seqno <= self.server.seqno:
+                elif self.stale_seqno(seqno):
                     raise CompoundPiStaleSequence(self.client_address[0], seqno)
-            response = handler(*params)
-            self.server.seqno = seqno
-            if not response:
-                response = ''
-            self.send_response(seqno, '%d OK\n%s' % (seqno, response))
+            if command in self.immediate_commands:
+                self.execute(seqno, handler, params)
+                self.record_seqno(seqno, reset=handler == self.do_hello)
+            else:
+                # The sequence number is recorded before the command is queued
+                # so that repeated transmissions of it are ignored as stale
+                # while it waits for (or is undergoing) execution
+                self.record_seqno(seqno)
+                self.server.worker.submit(self.execute, seqno, handler, params)
         except Warning as w:
             # Don't respond to raised warnings, just log them
             warnings.warn(w)
@@ -271,22 +830,79 @@ class CameraRequestHandler(socketserver.DatagramRequestHandler):
             logging.error(str(e))
             self.send_response(seqno, '%d ERROR\n%s' % (seqno, e))
 
+    def stale_seqno(self, seqno):
+        if seqno > self.server.seqno:
+            return False
+        elif seqno <= self.server.seqno - self.sequence_window:
+            return True
+        else:
+            return seqno in self.server.seqnos
+
+    def record_seqno(self, seqno, reset=False):
+        # A HELLO establishes a new client and hence a new window
+        if reset:
+            self.server.seqnos = set()
+            self.server.seqno = seqno
+        else:
+            self.server.seqno = max(self.server.seqno, seqno)
+        self.server.seqnos.add(seqno)
+        if len(self.server.seqnos) > self.sequence_window * 2:
+            self.server.seqnos = {
+                s for s in self.server.seqnos
+                if s > self.server.seqno - self.sequence_window
+                }
+
+    def execute(self, seqno, handler, params):
+        try:
+            response = handler(*params)
+        except Warning:
+            raise
+        except Exception as e:
+            logging.error(str(e))
+            self.send_response(seqno, '%d ERROR\n%s' % (seqno, e))
+        else:
+            if not response:
+                response = ''
+            self.send_response(seqno, '%d OK\n%s' % (seqno, response))
+
     def send_response(self, seqno, data):
         assert self.response_re.match(data)
+        header, _, body = data.partition('\n')
+        if len(body) <= self.fragment_size:
+            self.send_datagram((self.client_address, seqno), data)
+        else:
+            chunks = self.fragment(body)
+            for index, chunk in enumerate(chunks):
+                self.send_datagram(
+                    (self.client_address, seqno, index),
+                    '%s %d/%d\n%s' % (header, index, len(chunks), chunk))
+
+    def send_datagram(self, key, data):
         if isinstance(data, str):
             data = data.encode('utf-8')
         logging.debug(
                 '%s:%d < %r',
                 self.client_address[0], self.client_address[1], data)
-        self.server.responders[(self.client_address, seqno)] = NetworkRepeater(
-                self.socket, self.client_address, data)
+        self.server.repeater.send(key, self.client_address, data)
+
+    def fragment(self, data):
+        chunks = []
+        chunk = ''
+        for line in data.splitlines(True):
+            if chunk and len(chunk) + len(line) > self.fragment_size:
+                chunks.append(chunk)
+                chunk = ''
+            chunk += line
+        chunks.append(chunk)
+        return chunks
 
-    def do_ack(self, seqno):
+    def do_ack(self, seqno, fragment=None):
         seqno = int(seqno)
-        responder = self.server.responders.pop((self.client_address, seqno), None)
-        if responder:
-            responder.terminate = True
-            responder.join()
+        if fragment is None:
+            self.server.repeater.cancel((self.client_address, seqno))
+        else:
+            fragment = int(fragment)
+            self.server.repeater.cancel((self.client_address, seqno, fragment))
 
     def do_hello(self, timestamp):
         timestamp = float(timestamp)
@@ -297,6 +913,29 @@ class CameraRequestHandler(socketserver.DatagramRequestHandler):
         self.server.client_timestamp = timestamp
         return 'VERSION %s' % __version__
 
+    def do_sync(self):
+        return 'TIMESTAMP %f %f' % (self.received, time.time())
+
+    def do_group(self, action=None, group=None):
+        if action is None:
+            return ''.join(
+                'GROUP %s\n' % group
+                for group in sorted(self.server.groups)
+                )
+        if group is None:
+            raise ValueError('No multicast group specified')
+        group = multicast_group(group)
+        if action == 'JOIN':
+            if group not in self.server.groups:
+                logging.info('Joining multicast group %s', group)
+                self.server.join_group(group)
+        elif action == 'LEAVE':
+            if group in self.server.groups:
+                logging.info('Leaving multicast group %s', group)
+                self.server.leave_group(group)
+        else:
+            raise ValueError('Invalid GROUP action %s' % action)
+
     def blink_led(self, timeout):
         try:
             timeout = time.time() + timeout
@@ -320,6 +959,8 @@ class CameraRequestHandler(socketserver.DatagramRequestHandler):
         thread.start()
 
     def do_status(self):
+        memory_used, memory_limit = self.server.images.usage('memory')
+        disk_used, disk_limit = self.server.images.usage('disk')
         return (
             'RESOLUTION {width} {height}\n'
             'FRAMERATE {framerate}\n'
@@ -334,7 +975,8 @@ class CameraRequestHandler(socketserver.DatagramRequestHandler):
             'EV {ev}\n'
             'FLIP {hflip} {vflip}\n'
             'TIMESTAMP {timestamp}\n'
-            'IMAGES {images}\n'.format(
+            'IMAGES {images}\n'
+            'STORE {memory_used} {memory_limit} {disk_used} {disk_limit}\n'.format(
                 width=self.server.camera.resolution[0],
                 height=self.server.camera.resolution[1],
                 framerate=self.server.camera.framerate,
@@ -356,15 +998,31 @@ class CameraRequestHandler(socketserver.DatagramRequestHandler):
                 vflip=int(self.server.camera.vflip),
                 timestamp=time.time(),
                 images=len(self.server.images),
+                memory_used=memory_used,
+                memory_limit=memory_limit,
+                disk_used=disk_used,
+                disk_limit=disk_limit,
                 ))
 
+    def check_disarmed(self):
+        # Captures and changes to the camera's mode cannot be made while the
+        # video port is capturing continuously
+        if self.server.armed:
+            raise ValueError('Camera is armed')
+        if self.server.preview:
+            raise ValueError('Camera is previewing')
+        if self.server.recording:
+            raise ValueError('Camera is recording')
+
     def do_resolution(self, width, height):
         width, height = int(width), int(height)
+        self.check_disarmed()
         logging.info('Changing camera resolution to %dx%d', width, height)
         self.server.camera.resolution = (width, height)
 
     def do_framerate(self, rate):
         rate = fractions.Fraction(rate)
+        self.check_disarmed()
         logging.info('Changing camera framerate to %.2ffps', rate)
         self.server.camera.framerate = rate
 
@@ -431,23 +1089,116 @@ class CameraRequestHandler(socketserver.DatagramRequestHandler):
         logging.info('Changing camera vertical flip to %s', vertical)
         self.server.camera.vflip = vertical
 
+    # The settings accepted by CONFIGURE, and the conversion applied to the
+    # value of each
+    configure_settings = {
+        'resolution':       lambda v: tuple(int(i) for i in v.lower().split('x')),
+        'framerate':        fractions.Fraction,
+        'awb_mode':         lambda v: v.lower(),
+        'awb_red':          float,
+        'awb_blue':         float,
+        'agc_mode':         lambda v: v.lower(),
+        'exposure_mode':    lambda v: v.lower(),
+        'exposure_speed':   float,
+        'metering_mode':    lambda v: v.lower(),
+        'iso':              int,
+        'brightness':       int,
+        'contrast':         int,
+        'saturation':       int,
+        'ev':               int,
+        'hflip':            lambda v: bool(int(v)),
+        'vflip':            lambda v: bool(int(v)),
+        }
+
+    def do_configure(self, *params):
+        # Parse all settings before applying any of them so that a malformed
+        # request leaves the camera untouched
+        settings = {}
+        for param in params:
+            key, sep, value = param.partition('=')
+            if not sep:
+                raise ValueError('Invalid setting %s' % param)
+            try:
+                settings[key] = self.configure_settings[key](value)
+            except KeyError:
+                raise ValueError('Unknown setting %s' % key)
+        if 'resolution' in settings or 'framerate' in settings:
+            self.check_disarmed()
+        camera = self.server.camera
+        # Resolution and framerate are applied first (and only if they
+        # change) as each causes the camera to be reconfigured which resets
+        # several other properties
+        if 'resolution' in settings:
+            if settings['resolution'] != tuple(camera.resolution):
+                logging.info(
+                    'Changing camera resolution to %dx%d',
+                    *settings['resolution'])
+                camera.resolution = settings['resolution']
+        if 'framerate' in settings:
+            if settings['framerate'] != camera.framerate:
+                logging.info(
+                    'Changing camera framerate to %.2ffps',
+                    settings['framerate'])
+                camera.framerate = settings['framerate']
+        if 'agc_mode' in settings:
+            logging.info('Changing camera AGC mode to %s', settings['agc_mode'])
+            camera.exposure_mode = settings['agc_mode']
+        if 'exposure_mode' in settings or 'exposure_speed' in settings:
+            mode = settings.get(
+                'exposure_mode', 'off' if camera.shutter_speed else 'auto')
+            logging.info('Changing camera exposure speed mode to %s', mode)
+            if mode == 'auto':
+                camera.shutter_speed = 0
+            else:
+                speed = int(settings.get(
+                    'exposure_speed', camera.exposure_speed / 1000.0) * 1000)
+                logging.info(
+                    'Changing camera exposure speed to %.4fms', speed / 1000.0)
+                camera.shutter_speed = speed
+        if 'awb_mode' in settings:
+            logging.info('Changing camera AWB mode to %s', settings['awb_mode'])
+            camera.awb_mode = settings['awb_mode']
+        if (
+                ('awb_red' in settings or 'awb_blue' in settings) and
+                camera.awb_mode == 'off'):
+            red, blue = camera.awb_gains
+            red = settings.get('awb_red', red)
+            blue = settings.get('awb_blue', blue)
+            logging.info('Changing camera AWB gains to %.2f, %.2f', red, blue)
+            camera.awb_gains = (red, blue)
+        for key, attr, name in (
+                ('metering_mode', 'meter_mode',            'metering mode'),
+                ('iso',           'iso',                   'ISO'),
+                ('brightness',    'brightness',            'brightness'),
+                ('contrast',      'contrast',              'contrast'),
+                ('saturation',    'saturation',            'saturation'),
+                ('ev',            'exposure_compensation', 'EV'),
+                ('hflip',         'hflip',                 'horizontal flip'),
+                ('vflip',         'vflip',                 'vertical flip'),
+                ):
+            if key in settings:
+                logging.info('Changing camera %s to %s', name, settings[key])
+                setattr(camera, attr, settings[key])
+        return self.do_status()
+
     def stream_generator(self, count):
         for i in range(count):
-            stream = io.BytesIO()
-            self.server.images.append((time.time(), stream))
-            yield stream
+            image = self.server.images.create(time.time())
+            try:
+                yield image
+            finally:
+                image.finish()
 
     def do_capture(self, count=1, use_video_port=False, sync=None):
         count = int(count)
         use_video_port = bool(int(use_video_port))
         sync = float(sync) if sync else None
+        self.check_disarmed()
         self.server.camera.led = False
         try:
             if sync is not None:
-                delay = sync - time.time()
-                if delay <= 0.0:
-                    raise ValueError('Sync time in past')
-                time.sleep(delay)
+                self.wait_until(sync)
+            started = time.time()
             self.server.camera.capture_sequence(
                 self.stream_generator(count), format='jpeg',
                 use_video_port=use_video_port)
@@ -456,36 +1207,350 @@ class CameraRequestHandler(socketserver.DatagramRequestHandler):
                     count, 'video' if use_video_port else 'still')
         finally:
             self.server.camera.led = True
+        return 'TIMESTAMP %f' % started
+
+    def wait_until(self, sync):
+        delay = sync - time.time()
+        if delay <= 0.0:
+            raise ValueError('Sync time in past')
+        if delay > self.spin_time:
+            time.sleep(delay - self.spin_time)
+        while time.time() < sync:
+            pass
+
+    def do_record(self, segment=10.0, bitrate=17000000, sync=None):
+        segment = float(segment)
+        bitrate = int(bitrate)
+        sync = float(sync) if sync else None
+        if segment <= 0.0:
+            raise ValueError('Invalid segment length %f' % segment)
+        if bitrate <= 0:
+            raise ValueError('Invalid bitrate %d' % bitrate)
+        # Recording uses its own splitter port, hence may proceed while the
+        # camera is armed or previewing
+        if self.server.recording:
+            raise ValueError('Camera is already recording')
+        if sync is not None:
+            self.wait_until(sync)
+        logging.info(
+            'Recording %.1fs segments at %dbps', segment, bitrate)
+        self.server.recording = Recording(
+            self.server.camera, self.server.images, segment, bitrate)
+        return 'TIMESTAMP %f' % self.server.recording.started
 
-    def do_send(self, image, port):
+    def do_stop(self):
+        if self.server.recording:
+            logging.info('Stopping recording')
+            try:
+                self.server.recording.close()
+            finally:
+                self.server.recording = None
+
+    def do_arm(self, frames=3):
+        frames = int(frames)
+        if frames < 1:
+            raise ValueError('Invalid number of frames %d' % frames)
+        if self.server.armed:
+            self.server.armed.close()
+        logging.info('Arming camera with %d frame buffer', frames)
+        self.server.armed = ArmedCapture(self.server.camera, frames)
+
+    def do_disarm(self):
+        if self.server.armed:
+            logging.info('Disarming camera')
+            self.server.armed.close()
+            self.server.armed = None
+
+    def do_trigger(self, timestamp=None):
+        if not self.server.armed:
+            raise ValueError('Camera is not armed')
+        # Without a timestamp, the frame closest to the command's receipt is
+        # taken (the command may have waited in the worker's queue since)
+        timestamp = float(timestamp) if timestamp else self.received
+        image = self.server.armed.take(self.server.images, timestamp)
+        logging.info('Triggered image %d', image.index)
+        return 'TIMESTAMP %f' % image.timestamp
+
+    def do_preview(
+            self, action, port=None, width=None, height=None, framerate=None,
+            bitrate=None, quality=None):
+        if action == 'START':
+            if quality is None:
+                raise ValueError('Missing PREVIEW parameters')
+            port = int(port)
+            resolution = (int(width), int(height))
+            framerate = float(framerate)
+            bitrate = int(bitrate)
+            quality = int(quality)
+            if framerate <= 0.0:
+                raise ValueError('Invalid preview framerate %f' % framerate)
+            if bitrate <= 0:
+                raise ValueError('Invalid preview bitrate %d' % bitrate)
+            if not 1 <= quality <= 100:
+                raise ValueError('Invalid preview quality %d' % quality)
+            self.stop_preview()
+            logging.info(
+                'Starting %dx%d preview at %.1ffps, %dbps, quality %d',
+                resolution[0], resolution[1], framerate, bitrate, quality)
+            self.server.preview = PreviewStream(
+                self.server.camera, (self.client_address[0], port),
+                resolution, framerate, bitrate, quality)
+        elif action == 'STOP':
+            self.stop_preview()
+        else:
+            raise ValueError('Invalid PREVIEW action %s' % action)
+
+    def stop_preview(self):
+        if self.server.preview:
+            logging.info('Stopping preview')
+            self.server.preview.close()
+            self.server.preview = None
+
+    def do_send(self, image, port, offset=0, length=0, clear=0):
         image = int(image)
         port = int(port)
-        timestamp, stream = self.server.images[image]
-        size = stream.seek(0, io.SEEK_END)
-        logging.info('Sending image %d', image)
-        client_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_sock.connect((self.client_address[0], port))
-        client_file = client_sock.makefile('wb')
+        offset = int(offset)
+        length = int(length)
+        clear = bool(int(clear))
+        stored = self.server.images[image]
+        if not stored.complete:
+            raise ValueError('Image %d is still being recorded' % image)
+        size = stored.size
+        # A length of 0 requests the remainder of the image from offset
+        if not 0 <= offset <= size:
+            raise ValueError('Invalid offset %d for image %d' % (offset, image))
+        if not length:
+            length = size - offset
+        elif not 0 < length <= size - offset:
+            raise ValueError('Invalid length %d for image %d' % (length, image))
+        # The checksum of the whole image was calculated as it was captured;
+        # only partial ranges require a pass over the data to calculate theirs
+        if length == size:
+            checksum = stored.checksum
+        else:
+            checksum = self.range_checksum(stored.stream, offset, length)
+        logging.info(
+            'Sending image %d (bytes %d-%d)', image, offset, offset + length)
+        start = time.time()
+        with self.data_connection(port) as client_sock:
+            self.send_image(
+                client_sock, stored, offset, length, checksum, clear)
+        elapsed = max(time.time() - start, 1e-6)
+        logging.info(
+            'Sent image %d (%d bytes) in %.3fs (%.2fMB/s)',
+            image, length, elapsed, length / elapsed / 1000000)
+
+    def do_sendall(self, port, indexes=None, clear=0):
+        port = int(port)
+        clear = bool(int(clear))
+        images = [image for image in self.server.images if image.complete]
+        if indexes is not None:
+            ranges = self.parse_indexes(indexes)
+            images = [
+                image for image in images
+                if any(start <= image.index <= finish for start, finish in ranges)
+                ]
+            # Every image requested must be present, as the client will be
+            # waiting for it. Each range is only walked as far as its first
+            # missing index, so the walk is bounded by the number of images
+            # rather than the (client supplied) size of the range
+            present = {image.index for image in images}
+            for start, finish in ranges:
+                index = start
+                while index <= finish and index in present:
+                    index += 1
+                if index <= finish:
+                    raise ValueError(
+                        'Image %d is missing or incomplete' % index)
+        logging.info('Sending %d images', len(images))
+        start = time.time()
+        size = 0
+        with self.data_connection(port) as client_sock:
+            for image in images:
+                self.send_image(
+                    client_sock, image, 0, image.size, image.checksum, clear)
+                size += image.size
+        elapsed = max(time.time() - start, 1e-6)
+        logging.info(
+            'Sent %d images (%d bytes) in %.3fs (%.2fMB/s)',
+            len(images), size, elapsed, size / elapsed / 1000000)
+
+    @contextmanager
+    def data_connection(self, port):
+        # Yields a connection to the client over which images may be sent. If
+        # *port* is 0, this is the data channel opened by the client;
+        # otherwise the server connects to *port* on the client for the
+        # duration of the transfer
+        if port:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                sock.connect((self.client_address[0], port))
+                yield sock
+            finally:
+                sock.close()
+        else:
+            channel = self.server.channel
+            try:
+                peer = channel.getpeername()[0]
+            except (AttributeError, socket.error):
+                peer = None
+            if peer != self.client_address[0]:
+                raise ValueError('No data channel from %s' % self.client_address[0])
+            try:
+                yield channel
+            except:
+                # A failed transfer leaves the channel part way through a
+                # frame, hence it cannot be used again
+                self.server.close_channel(channel)
+                raise
+
+    def send_image(self, sock, image, offset, length, checksum, clear):
+        # Send a frame consisting of a header, the specified range of the
+        # stored *image*, and a trailer containing the range's *checksum*. If
+        # *clear* is set, the image is removed once the client acknowledges
+        # receipt
+        sock.sendall(SEND_HEADER.pack(image.index, image.size, offset, length))
+        self.send_stream(sock, image.stream, offset, length)
+        sock.sendall(SEND_TRAILER.pack(checksum))
+        acked = clear and self.receive_ack(sock, checksum)
+        # Only a transfer reaching the end of the image completes it (the
+        # client is assumed to have retrieved earlier ranges)
+        if offset + length == image.size:
+            image.sent = True
+            if acked:
+                logging.info('Clearing image %d', image.index)
+                self.server.images.clear({image.index})
+
+    def receive_ack(self, sock, checksum):
+        # Waits for the client to confirm receipt of a transfer by echoing
+        # its *checksum*; returns False if the client disconnects, times out,
+        # or echoes the wrong checksum
+        sock.settimeout(self.send_ack_timeout)
+        ack = b''
         try:
-            client_file.write(struct.pack(native_str('>L'), size))
-            client_file.flush()
-            stream.seek(0)
-            shutil.copyfileobj(stream, client_file)
+            while len(ack) < SEND_TRAILER.size:
+                data = sock.recv(SEND_TRAILER.size - len(ack))
+                if not data:
+                    break
+                ack += data
+        except socket.error as e:
+            logging.warning('Failed to receive transfer ack: %s', e)
         finally:
-            client_file.close()
-            client_sock.close()
+            # The data channel persists beyond this transfer
+            sock.settimeout(None)
+        if len(ack) < SEND_TRAILER.size and sock is self.server.channel:
+            # A late ack would be mistaken for the next one, so the channel
+            # cannot be used again
+            self.server.close_channel(sock)
+        return ack == SEND_TRAILER.pack(checksum)
+
+    def range_checksum(self, stream, offset, length):
+        # Returns the CRC32 of *length* bytes of *stream* from *offset*
+        result = 0
+        stream.seek(offset)
+        while length:
+            data = stream.read(min(length, 1048576))
+            if not data:
+                break
+            result = zlib.crc32(data, result)
+            length -= len(data)
+        return result & 0xFFFFFFFF
+
+    def send_stream(self, sock, stream, offset, length):
+        # Send the specified range of stream with as little copying as the
+        # stream permits: streams backed by a file are sent by the kernel with
+        # sendfile (where available), in-memory streams are sent directly
+        # from their buffer, and anything else is read in bounded chunks
+        try:
+            fileno = stream.fileno()
+        except (AttributeError, IOError, OSError):
+            fileno = None
+        if fileno is not None and hasattr(os, 'sendfile'):
+            end = offset + length
+            while offset < end:
+                sent = os.sendfile(sock.fileno(), fileno, offset, end - offset)
+                if not sent:
+                    break
+                offset += sent
+        elif hasattr(stream, 'getbuffer'):
+            view = stream.getbuffer()
+            if isinstance(view, memoryview):
+                part = view[offset:offset + length]
+            else:
+                # Python 2's old-style buffers copy when sliced
+                part = buffer(view, offset, length)
+            try:
+                sock.sendall(part)
+            finally:
+                # Release the views (where they support this) as an exported
+                # BytesIO buffer cannot be resized
+                for v in (part, view):
+                    if hasattr(v, 'release'):
+                        v.release()
+        elif hasattr(stream, 'getvalue'):
+            # Slicing the value with a buffer avoids copying the range again
+            sock.sendall(buffer(stream.getvalue(), offset, length))
+        else:
+            stream.seek(offset)
+            while length:
+                data = stream.read(min(length, 1048576))
+                if not data:
+                    break
+                sock.sendall(data)
+                length -= len(data)
 
     def do_list(self):
-        for timestamp, stream in self.server.images:
-            stream.seek(0, io.SEEK_END)
         return '\n'.join(
-            'IMAGE %d %f %d' % (index, timestamp, stream.tell())
-            for (index, (timestamp, stream)) in enumerate(self.server.images)
+            'IMAGE %d %f %d%s' % (
+                image.index, image.timestamp, image.size,
+                self.list_attrs(image))
+            for image in self.server.images
             )
 
-    def do_clear(self):
-        logging.info('Clearing images')
-        del self.server.images[:]
+    def list_attrs(self, image):
+        # Attributes other than the checksum are only listed where they differ
+        # from the default for a still image
+        result = ''
+        if image.complete:
+            result += ' crc32=%08x' % image.checksum
+        if image.trigger is not None:
+            result += ' trigger=%f' % image.trigger
+        if image.format != 'jpeg':
+            result += ' format=%s' % image.format
+        if image.duration is not None:
+            result += ' duration=%f' % image.duration
+        return result
+
+    def do_clear(self, indexes=None):
+        if indexes is None:
+            logging.info('Clearing images')
+            self.server.images.clear()
+        else:
+            ranges = self.parse_indexes(indexes)
+            indexes = {
+                image.index for image in self.server.images
+                if any(start <= image.index <= finish for start, finish in ranges)
+                }
+            logging.info('Clearing %d images', len(indexes))
+            self.server.images.clear(indexes)
+
+    def parse_indexes(self, spec):
+        # Parses a comma-separated list of indexes and inclusive ranges of
+        # indexes (e.g. "0,3-5,9") into a list of (start, finish) tuples
+        result = []
+        try:
+            for item in spec.split(','):
+                if '-' in item:
+                    start, finish = (int(i) for i in item.split('-', 1))
+                else:
+                    start = finish = int(item)
+                if not 0 <= start <= finish:
+                    raise ValueError()
+                result.append((start, finish))
+        except ValueError:
+            raise ValueError('Invalid image indexes %s' % spec)
+        return result
 
 
 main = CompoundPiServer()
@@ -0,0 +1,395 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+
+# Copyright 2014 Dave Hughes <dave@waveform.org.uk>.
+#
+# This file is part of compoundpi.
+#
+# compoundpi is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# compoundpi is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# compoundpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"Implements the image store used by the Compound Pi server"
+
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    print_function,
+    division,
+    )
+str = type('')
+
+
+import io
+import os
+import mmap
+import zlib
+import tempfile
+import threading
+import logging
+from collections import OrderedDict, deque
+
+
+class StoredImage(object):
+    """
+    Represents a single image held by an :class:`ImageStore`.
+
+    The *index* is the number the image is identified by in the protocol,
+    *timestamp* is the time at which the image was captured, *stream* is the
+    file-like object containing the image data, and *backend* is the backend
+    which created the stream. The optional *trigger* is the time of the
+    trigger (e.g. a GPIO edge) the image was taken in response to, if any. The
+    optional *format* is the format of the data (``'jpeg'`` for still images,
+    or ``'h264'`` for segments of a video recording). The :attr:`duration`
+    attribute holds the length in seconds of a video segment once it is
+    complete, and the :attr:`sent` attribute is set once the image has been
+    successfully sent to a client.
+
+    Image data should be written with :meth:`write` (the instance can be
+    handed to the camera as an output in place of its stream) so that the
+    image's :attr:`checksum` is calculated as the data arrives.
+    """
+
+    def __init__(
+            self, index, timestamp, stream, backend, trigger=None,
+            format='jpeg'):
+        self.index = index
+        self.timestamp = timestamp
+        self.stream = stream
+        self.backend = backend
+        self.trigger = trigger
+        self.format = format
+        self.duration = None
+        self.sent = False
+        self._size = None
+        self._checksum = 0
+
+    @property
+    def size(self):
+        """
+        Returns the size of the image in bytes. While the image is being
+        written this is the number of bytes written so far.
+        """
+        if self._size is None:
+            return self.stream.tell()
+        return self._size
+
+    @property
+    def checksum(self):
+        """
+        Returns the CRC32 of the data written to the image (as an unsigned
+        integer).
+        """
+        return self._checksum & 0xFFFFFFFF
+
+    @property
+    def complete(self):
+        """
+        Returns ``True`` once the image has been completely written.
+        """
+        return self._size is not None
+
+    def write(self, data):
+        """
+        Writes *data* to the image's stream, updating its :attr:`checksum`.
+        """
+        result = self.stream.write(data)
+        self._checksum = zlib.crc32(data, self._checksum)
+        return result
+
+    def flush(self):
+        self.stream.flush()
+
+    def finish(self):
+        """
+        Called when the image has been completely written to fix its size.
+        """
+        self.stream.flush()
+        self._size = self.stream.seek(0, io.SEEK_END)
+
+    def close(self):
+        self.backend.close(self.stream)
+
+
+class MemoryBackend(object):
+    """
+    Image store backend which keeps images in RAM. The optional *limit*
+    specifies the number of bytes the backend may hold (0 means unlimited).
+    """
+
+    kind = 'memory'
+
+    def __init__(self, limit=0):
+        self.limit = limit
+
+    def available(self, used):
+        return not self.limit or used < self.limit
+
+    def open(self):
+        return io.BytesIO()
+
+    def close(self, stream):
+        stream.close()
+
+
+class FileBackend(object):
+    """
+    Image store backend which keeps images in anonymous files under *path*
+    (typically a tmpfs mount, or a directory on the SD card). The optional
+    *limit* specifies the number of bytes the backend may hold (0 means
+    unlimited).
+    """
+
+    kind = 'disk'
+
+    def __init__(self, path, limit=0):
+        self.path = path
+        self.limit = limit
+
+    def available(self, used):
+        return not self.limit or used < self.limit
+
+    def open(self):
+        # The file is unlinked immediately so that its space is reclaimed
+        # automatically when it is closed, or when the server terminates
+        fd, filename = tempfile.mkstemp(prefix='cpid-', dir=self.path)
+        os.unlink(filename)
+        return io.open(fd, 'w+b')
+
+    def close(self, stream):
+        stream.close()
+
+
+class RingBackend(object):
+    """
+    Image store backend which keeps images in a ring of *slots* fixed-size
+    slots, each *slot_size* bytes long, within a single anonymous memory map
+    allocated up front. This keeps the server's memory usage constant
+    regardless of the number of images captured, and permits images to be
+    sent directly from the map. Images larger than *slot_size* cannot be
+    stored; the write which exceeds the slot raises :exc:`IOError`.
+    """
+
+    kind = 'memory'
+
+    def __init__(self, slots, slot_size):
+        self.slot_size = slot_size
+        self.limit = slots * slot_size
+        self.map = mmap.mmap(-1, self.limit)
+        self._free = deque(range(slots))
+
+    def available(self, used):
+        return bool(self._free)
+
+    def open(self):
+        return SlotStream(self, self._free.popleft())
+
+    def close(self, stream):
+        if not stream.closed:
+            stream.closed = True
+            self._free.append(stream.slot)
+
+
+class SlotStream(object):
+    """
+    A minimal file-like object representing the content of *slot* within the
+    memory map of the :class:`RingBackend` *ring*.
+    """
+
+    def __init__(self, ring, slot):
+        self.ring = ring
+        self.slot = slot
+        self.offset = slot * ring.slot_size
+        self.length = 0
+        self.closed = False
+        self._pos = 0
+
+    def write(self, data):
+        size = len(data)
+        if self._pos + size > self.ring.slot_size:
+            raise IOError('Image exceeds ring slot size')
+        start = self.offset + self._pos
+        self.ring.map[start:start + size] = data
+        self._pos += size
+        self.length = max(self.length, self._pos)
+        return size
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.length - self._pos
+        size = max(0, min(size, self.length - self._pos))
+        start = self.offset + self._pos
+        self._pos += size
+        return self.ring.map[start:start + size]
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.length
+        self._pos = max(0, offset)
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def getbuffer(self):
+        """
+        Returns a view of the slot's content without copying it.
+        """
+        try:
+            view = memoryview(self.ring.map)
+        except TypeError:
+            # Python 2's mmap only supports the old buffer protocol
+            return buffer(self.ring.map, self.offset, self.length)
+        return view[self.offset:self.offset + self.length]
+
+    def close(self):
+        self.ring.close(self)
+
+
+class ImageStore(object):
+    """
+    Stores the images captured by the server.
+
+    The *backends* parameter is a sequence of backends (see
+    :class:`MemoryBackend`, :class:`RingBackend`, and :class:`FileBackend`) in
+    order of preference; new images are written to the first backend with
+    space remaining, so a store consisting of a memory backend followed by a
+    file backend spills images to disk once its RAM budget is exhausted. When
+    all backends are full, *policy* determines the outcome: ``'refuse'``
+    causes :meth:`create` to raise :exc:`IOError`, while ``'evict'`` discards
+    the oldest images that have already been sent to the client until space
+    is available (raising :exc:`IOError` only if no sent images remain).
+
+    Limits are checked before each image is written, so a backend may exceed
+    its limit by at most one image.
+
+    Images are identified by an index which is assigned sequentially from 0,
+    and never re-used for the lifetime of the store (so that a client cannot
+    mistake a new image for one it listed earlier). The store can be iterated
+    over to obtain its :class:`StoredImage` instances in index order, and
+    indexed to obtain a specific image.
+    """
+
+    policies = ('refuse', 'evict')
+
+    def __init__(self, backends=None, policy='refuse'):
+        if backends is None:
+            backends = [MemoryBackend()]
+        if policy not in self.policies:
+            raise ValueError('Invalid store policy %s' % policy)
+        self.backends = list(backends)
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._images = OrderedDict()
+        self._index = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._images)
+
+    def __iter__(self):
+        with self._lock:
+            images = list(self._images.values())
+        return iter(images)
+
+    def __getitem__(self, index):
+        with self._lock:
+            try:
+                return self._images[index]
+            except KeyError:
+                raise IndexError('Invalid image index %d' % index)
+
+    def create(self, timestamp, trigger=None, format='jpeg'):
+        """
+        Returns a new :class:`StoredImage` with the specified *timestamp* (and
+        optional *trigger* time and *format*), with a stream ready for the
+        image data to be written to it.
+        """
+        with self._lock:
+            while True:
+                for backend in self.backends:
+                    if backend.available(self._used(backend)):
+                        break
+                else:
+                    if self.policy == 'evict' and self._evict():
+                        continue
+                    raise IOError('Image store is full')
+                break
+            image = StoredImage(
+                self._index, timestamp, backend.open(), backend, trigger,
+                format)
+            self._images[image.index] = image
+            self._index += 1
+            return image
+
+    def remove(self, index):
+        """
+        Removes the image with the specified *index* from the store.
+        """
+        with self._lock:
+            try:
+                image = self._images.pop(index)
+            except KeyError:
+                raise IndexError('Invalid image index %d' % index)
+        image.close()
+
+    def clear(self, indexes=None):
+        """
+        Removes all images from the store, except those which are still being
+        written (e.g. the current segment of a video recording). If *indexes*
+        is specified, only images with those indexes are removed; indexes
+        which are not present in the store are ignored.
+        """
+        with self._lock:
+            images = [
+                image for image in self._images.values()
+                if image.complete and (
+                    indexes is None or image.index in indexes)
+                ]
+            for image in images:
+                del self._images[image.index]
+        for image in images:
+            image.close()
+
+    def usage(self, kind):
+        """
+        Returns a ``(used, limit)`` tuple giving the number of bytes used, and
+        the limit in bytes (0 if unlimited) of all backends of the specified
+        *kind* (``'memory'`` or ``'disk'``).
+        """
+        with self._lock:
+            backends = [b for b in self.backends if b.kind == kind]
+            used = sum(self._used(backend) for backend in backends)
+        if all(backend.limit for backend in backends):
+            limit = sum(backend.limit for backend in backends)
+        else:
+            limit = 0
+        return used, limit
+
+    def _used(self, backend):
+        return sum(
+            image.size
+            for image in self._images.values()
+            if image.backend is backend
+            )
+
+    def _evict(self):
+        for image in self._images.values():
+            if image.sent:
+                logging.info('Evicting image %d', image.index)
+                del self._images[image.index]
+                image.close()
+                return True
+        return False
@@ -43,6 +43,7 @@ from .configure_dialog import ConfigureDialog
 from .capture_dialog import CaptureDialog
 from .add_dialog import AddDialog
 from .progress_dialog import ProgressDialog
+from .preview_window import PreviewWindow
 
 
 class MainWindow(QtGui.QMainWindow):
@@ -89,6 +90,7 @@ class MainWindow(QtGui.QMainWindow):
         self.ui.identify_action.setIcon(get_icon('dialog-information'))
         self.ui.configure_action.setIcon(get_icon('preferences-system'))
         self.ui.capture_action.setIcon(get_icon('camera-photo'))
+        self.ui.preview_action.setIcon(get_icon('camera-web'))
         self.ui.copy_action.setIcon(get_icon('edit-copy'))
         self.ui.clear_action.setIcon(get_icon('edit-clear'))
         self.ui.export_action.setIcon(get_icon('document-save'))
@@ -105,6 +107,7 @@ class MainWindow(QtGui.QMainWindow):
         self.ui.remove_action.triggered.connect(self.servers_remove)
         self.ui.identify_action.triggered.connect(self.servers_identify)
         self.ui.capture_action.triggered.connect(self.servers_capture)
+        self.ui.preview_action.triggered.connect(self.servers_preview)
         self.ui.configure_action.triggered.connect(self.servers_configure)
         self.ui.copy_action.triggered.connect(self.images_copy)
         self.ui.export_action.triggered.connect(self.images_export)
@@ -243,27 +246,63 @@ The project homepage and documentation is at
                 self.settings.setValue('count', dialog.capture_count)
                 self.settings.setValue('delay', dialog.capture_delay or 0.0)
                 self.settings.setValue('video_port', int(dialog.capture_video_port))
-                self.client.capture(
+                skew = self.client.capture(
                         count=dialog.capture_count,
                         video_port=dialog.capture_video_port,
                         delay=dialog.capture_delay,
                         addresses=self.selected_addresses)
-                responses = self.client.list(self.selected_addresses)
+                if skew:
+                    self.statusBar().showMessage(
+                        'Capture skew: spread %.2fms, stdev %.2fms' % (
+                            skew.spread * 1000, skew.stdev * 1000))
+                # Only complete still images are retrieved; recording
+                # segments (including the one still being written) are left
+                # on the servers
+                responses = {
+                    address: [
+                        image for image in images
+                        if image.format == 'jpeg' and
+                        image.checksum is not None
+                        ]
+                    for (address, images) in self.client.list(
+                        self.selected_addresses).items()
+                    }
+                streams = {
+                    (address, image.index): io.BytesIO()
+                    for (address, images) in responses.items()
+                    for image in images
+                    }
+                results = self.client.download_many({
+                    address: [
+                        (image.index, streams[(address, image.index)])
+                        for image in images
+                        ]
+                    for (address, images) in responses.items()
+                    })
                 for (address, images) in responses.items():
                     for image in images:
-                        stream = io.BytesIO()
-                        self.client.download(address, image.index, stream)
+                        stream = streams[(address, image.index)]
                         if stream.tell() != image.size:
                             raise IOError('Incorrect download size')
+                        if results[(address, image.index)].checksum != image.checksum:
+                            raise IOError('Incorrect download checksum')
                         self.images[address][image.timestamp] = stream
                 # XXX Check ordering of self.images[address]
                 # XXX Rollback in the case of a partial download...
-                self.client.clear(self.selected_addresses)
+                with self.client.pipeline():
+                    for (address, images) in responses.items():
+                        if images:
+                            self.client.clear(
+                                [address], [image.index for image in images])
                 self.ui.server_list.model().refresh_selected()
                 self.ui.image_list.model().refresh()
         finally:
             self.settings.endGroup()
 
+    def servers_preview(self):
+        window = PreviewWindow(self.client, self.selected_addresses, self)
+        window.show()
+
     def servers_configure(self):
         settings = {
             attr: set(getattr(status, attr) for (addr, status) in self.selected_servers)
@@ -296,67 +335,45 @@ The project homepage and documentation is at
             setattr(dialog, attr, value)
         if dialog.exec_():
             try:
-                if dialog.resolution != settings['resolution']:
-                    self.client.resolution(
-                            *dialog.resolution,
-                            addresses=self.selected_addresses)
-                if dialog.framerate != settings['framerate']:
-                    self.client.framerate(
-                            dialog.framerate,
-                            addresses=self.selected_addresses)
-                if dialog.agc_mode != settings['agc_mode']:
-                    self.client.agc(
-                            dialog.agc_mode,
-                            addresses=self.selected_addresses)
-                if (dialog.awb_mode != settings['awb_mode']) or (
-                        dialog.awb_mode == 'off' and (
-                            dialog.awb_red != settings['awb_red'] or
-                            dialog.awb_blue != settings['awb_blue']
-                            )):
-                    self.client.awb(
-                            dialog.awb_mode,
-                            dialog.awb_red,
-                            dialog.awb_blue,
-                            addresses=self.selected_addresses)
-                if (dialog.exposure_mode != settings['exposure_mode']) or (
+                changes = {
+                    attr: getattr(dialog, attr)
+                    for attr in (
+                        'resolution',
+                        'framerate',
+                        'agc_mode',
+                        'awb_mode',
+                        'exposure_mode',
+                        'metering_mode',
+                        'iso',
+                        'brightness',
+                        'contrast',
+                        'saturation',
+                        'ev',
+                        )
+                    if getattr(dialog, attr) != settings[attr]
+                    }
+                if dialog.awb_mode == 'off' and (
+                        dialog.awb_red != settings['awb_red'] or
+                        dialog.awb_blue != settings['awb_blue']
+                        ):
+                    changes['awb_mode'] = dialog.awb_mode
+                    changes['awb_red'] = dialog.awb_red
+                    changes['awb_blue'] = dialog.awb_blue
+                if (
                         dialog.exposure_mode == 'off' and
                         dialog.exposure_speed != settings['exposure_speed']
                         ):
-                    self.client.exposure(
-                            dialog.exposure_mode,
-                            dialog.exposure_speed,
-                            addresses=self.selected_addresses)
-                if dialog.metering_mode != settings['metering_mode']:
-                    self.client.metering(
-                            dialog.metering_mode,
-                            addresses=self.selected_addresses)
-                if dialog.iso != settings['iso']:
-                    self.client.iso(
-                            dialog.iso,
-                            addresses=self.selected_addresses)
-                if dialog.brightness != settings['brightness']:
-                    self.client.brightness(
-                            dialog.brightness,
-                            addresses=self.selected_addresses)
-                if dialog.contrast != settings['contrast']:
-                    self.client.contrast(
-                            dialog.contrast,
-                            addresses=self.selected_addresses)
-                if dialog.saturation != settings['saturation']:
-                    self.client.saturation(
-                            dialog.saturation,
-                            addresses=self.selected_addresses)
-                if dialog.ev != settings['ev']:
-                    self.client.ev(
-                            dialog.ev,
-                            addresses=self.selected_addresses)
+                    changes['exposure_mode'] = dialog.exposure_mode
+                    changes['exposure_speed'] = dialog.exposure_speed
                 if (
                         dialog.hflip != settings['hflip'] or
                         dialog.vflip != settings['vflip']
                         ):
-                    self.client.flip(
-                            dialog.hflip, dialog.vflip,
-                            addresses=self.selected_addresses)
+                    changes['hflip'] = dialog.hflip
+                    changes['vflip'] = dialog.vflip
+                if changes:
+                    self.client.configure(
+                            addresses=self.selected_addresses, **changes)
             finally:
                 self.ui.server_list.model().refresh_selected(update=True)
 
@@ -452,6 +469,7 @@ The project homepage and documentation is at
         self.ui.remove_action.setEnabled(has_selection)
         self.ui.identify_action.setEnabled(has_selection)
         self.ui.capture_action.setEnabled(has_selection)
+        self.ui.preview_action.setEnabled(has_selection)
         self.ui.configure_action.setEnabled(has_selection)
         self.ui.refresh_action.setEnabled(has_rows)
         self.ui.image_list.model().refresh()
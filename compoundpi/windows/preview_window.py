@@ -0,0 +1,85 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+
+# Copyright 2014 Dave Hughes <dave@waveform.org.uk>.
+#
+# This file is part of compoundpi.
+#
+# compoundpi is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# compoundpi is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# compoundpi.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    print_function,
+    division,
+    )
+str = type('')
+
+import math
+
+from . import get_ui_file
+from ..qt import QtCore, QtGui, loadUi
+
+
+class PreviewWindow(QtGui.QWidget):
+    "Implements the live preview window"
+
+    # The number of milliseconds between refreshes of the tiles
+    refresh_interval = 100
+
+    def __init__(self, client, addresses, parent=None):
+        super(PreviewWindow, self).__init__(parent, QtCore.Qt.Window)
+        self.setAttribute(QtCore.Qt.WA_DeleteOnClose)
+        self.ui = loadUi(get_ui_file('preview_window.ui'), self)
+        self.client = client
+        self.addresses = sorted(addresses)
+        self.previews = client.preview(addresses=self.addresses)
+        # Arrange the tiles in a grid that is as close to square as possible
+        columns = max(1, int(math.ceil(math.sqrt(len(self.addresses)))))
+        self.tiles = {}
+        self.shown = {}
+        for index, address in enumerate(self.addresses):
+            tile = QtGui.QLabel(str(address))
+            tile.setAlignment(QtCore.Qt.AlignCenter)
+            tile.setMinimumSize(160, 120)
+            tile.setSizePolicy(
+                QtGui.QSizePolicy.Ignored, QtGui.QSizePolicy.Ignored)
+            tile.setFrameShape(QtGui.QFrame.Box)
+            self.ui.tiles_layout.addWidget(
+                tile, index // columns, index % columns)
+            self.tiles[address] = tile
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(self.refresh_interval)
+
+    def refresh(self):
+        for address, tile in self.tiles.items():
+            preview = self.previews[address]
+            frame = preview.frame
+            # Only decode frames which have changed since the last refresh
+            if frame is None or frame is self.shown.get(address):
+                continue
+            self.shown[address] = frame
+            timestamp, data = frame
+            image = QtGui.QImage.fromData(data, 'JPEG')
+            if not image.isNull():
+                tile.setPixmap(QtGui.QPixmap.fromImage(image).scaled(
+                    tile.size(), QtCore.Qt.KeepAspectRatio,
+                    QtCore.Qt.SmoothTransformation))
+                tile.setToolTip('%s: %s (%.1fKB/s)' % (
+                    address, timestamp.strftime('%H:%M:%S.%f'),
+                    preview.rate / 1000))
+
+    def closeEvent(self, event):
+        self.timer.stop()
+        self.client.unpreview(self.addresses)
+        super(PreviewWindow, self).closeEvent(event)
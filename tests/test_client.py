@@ -0,0 +1,599 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Copyright 2014 Dave Hughes <dave@waveform.org.uk>.
+#
+# This file is part of compoundpi.
+#
+# compoundpi is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# compoundpi is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# compoundpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"A project for controlling multiple Pi camera modules simultaneously"
+
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    print_function,
+    division,
+    )
+str = type('')
+
+
+import io
+import time
+import socket
+import threading
+import zlib
+
+import pytest
+from mock import Mock, patch, call
+
+import compoundpi.client
+import compoundpi.exc
+from compoundpi.client import IPv4Address
+from compoundpi.common import SEND_TRAILER
+
+
+def create_client(cls=compoundpi.client.CompoundPiClient):
+    # Returns a client whose retransmissions and download server are mocked
+    # out
+    with patch.object(compoundpi.client, 'NetworkRepeater'), \
+            patch.object(compoundpi.client, 'CompoundPiDownloadServer'):
+        client = cls()
+    client._server.socket.getsockname.return_value = ('0.0.0.0', 5647)
+    return client
+
+def mock_client(*servers):
+    # Returns a client, defining the specified server addresses, whose socket
+    # is replaced by a mock
+    client = create_client()
+    client.network = '192.168.0.0/24'
+    client._servers = {IPv4Address(address) for address in servers}
+    client._socket = Mock()
+    return client
+
+def loopback_client(cls=compoundpi.client.CompoundPiClient):
+    # Returns a client listening on a loopback port, and a socket through
+    # which a "server" on another loopback port can respond to it
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    server.settimeout(1)
+    client = create_client(cls)
+    client.network = '127.0.0.0/24'
+    client.port = server.getsockname()[1]
+    client._servers = {IPv4Address('127.0.0.1')}
+    client._socket.bind(('127.0.0.1', 0))
+    return client, server
+
+def reply(client, server, data):
+    # Sends *data* from *server* to *client*
+    server.sendto(data.encode('utf-8'), client._socket.getsockname())
+
+def response(client, address, data):
+    # Feeds *data* to *client* as a datagram received from *address*
+    client._socket.recvfrom.return_value = (
+        data.encode('utf-8'), (str(address), client.port))
+    client._receive()
+
+def test_future_expiry():
+    client = mock_client()
+    future = compoundpi.client.CompoundPiFuture(
+        client, 1, {IPv4Address('192.168.0.1')}, 1, None, 100.0)
+    assert future.expiry() == 100.0
+    future._last = 10.0
+    assert future.expiry() == 100.0
+
+def test_future_expiry_quiet():
+    client = mock_client()
+    future = compoundpi.client.CompoundPiFuture(
+        client, 1, {IPv4Address('192.168.0.1')}, 1, None, 100.0, quiet=1.0)
+    # No response yet, so the future waits for the deadline
+    assert future.expiry() == 100.0
+    future._last = 10.0
+    assert future.expiry() == 11.0
+    # Long gaps between responses extend the quiet period
+    future._gap = 2.0
+    assert future.expiry() == 16.0
+    # ...but never beyond the deadline
+    future._last = 99.0
+    assert future.expiry() == 100.0
+
+def test_future_complete_on_count():
+    client = mock_client('192.168.0.1', '192.168.0.2')
+    future = client._transact_async('STATUS')
+    assert future.count == 2
+    response(client, '192.168.0.1', '%d OK\nfoo' % future.seqno)
+    assert not future.done()
+    response(client, '192.168.0.2', '%d OK\nbar' % future.seqno)
+    assert future.done()
+    assert future.seqno not in client._pending
+    assert future._responses == {
+        IPv4Address('192.168.0.1'): 'foo',
+        IPv4Address('192.168.0.2'): 'bar',
+        }
+    assert future.errors == []
+
+def test_future_fragments_out_of_order():
+    client = mock_client('192.168.0.1')
+    future = client._transact_async('LIST')
+    response(client, '192.168.0.1', '%d OK 2/3\nbaz' % future.seqno)
+    response(client, '192.168.0.1', '%d OK 0/3\nfoo' % future.seqno)
+    # A repeated fragment (the server didn't see our ACK) simply replaces its
+    # earlier copy
+    response(client, '192.168.0.1', '%d OK 2/3\nbaz' % future.seqno)
+    assert not future.done()
+    response(client, '192.168.0.1', '%d OK 1/3\nbar' % future.seqno)
+    assert future.done()
+    assert future._responses == {IPv4Address('192.168.0.1'): 'foobarbaz'}
+    assert client._socket.sendto.mock_calls == [
+        call('%d ACK 2' % future.seqno, ('192.168.0.1', 5647)),
+        call('%d ACK 0' % future.seqno, ('192.168.0.1', 5647)),
+        call('%d ACK 2' % future.seqno, ('192.168.0.1', 5647)),
+        call('%d ACK 1' % future.seqno, ('192.168.0.1', 5647)),
+        ]
+
+def test_future_multi_response():
+    client = mock_client('192.168.0.1', '192.168.0.2')
+    future = client._transact_async('STATUS')
+    response(client, '192.168.0.1', '%d OK\nfoo' % future.seqno)
+    with pytest.warns(compoundpi.exc.CompoundPiMultiResponse):
+        response(client, '192.168.0.1', '%d OK\nfoo' % future.seqno)
+    assert not future.done()
+
+def test_future_callbacks():
+    client = mock_client('192.168.0.1')
+    future = client._transact_async('STATUS')
+    callback = Mock()
+    future.add_done_callback(callback)
+    assert not callback.called
+    response(client, '192.168.0.1', '%d OK\n' % future.seqno)
+    callback.assert_called_once_with(future)
+    # Callbacks added after completion are called immediately
+    late = Mock()
+    future.add_done_callback(late)
+    late.assert_called_once_with(future)
+
+def test_pipeline_window():
+    client = mock_client('192.168.0.1')
+    client.window = 2
+    waited = []
+    def wait(future, progress=False):
+        waited.append(future.seqno)
+        future._complete()
+        return future
+    client._wait = wait
+    with pytest.raises(compoundpi.exc.CompoundPiTransactionFailed) as exc:
+        with client.pipeline():
+            futures = [client.framerate(30) for i in range(3)]
+            # The third command had to wait for the oldest outstanding
+            # command to make room in the window
+            assert waited == [futures[0].seqno]
+            assert len(client._pending) == 2
+    # Nothing responded, so each command reports a missing response
+    assert len(exc.value.errors) == 3
+    assert not client._pending
+
+def test_pipeline_errors():
+    client = mock_client('192.168.0.1', '192.168.0.2')
+    with pytest.raises(compoundpi.exc.CompoundPiTransactionFailed) as exc:
+        with client.pipeline():
+            first = client.framerate(30)
+            second = client.resolution(1280, 720)
+            assert isinstance(first, compoundpi.client.CompoundPiFuture)
+            response(client, '192.168.0.1', '%d OK\n' % first.seqno)
+            response(client, '192.168.0.2', '%d OK\n' % first.seqno)
+            response(client, '192.168.0.1', '%d OK\n' % second.seqno)
+            response(client, '192.168.0.2', '%d ERROR\nfoo' % second.seqno)
+    assert first.errors == []
+    assert len(exc.value.errors) == 1
+    assert isinstance(
+        exc.value.errors[0], compoundpi.exc.CompoundPiServerError)
+
+def test_network_addresses():
+    addresses = compoundpi.client.NetworkAddresses(
+        compoundpi.client.IPv4Network('10.0.0.0/16'))
+    assert len(addresses) == 65536
+    assert IPv4Address('10.0.0.0') in addresses
+    assert IPv4Address('10.0.255.255') in addresses
+    assert IPv4Address('10.1.0.0') not in addresses
+
+def test_find_count():
+    client = mock_client()
+    with patch.object(client, '_start') as start:
+        client.find_async(3)
+        # An explicit count waits up to the timeout for that many servers
+        assert start.call_args[1] == {'count': 3, 'quiet': 0}
+
+def test_find_quiet():
+    client = mock_client()
+    with patch.object(client, '_start') as start:
+        client.find_async()
+        assert start.call_args[1] == {'count': 0, 'quiet': 1.0}
+
+def test_find_cache(tmpdir):
+    client = mock_client()
+    cache = str(tmpdir.join('servers'))
+    with open(cache, 'w') as f:
+        f.write('192.168.0.1\n192.168.0.2\n10.0.0.1\nfoo\n')
+    with patch.object(client, '_start') as start:
+        # The cached count is merely a guess, so the quiet period still
+        # applies in case servers have disappeared
+        client.find_async(cache=cache)
+        assert start.call_args[1] == {'count': 2, 'quiet': 1.0}
+        client.find_async(5, cache=cache)
+        assert start.call_args[1] == {'count': 5, 'quiet': 0}
+
+def test_find_result(tmpdir):
+    client = mock_client()
+    cache = str(tmpdir.join('servers'))
+    future = client.find_async(2, cache=cache)
+    hello = 'VERSION %s' % compoundpi.client.__version__
+    response(client, '192.168.0.2', '%d OK\n%s' % (future.seqno, hello))
+    response(client, '192.168.0.1', '%d OK\n%s' % (future.seqno, hello))
+    assert future.done()
+    assert client._servers == {
+        IPv4Address('192.168.0.1'), IPv4Address('192.168.0.2')}
+    with open(cache) as f:
+        assert f.read() == '192.168.0.1\n192.168.0.2\n'
+
+def sync_wait(client, exchanges):
+    # Returns a replacement for client._wait which answers each SYNC with the
+    # next of the (sent, server_received, server_sent, received) *exchanges*
+    exchanges = iter(exchanges)
+    def wait(future, progress=False):
+        if not future.done():
+            sent, server_received, server_sent, received = next(exchanges)
+            response(client, '192.168.0.1', '%d OK\nTIMESTAMP %f %f' % (
+                future.seqno, server_received, server_sent))
+            future.sent = sent
+            future.received[IPv4Address('192.168.0.1')] = received
+        return future
+    return wait
+
+def test_sync_offset():
+    client = mock_client('192.168.0.1')
+    # The server's clock is 50s ahead; the first exchange was delayed by 6ms
+    # on the way back (inflating its round trip), the second took 1ms each
+    # way, and both spent 1ms on the server
+    client._wait = sync_wait(client, [
+        (100.000, 150.001, 150.002, 100.008),
+        (200.000, 250.001, 250.002, 200.003),
+        ])
+    clocks = client.sync(samples=2)
+    clock = clocks[IPv4Address('192.168.0.1')]
+    assert clock.offset == pytest.approx(50.0)
+    assert clock.rtt == pytest.approx(0.002)
+    assert clock.updated == 200.003
+    assert client._clocks == clocks
+
+def test_sync_invalid_response():
+    client = mock_client('192.168.0.1')
+    def wait(future, progress=False):
+        if not future.done():
+            response(client, '192.168.0.1', '%d OK\nfoo' % future.seqno)
+        return future
+    client._wait = wait
+    with pytest.raises(compoundpi.exc.CompoundPiTransactionFailed):
+        client.sync(samples=1)
+    assert not client._clocks
+
+def test_synchronized_capture():
+    client = mock_client('192.168.0.1', '192.168.0.2')
+    client._clocks = {
+        IPv4Address('192.168.0.1'): compoundpi.client.CompoundPiClock(
+            offset=50.0, rtt=0.002, updated=time.time()),
+        IPv4Address('192.168.0.2'): compoundpi.client.CompoundPiClock(
+            offset=-1.0, rtt=0.002, updated=time.time()),
+        }
+    future = client.capture_async(delay=0.5)
+    # Each server is sent the target time translated to its own clock
+    times = {
+        destination: float(data.decode('ascii').split()[-1])
+        for (key, destination, data), kwargs
+        in client._repeater.send.call_args_list
+        }
+    assert times[('192.168.0.1', 5647)] - times[('192.168.0.2', 5647)] == (
+        pytest.approx(51.0))
+    # Each server's reported capture time is translated back to the client's
+    # clock to calculate the skew
+    response(client, '192.168.0.1', '%d OK\nTIMESTAMP %f' % (
+        future.seqno, times[('192.168.0.1', 5647)] + 0.001))
+    response(client, '192.168.0.2', '%d OK\nTIMESTAMP %f' % (
+        future.seqno, times[('192.168.0.2', 5647)] - 0.001))
+    client._wait = lambda future, progress=False: future
+    skew = future.result()
+    assert skew[IPv4Address('192.168.0.1')] == pytest.approx(0.001, abs=1e-5)
+    assert skew[IPv4Address('192.168.0.2')] == pytest.approx(-0.001, abs=1e-5)
+    assert skew.spread == pytest.approx(0.002, abs=1e-5)
+
+def mock_socket(data):
+    # Returns a mock socket from which *data* can be received
+    stream = io.BytesIO(data)
+    sock = Mock()
+    def recv_into(buf):
+        chunk = stream.read(len(buf))
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+    sock.recv_into.side_effect = recv_into
+    return sock
+
+def crc(data):
+    return zlib.crc32(data) & 0xFFFFFFFF
+
+def test_transfer_checksum():
+    data = b'x' * 3000
+    output = io.BytesIO()
+    transfer = compoundpi.client.CompoundPiTransfer(
+        IPv4Address('192.168.0.1'), 1, output)
+    transfer.block_size = 1024
+    sock = mock_socket(data + SEND_TRAILER.pack(crc(data)))
+    transfer.receive(sock, len(data), 0, len(data))
+    assert transfer.event.is_set()
+    assert transfer.exception is None
+    assert transfer.checksum == crc(data)
+    assert output.getvalue() == data
+    assert not sock.sendall.called
+
+def test_transfer_checksum_mismatch():
+    data = b'x' * 3000
+    output = io.BytesIO()
+    output.write(b'y' * 1000)
+    transfer = compoundpi.client.CompoundPiTransfer(
+        IPv4Address('192.168.0.1'), 1, output, resume=True)
+    transfer.open()
+    assert transfer.offset == 1000
+    sock = mock_socket(data[1000:] + SEND_TRAILER.pack(crc(b'z')))
+    transfer.receive(sock, len(data), 1000, len(data) - 1000)
+    assert isinstance(
+        transfer.exception, compoundpi.exc.CompoundPiChecksumError)
+    assert transfer.checksum is None
+    # The corrupt range is discarded, leaving the resumed prefix
+    assert output.getvalue() == b'y' * 1000
+
+def test_transfer_checksum_mismatch_clear():
+    data = b'x' * 3000
+    output = io.BytesIO()
+    transfer = compoundpi.client.CompoundPiTransfer(
+        IPv4Address('192.168.0.1'), 1, output, clear=True)
+    sock = mock_socket(data + SEND_TRAILER.pack(crc(b'z')))
+    transfer.receive(sock, len(data), 0, len(data))
+    assert isinstance(
+        transfer.exception, compoundpi.exc.CompoundPiChecksumError)
+    # The server is told the checksum we calculated, which doesn't match its
+    # own, so it keeps the image
+    sock.sendall.assert_called_once_with(SEND_TRAILER.pack(crc(data)))
+    assert output.getvalue() == b''
+
+def test_transfer_clear():
+    data = b'x' * 3000
+    transfer = compoundpi.client.CompoundPiTransfer(
+        IPv4Address('192.168.0.1'), 1, io.BytesIO(), clear=True)
+    sock = mock_socket(data + SEND_TRAILER.pack(crc(data)))
+    transfer.receive(sock, len(data), 0, len(data))
+    assert transfer.exception is None
+    sock.sendall.assert_called_once_with(SEND_TRAILER.pack(crc(data)))
+
+def test_transfer_truncated():
+    data = b'x' * 3000
+    transfer = compoundpi.client.CompoundPiTransfer(
+        IPv4Address('192.168.0.1'), 1, io.BytesIO())
+    transfer.receive(mock_socket(data[:2000]), len(data), 0, len(data))
+    assert isinstance(transfer.exception, compoundpi.exc.CompoundPiServerError)
+    transfer = compoundpi.client.CompoundPiTransfer(
+        IPv4Address('192.168.0.1'), 1, io.BytesIO())
+    transfer.receive(mock_socket(data), len(data), 0, len(data))
+    assert isinstance(transfer.exception, compoundpi.exc.CompoundPiServerError)
+    assert 'missing checksum' in str(transfer.exception)
+
+def test_writer_pool(tmpdir):
+    filenames = [str(tmpdir.join('%d.jpg' % i)) for i in range(3)]
+    with compoundpi.client.CompoundPiWriterPool(threads=2, queue_size=1) as pool:
+        outputs = [pool.open(filename) for filename in filenames]
+        buf = bytearray(b'a' * 100)
+        for i in range(3):
+            for output in outputs:
+                output.write(memoryview(buf))
+            # The pool copies each write, so the caller may re-use its buffer
+            buf[:] = b'b' * 100
+        assert outputs[0].tell() == 300
+        for output in outputs:
+            output.close()
+    assert pool.written == 900
+    for filename in filenames:
+        with io.open(filename, 'rb') as f:
+            assert f.read() == b'a' * 100 + b'b' * 200
+
+def test_writer_pool_error(tmpdir):
+    pool = compoundpi.client.CompoundPiWriterPool(threads=1)
+    with patch.object(compoundpi.client.io, 'open') as m:
+        m.return_value.write.side_effect = IOError('disk full')
+        output = pool.open(str(tmpdir.join('foo.jpg')))
+    output.write(b'foo')
+    with pytest.raises(IOError):
+        output.flush()
+    with pytest.raises(IOError):
+        output.write(b'bar')
+    output.close()
+    with pytest.raises(IOError):
+        pool.close()
+    assert m.return_value.write.call_count == 1
+    m.return_value.close.assert_called_once_with()
+
+def test_download_batch():
+    client = mock_client('192.168.0.1', '192.168.0.2')
+    def transact_each(commands):
+        # Complete every transfer as though its data had arrived
+        for transfer in client._transfers.values():
+            transfer.event.set()
+        return {address: '' for address in commands}, []
+    client._transact_each = Mock(side_effect=transact_each)
+    transfers = [
+        compoundpi.client.CompoundPiTransfer(
+            IPv4Address('192.168.0.1'), 3, io.BytesIO(), clear=True),
+        ] + [
+        compoundpi.client.CompoundPiTransfer(
+            IPv4Address('192.168.0.2'), index, io.BytesIO(), clear=True)
+        for index in (1, 2, 3, 5)
+        ]
+    results, errors = client._download_batch(transfers)
+    # A single image is requested with SEND, several with SENDALL
+    client._transact_each.assert_called_once_with({
+        IPv4Address('192.168.0.1'): 'SEND 3 5647 0 0 1',
+        IPv4Address('192.168.0.2'): 'SENDALL 5647 1-3,5 1',
+        })
+    assert errors == []
+    assert [(r.address, r.index) for r in results] == [
+        (t.address, t.index) for t in transfers]
+    assert client._transfers == {}
+
+def test_download_batch_failed():
+    client = mock_client('192.168.0.1')
+    client.timeout = 0
+    def transact_each(commands):
+        # The first image is streamed before the server fails
+        client._transfers[(IPv4Address('192.168.0.1'), 1)].event.set()
+        return {}, [compoundpi.exc.CompoundPiServerError(
+            IPv4Address('192.168.0.1'), 'foo')]
+    client._transact_each = Mock(side_effect=transact_each)
+    transfers = [
+        compoundpi.client.CompoundPiTransfer(
+            IPv4Address('192.168.0.1'), index, io.BytesIO())
+        for index in (1, 2)
+        ]
+    results, errors = client._download_batch(transfers)
+    assert [r.index for r in results] == [1]
+    assert len(errors) == 1
+    assert isinstance(errors[0], compoundpi.exc.CompoundPiServerError)
+
+def test_async_callback():
+    client, server = loopback_client(compoundpi.client.AsyncCompoundPiClient)
+    with client:
+        future = client._transact_async('STATUS')
+        called = threading.Event()
+        threads = []
+        def callback(f):
+            threads.append(threading.current_thread())
+            called.set()
+        future.add_done_callback(callback)
+        reply(client, server, '%d OK\nfoo' % future.seqno)
+        # The callback is called by the background thread without anything
+        # waiting for the future
+        assert called.wait(1)
+        assert threads == [client._reactor]
+        assert future.result() == {IPv4Address('127.0.0.1'): 'foo'}
+
+def test_async_result():
+    client, server = loopback_client(compoundpi.client.AsyncCompoundPiClient)
+    with client:
+        future = client._transact_async('STATUS')
+        timer = threading.Timer(
+            0.05, reply, args=(client, server, '%d OK\nfoo' % future.seqno))
+        timer.start()
+        try:
+            assert future.result() == {IPv4Address('127.0.0.1'): 'foo'}
+        finally:
+            timer.join()
+        assert client.latencies[-1].seqno == future.seqno
+
+def test_async_wait_in_callback():
+    client, server = loopback_client(compoundpi.client.AsyncCompoundPiClient)
+    with client:
+        first = client._transact_async('STATUS')
+        second = client._transact_async('STATUS')
+        called = threading.Event()
+        errors = []
+        def callback(f):
+            try:
+                second.result()
+            except RuntimeError as e:
+                errors.append(e)
+            finally:
+                called.set()
+        first.add_done_callback(callback)
+        reply(client, server, '%d OK\n' % first.seqno)
+        assert called.wait(1)
+        assert len(errors) == 1
+        assert not second.done()
+
+def test_async_close():
+    client, server = loopback_client(compoundpi.client.AsyncCompoundPiClient)
+    future = client._transact_async('STATUS')
+    callback = Mock()
+    future.add_done_callback(callback)
+    client.close()
+    assert not client._reactor.is_alive()
+    # Outstanding commands are completed with missing responses
+    assert future.done()
+    callback.assert_called_once_with(future)
+    assert len(future.errors) == 1
+    assert isinstance(
+        future.errors[0], compoundpi.exc.CompoundPiMissingResponse)
+    with pytest.raises(compoundpi.exc.CompoundPiTransactionFailed):
+        future.result()
+    client.close()
+
+def test_poll():
+    client, server = loopback_client()
+    assert client._poll(0) == set()
+    reply(client, server, '1 OK\n')
+    assert client._poll(1) == {client._socket.fileno()}
+
+def test_poll_select():
+    client, server = loopback_client()
+    # Where epoll is unavailable, select is used instead
+    client._poller = None
+    assert client._poll(0) == set()
+    reply(client, server, '1 OK\n')
+    assert client._poll(1) == {client._socket.fileno()}
+
+def test_drain():
+    client, server = loopback_client()
+    futures = [client._transact_async('STATUS') for i in range(3)]
+    for future in futures:
+        reply(client, server, '%d OK\n' % future.seqno)
+    assert client._socket.fileno() in client._poll(1)
+    time.sleep(0.05)
+    # A single wakeup dispatches every queued response
+    client._drain()
+    assert all(future.done() for future in futures)
+    acks = sorted(server.recvfrom(100)[0] for future in futures)
+    assert acks == sorted(
+        ('%d ACK' % future.seqno).encode('utf-8') for future in futures)
+
+def test_wait_deadline():
+    client, server = loopback_client()
+    client.timeout = 0.2
+    future = client._transact_async('STATUS')
+    start = time.time()
+    client._wait(future)
+    # The wait ends at the deadline, not at the next poll interval
+    assert 0.15 < time.time() - start < 0.5
+    assert isinstance(
+        future.errors[0], compoundpi.exc.CompoundPiMissingResponse)
+    latency = client.latencies[-1]
+    assert latency.seqno == future.seqno
+    assert latency.response is None
+    assert latency.overhead is None
+
+def test_wait_latency():
+    client, server = loopback_client()
+    future = client._transact_async('STATUS')
+    reply(client, server, '%d OK\n' % future.seqno)
+    client._wait(future)
+    assert future.result() == {IPv4Address('127.0.0.1'): ''}
+    latency = client.latencies[-1]
+    assert latency.seqno == future.seqno
+    assert latency.sent == future.sent
+    assert 0 <= latency.response < 1
+    assert 0 <= latency.overhead < 1
+    # Waiting again doesn't record the transaction twice
+    client._wait(future)
+    assert len(client.latencies) == 1
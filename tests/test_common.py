@@ -0,0 +1,101 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# Copyright 2014 Dave Hughes <dave@waveform.org.uk>.
+#
+# This file is part of compoundpi.
+#
+# compoundpi is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# compoundpi is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# compoundpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"A project for controlling multiple Pi camera modules simultaneously"
+
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    print_function,
+    division,
+    )
+str = type('')
+
+
+import time
+
+from mock import Mock, call
+
+import compoundpi.common
+
+
+def test_repeater_sends_immediately():
+    socket = Mock()
+    repeater = compoundpi.common.NetworkRepeater(socket, interval=10)
+    try:
+        repeater.send(('foo', 1), ('localhost', 1), b'1 OK\n')
+        socket.sendto.assert_called_once_with(b'1 OK\n', ('localhost', 1))
+        assert ('foo', 1) in repeater
+    finally:
+        repeater.close()
+
+def test_repeater_repeats():
+    socket = Mock()
+    repeater = compoundpi.common.NetworkRepeater(socket, interval=0.01)
+    try:
+        repeater.send(('foo', 1), ('localhost', 1), b'1 OK\n')
+        repeater.send(('foo', 2), ('localhost', 2), b'2 OK\n')
+        time.sleep(0.2)
+        assert socket.sendto.call_count > 4
+        assert call(b'1 OK\n', ('localhost', 1)) in socket.sendto.mock_calls
+        assert call(b'2 OK\n', ('localhost', 2)) in socket.sendto.mock_calls
+        assert len(repeater) == 2
+    finally:
+        repeater.close()
+
+def test_repeater_cancel():
+    socket = Mock()
+    repeater = compoundpi.common.NetworkRepeater(socket, interval=0.01)
+    try:
+        repeater.send(('foo', 1), ('localhost', 1), b'1 OK\n')
+        assert repeater.cancel(('foo', 1))
+        assert not repeater.cancel(('foo', 1))
+        assert not repeater.cancel(('foo', 2))
+        count = socket.sendto.call_count
+        time.sleep(0.1)
+        assert socket.sendto.call_count == count
+        assert len(repeater) == 0
+    finally:
+        repeater.close()
+
+def test_repeater_timeout():
+    socket = Mock()
+    repeater = compoundpi.common.NetworkRepeater(
+        socket, timeout=0.05, interval=0.01)
+    try:
+        repeater.send(('foo', 1), ('localhost', 1), b'1 OK\n')
+        time.sleep(0.2)
+        assert ('foo', 1) not in repeater
+        count = socket.sendto.call_count
+        time.sleep(0.05)
+        assert socket.sendto.call_count == count
+    finally:
+        repeater.close()
+
+def test_repeater_replace():
+    socket = Mock()
+    repeater = compoundpi.common.NetworkRepeater(socket, interval=0.01)
+    try:
+        repeater.send(('foo', 1), ('localhost', 1), b'1 OK\n')
+        repeater.send(('foo', 1), ('localhost', 1), b'1 ERROR\n')
+        assert len(repeater) == 1
+        time.sleep(0.1)
+        repeater.cancel(('foo', 1))
+        assert socket.sendto.call_args == call(b'1 ERROR\n', ('localhost', 1))
+    finally:
+        repeater.close()
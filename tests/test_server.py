@@ -32,10 +32,16 @@ import os
 import io
 import time
 import signal
+import itertools
+import zlib
 
 import pytest
 from mock import Mock, MagicMock, patch, sentinel
 
+# The image store is platform independent; it is imported outside the mocked
+# modules below so it remains loaded when they are removed
+import compoundpi.store
+
 # Several of the modules that CompoundPiServer relies upon are Raspberry Pi
 # specific (can't be installed on other platforms) so we need to mock them
 # out before performing attempting to import compoundpi.server
@@ -56,6 +62,27 @@ with patch.dict('sys.modules', {
     import compoundpi.server
     import compoundpi.exc
 
+    def image_store(images):
+        # Returns an in-memory image store containing the specified list of
+        # (timestamp, data) tuples
+        store = compoundpi.store.ImageStore()
+        for timestamp, data in images:
+            image = store.create(timestamp)
+            image.write(data)
+            image.finish()
+        return store
+
+    def mock_server():
+        # Returns a mock server whose worker executes submitted commands
+        # synchronously
+        server = MagicMock()
+        server.worker.submit.side_effect = lambda func, *args: func(*args)
+        server.seqnos = set()
+        server.armed = None
+        server.preview = None
+        server.recording = None
+        return server
+
     def test_service():
         assert compoundpi.server.service('5000') == 5000
         with patch('socket.getservbyname') as m:
@@ -67,6 +94,16 @@ with patch.dict('sys.modules', {
             m.return_value = [(2, 2, 17, '', ('127.0.0.1', 0))]
             assert compoundpi.server.address('localhost') == '127.0.0.1'
 
+    def test_multicast_group():
+        assert compoundpi.server.multicast_group('239.1.2.3') == '239.1.2.3'
+        with pytest.raises(ValueError):
+            compoundpi.server.multicast_group('192.168.0.1')
+        with pytest.raises(ValueError):
+            compoundpi.server.multicast_group('foo')
+        assert compoundpi.server.multicast_groups('') == []
+        assert compoundpi.server.multicast_groups('239.0.0.1,239.0.0.2') == [
+            '239.0.0.1', '239.0.0.2']
+
     def test_user():
         assert compoundpi.server.user('1000') == 1000
         with patch('pwd.getpwnam') as m:
@@ -101,7 +138,8 @@ with patch.dict('sys.modules', {
                     stderr=sys.stderr,
                     uid=os.getuid(),
                     gid=os.getgid(),
-                    files_preserve=[app.server.socket],
+                    files_preserve=[
+                        app.server.socket, app.server.channel_socket],
                     pidfile=sentinel.pidfile,
                     signal_map={
                         signal.SIGTERM: app.terminate,
@@ -109,6 +147,23 @@ with patch.dict('sys.modules', {
                         })
                 app.server.serve_forever.assert_called_once_with()
 
+    def test_server_trigger_pin():
+        with patch.object(daemon_mock, 'DaemonContext') as ctx:
+            ctx.__enter__ = Mock()
+            ctx.__exit__ = Mock()
+            with patch.object(compoundpi.server, 'CompoundPiUDPServer') as srv, \
+                    patch.object(compoundpi.server, 'GPIO') as gpio:
+                app = compoundpi.server.CompoundPiServer()
+                app([
+                    '--trigger-pin', '17', '--trigger-edge', 'falling',
+                    '--trigger-pull', 'up', '--trigger-bounce', '5'])
+                gpio.setup.assert_called_once_with(
+                    17, gpio.IN, pull_up_down=gpio.PUD_UP)
+                gpio.add_event_detect.assert_called_once_with(
+                    17, gpio.FALLING, callback=app.server.gpio_trigger,
+                    bouncetime=5)
+                gpio.remove_event_detect.assert_called_once_with(17)
+
     def test_server_log_files_preserved(tmpdir):
         with patch.object(daemon_mock, 'DaemonContext') as ctx:
             ctx.__enter__ = Mock()
@@ -166,33 +221,36 @@ with patch.dict('sys.modules', {
     def test_handler_bad_request():
         with patch.object(compoundpi.server, 'NetworkRepeater') as m:
             socket = Mock()
+            server = mock_server()
             handler = compoundpi.server.CameraRequestHandler(
-                    (b'FOO', socket), ('localhost', 1), MagicMock())
-            assert m.call_count == 1
-            args, kwargs = m.call_args
-            assert args[0] == socket
+                    (b'FOO', socket), ('localhost', 1), server)
+            assert server.repeater.send.call_count == 1
+            args, kwargs = server.repeater.send.call_args
+            assert args[0] == (('localhost', 1), 0)
             assert args[1] == ('localhost', 1)
             assert args[2].startswith('0 ERROR\n')
 
     def test_handler_unknown_command():
         with patch.object(compoundpi.server, 'NetworkRepeater') as m:
             socket = Mock()
+            server = mock_server()
             handler = compoundpi.server.CameraRequestHandler(
-                    (b'0 FOO', socket), ('localhost', 1), MagicMock())
-            assert m.call_count == 1
-            args, kwargs = m.call_args
-            assert args[0] == socket
+                    (b'0 FOO', socket), ('localhost', 1), server)
+            assert server.repeater.send.call_count == 1
+            args, kwargs = server.repeater.send.call_args
+            assert args[0] == (('localhost', 1), 0)
             assert args[1] == ('localhost', 1)
             assert args[2].startswith('0 ERROR\n')
 
     def test_handler_unknown_command_with_params():
         with patch.object(compoundpi.server, 'NetworkRepeater') as m:
             socket = Mock()
+            server = mock_server()
             handler = compoundpi.server.CameraRequestHandler(
-                    (b'0 FOO 1 2 3', socket), ('localhost', 1), MagicMock())
-            assert m.call_count == 1
-            args, kwargs = m.call_args
-            assert args[0] == socket
+                    (b'0 FOO 1 2 3', socket), ('localhost', 1), server)
+            assert server.repeater.send.call_count == 1
+            args, kwargs = server.repeater.send.call_args
+            assert args[0] == (('localhost', 1), 0)
             assert args[1] == ('localhost', 1)
             assert args[2].startswith('0 ERROR\n')
 
@@ -200,7 +258,7 @@ with patch.dict('sys.modules', {
         with patch.object(compoundpi.server, 'NetworkRepeater') as m:
             with patch.object(compoundpi.server.warnings, 'warn') as w:
                 socket = Mock()
-                server = MagicMock()
+                server = mock_server()
                 server.client_address = ('foo', 1)
                 compoundpi.server.CameraRequestHandler(
                         (b'0 LIST', socket), ('localhost', 1), server)
@@ -212,8 +270,8 @@ with patch.dict('sys.modules', {
         with patch.object(compoundpi.server, 'NetworkRepeater') as m:
             with patch.object(compoundpi.server.warnings, 'warn') as w:
                 socket = Mock()
-                server = MagicMock()
-                server.seqno = 10
+                server = mock_server()
+                server.seqno = 100
                 server.client_address = ('localhost', 1)
                 compoundpi.server.CameraRequestHandler(
                         (b'0 LIST', socket), ('localhost', 1), server)
@@ -221,22 +279,130 @@ with patch.dict('sys.modules', {
                 assert isinstance(
                         w.call_args[0][0], compoundpi.exc.CompoundPiStaleSequence)
 
-    def test_ack_handler():
+    def test_handler_repeated_seqno():
+        with patch.object(compoundpi.server, 'NetworkRepeater') as m:
+            with patch.object(compoundpi.server.warnings, 'warn') as w:
+                socket = Mock()
+                server = mock_server()
+                server.seqno = 10
+                server.seqnos = {9, 10}
+                server.client_address = ('localhost', 1)
+                compoundpi.server.CameraRequestHandler(
+                        (b'9 LIST', socket), ('localhost', 1), server)
+                assert w.call_count == 1
+                assert isinstance(
+                        w.call_args[0][0], compoundpi.exc.CompoundPiStaleSequence)
+                assert not server.repeater.send.called
+
+    def test_handler_reordered_seqno():
+        with patch.object(compoundpi.server, 'NetworkRepeater') as m:
+            socket = Mock()
+            server = mock_server()
+            server.seqno = 10
+            server.seqnos = {7, 10}
+            server.client_address = ('localhost', 1)
+            compoundpi.server.CameraRequestHandler(
+                    (b'8 FLIP 1 0', socket), ('localhost', 1), server)
+            assert server.seqno == 10
+            assert server.seqnos == {7, 8, 10}
+            assert server.camera.hflip == True
+            server.repeater.send.assert_called_once_with(
+                    (('localhost', 1), 8), ('localhost', 1), '8 OK\n')
+
+    def test_handler_queues_camera_commands():
+        with patch.object(compoundpi.server, 'NetworkRepeater') as m:
+            socket = Mock()
+            server = MagicMock()
+            server.client_address = ('localhost', 1)
+            server.seqno = 1
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'2 RESOLUTION 1920 1080', socket), ('localhost', 1), server)
+            assert server.seqno == 2
+            server.worker.submit.assert_called_once_with(
+                    handler.execute, 2, handler.do_resolution, ['1920', '1080'])
+            assert not server.repeater.send.called
+
+    def test_handler_immediate_commands():
         with patch.object(compoundpi.server, 'NetworkRepeater') as m:
             socket = Mock()
             server = MagicMock()
-            responder = Mock()
-            server.responders = {(('localhost', 1), 0): responder}
+            server.client_address = ('localhost', 1)
+            server.seqno = 1
+            server.images = []
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'2 LIST', socket), ('localhost', 1), server)
+            assert server.seqno == 2
+            assert not server.worker.submit.called
+            server.repeater.send.assert_called_once_with(
+                    (('localhost', 1), 2), ('localhost', 1), '2 OK\n')
+
+    def test_camera_worker():
+        worker = compoundpi.server.CameraWorker()
+        try:
+            result = []
+            def func(n):
+                if n == 2:
+                    raise ValueError('bar')
+                result.append(n)
+            for n in range(4):
+                worker.submit(func, n)
+        finally:
+            worker.close()
+        assert result == [0, 1, 3]
+        assert not worker.is_alive()
+
+    def test_ack_handler():
+        with patch.object(compoundpi.server, 'NetworkRepeater') as m:
+            socket = Mock()
+            server = mock_server()
             handler = compoundpi.server.CameraRequestHandler(
                     (b'0 ACK', socket), ('localhost', 1), server)
-            assert responder.terminate == True
-            assert responder.join.called_once_with()
+            server.repeater.cancel.assert_called_once_with((('localhost', 1), 0))
+            assert not server.repeater.send.called
+
+    def test_ack_fragment_handler():
+        with patch.object(compoundpi.server, 'NetworkRepeater') as m:
+            socket = Mock()
+            server = mock_server()
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'3 ACK 2', socket), ('localhost', 1), server)
+            server.repeater.cancel.assert_called_once_with((('localhost', 1), 3, 2))
+            assert not server.repeater.send.called
+
+    def test_fragmented_response():
+        with patch.object(compoundpi.server, 'NetworkRepeater') as m:
+            socket = Mock()
+            server = mock_server()
+            server.client_address = ('localhost', 1)
+            server.seqno = 1
+            server.images = image_store(
+                (1000.0 + i, b'\x00' * 100000)
+                for i in range(100)
+                )
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'2 LIST', socket), ('localhost', 1), server)
+            assert server.seqno == 2
+            calls = server.repeater.send.call_args_list
+            assert len(calls) > 1
+            lines = []
+            for index, ((key, address, data), kwargs) in enumerate(calls):
+                assert key == (('localhost', 1), 2, index)
+                assert address == ('localhost', 1)
+                assert len(data) < 1500
+                header, data = data.split(b'\n', 1)
+                assert header == b'2 OK %d/%d' % (index, len(calls))
+                lines.extend(data.splitlines())
+            assert lines == [
+                b'IMAGE %d %f 100000 crc32=%08x' % (
+                    i, 1000.0 + i, zlib.crc32(b'\x00' * 100000) & 0xFFFFFFFF)
+                for i in range(100)
+                ]
 
     def test_hello_handler_stale_time():
         with patch.object(compoundpi.server, 'NetworkRepeater') as m:
             with patch.object(compoundpi.server.warnings, 'warn') as w:
                 socket = Mock()
-                server = MagicMock()
+                server = mock_server()
                 server.client_address = ('localhost', 1)
                 server.client_timestamp = 2000.0
                 handler = compoundpi.server.CameraRequestHandler(
@@ -248,21 +414,21 @@ with patch.dict('sys.modules', {
     def test_hello_handler():
         with patch.object(compoundpi.server, 'NetworkRepeater') as m:
             socket = Mock()
-            server = MagicMock()
+            server = mock_server()
             server.client_address = None
             handler = compoundpi.server.CameraRequestHandler(
                     (b'0 HELLO 1000.0', socket), ('localhost', 1), server)
             assert server.client_address == ('localhost', 1)
             assert server.client_timestamp == 1000.0
             assert server.seqno == 0
-            m.assert_called_once_with(
-                    socket, ('localhost', 1),
+            server.repeater.send.assert_called_once_with(
+                    (('localhost', 1), 0), ('localhost', 1),
                     '0 OK\nVERSION %s' % compoundpi.__version__)
 
     def test_blink_thread():
         with patch.object(compoundpi.server, 'NetworkRepeater') as m:
             with patch.object(compoundpi.server.time, 'sleep') as sleep:
-                server = MagicMock()
+                server = mock_server()
                 handler = compoundpi.server.CameraRequestHandler(
                         (b'1 BLINK', Mock()), ('localhost', 1), server)
                 start = time.time()
@@ -275,21 +441,21 @@ with patch.dict('sys.modules', {
         with patch.object(compoundpi.server, 'NetworkRepeater') as m:
             with patch('threading.Thread') as thread:
                 socket = Mock()
-                server = MagicMock()
+                server = mock_server()
                 server.client_address = ('localhost', 1)
                 server.seqno = 0
                 handler = compoundpi.server.CameraRequestHandler(
                         (b'1 BLINK', socket), ('localhost', 1), server)
                 assert server.seqno == 1
-                m.assert_called_once_with(
-                        socket, ('localhost', 1), '1 OK\n')
+                server.repeater.send.assert_called_once_with(
+                        (('localhost', 1), 1), ('localhost', 1), '1 OK\n')
                 thread.assert_called_once_with(target=handler.blink_led, args=(5,))
 
     def test_status_handler():
         with patch.object(compoundpi.server, 'NetworkRepeater') as m:
             with patch.object(compoundpi.server.time, 'time') as now:
                 socket = Mock()
-                server = MagicMock()
+                server = mock_server()
                 server.client_address = ('localhost', 1)
                 server.seqno = 1
                 server.camera.resolution = (1280, 720)
@@ -297,6 +463,8 @@ with patch.dict('sys.modules', {
                 server.camera.awb_mode = 'auto'
                 server.camera.awb_gains = (1.5, 1.3)
                 server.camera.exposure_mode = 'off'
+                server.camera.analog_gain = 2
+                server.camera.digital_gain = 1
                 server.camera.exposure_speed = 100000
                 server.camera.exposure_compensation = 0
                 server.camera.iso = 100
@@ -306,71 +474,76 @@ with patch.dict('sys.modules', {
                 server.camera.saturation = 15
                 server.camera.hflip = True
                 server.camera.vflip = False
-                server.images = []
+                server.images = image_store([])
                 now.return_value = 2000.0
                 handler = compoundpi.server.CameraRequestHandler(
                         (b'2 STATUS', socket), ('localhost', 1), server)
                 assert server.seqno == 2
-                m.assert_called_once_with(
-                        socket, ('localhost', 1),
+                server.repeater.send.assert_called_once_with(
+                        (('localhost', 1), 2), ('localhost', 1),
                         '2 OK\n'
                         'RESOLUTION 1280 720\n'
                         'FRAMERATE 30\n'
                         'AWB auto 1.5 1.3\n'
-                        'EXPOSURE off 100.0 0\n'
+                        'AGC off 2 1\n'
+                        'EXPOSURE off 100.0\n'
                         'ISO 100\n'
                         'METERING spot\n'
-                        'LEVELS 50 25 15\n'
+                        'BRIGHTNESS 50\n'
+                        'CONTRAST 25\n'
+                        'SATURATION 15\n'
+                        'EV 0\n'
                         'FLIP 1 0\n'
                         'TIMESTAMP 2000.0\n'
-                        'IMAGES 0\n')
+                        'IMAGES 0\n'
+                        'STORE 0 0 0 0\n')
 
     def test_resolution_handler():
         with patch.object(compoundpi.server, 'NetworkRepeater') as m:
             socket = Mock()
-            server = MagicMock()
+            server = mock_server()
             server.client_address = ('localhost', 1)
             server.seqno = 1
             handler = compoundpi.server.CameraRequestHandler(
                     (b'2 RESOLUTION 1920 1080', socket), ('localhost', 1), server)
             assert server.seqno == 2
             assert server.camera.resolution == (1920, 1080)
-            m.assert_called_once_with(
-                    socket, ('localhost', 1),
+            server.repeater.send.assert_called_once_with(
+                    (('localhost', 1), 2), ('localhost', 1),
                     '2 OK\n')
 
     def test_framerate_handler():
         with patch.object(compoundpi.server, 'NetworkRepeater') as m:
             socket = Mock()
-            server = MagicMock()
+            server = mock_server()
             server.client_address = ('localhost', 1)
             server.seqno = 1
             handler = compoundpi.server.CameraRequestHandler(
                     (b'2 FRAMERATE 30/2', socket), ('localhost', 1), server)
             assert server.seqno == 2
             assert server.camera.framerate == 15
-            m.assert_called_once_with(
-                    socket, ('localhost', 1),
+            server.repeater.send.assert_called_once_with(
+                    (('localhost', 1), 2), ('localhost', 1),
                     '2 OK\n')
 
     def test_awb_handler_auto():
         with patch.object(compoundpi.server, 'NetworkRepeater') as m:
             socket = Mock()
-            server = MagicMock()
+            server = mock_server()
             server.client_address = ('localhost', 1)
             server.seqno = 1
             handler = compoundpi.server.CameraRequestHandler(
                     (b'2 AWB auto 1.0 1.0', socket), ('localhost', 1), server)
             assert server.seqno == 2
             assert server.camera.awb_mode == 'auto'
-            m.assert_called_once_with(
-                    socket, ('localhost', 1),
+            server.repeater.send.assert_called_once_with(
+                    (('localhost', 1), 2), ('localhost', 1),
                     '2 OK\n')
 
     def test_awb_handler_manual():
         with patch.object(compoundpi.server, 'NetworkRepeater') as m:
             socket = Mock()
-            server = MagicMock()
+            server = mock_server()
             server.client_address = ('localhost', 1)
             server.seqno = 1
             handler = compoundpi.server.CameraRequestHandler(
@@ -378,74 +551,83 @@ with patch.dict('sys.modules', {
             assert server.seqno == 2
             assert server.camera.awb_mode == 'off'
             assert server.camera.awb_gains == (1.5, 1.3)
-            m.assert_called_once_with(
-                    socket, ('localhost', 1),
+            server.repeater.send.assert_called_once_with(
+                    (('localhost', 1), 2), ('localhost', 1),
                     '2 OK\n')
 
     def test_exposure_handler():
         with patch.object(compoundpi.server, 'NetworkRepeater') as m:
             socket = Mock()
-            server = MagicMock()
+            server = mock_server()
             server.client_address = ('localhost', 1)
             server.seqno = 1
             handler = compoundpi.server.CameraRequestHandler(
-                    (b'2 EXPOSURE auto 20.0 24', socket), ('localhost', 1), server)
+                    (b'2 EXPOSURE off 20.0', socket), ('localhost', 1), server)
             assert server.seqno == 2
-            assert server.camera.exposure_mode == 'auto'
-            assert server.camera.shutter_speed == 20000.0
-            assert server.camera.exposure_compensation == 24
-            m.assert_called_once_with(
-                    socket, ('localhost', 1),
+            assert server.camera.shutter_speed == 20000
+            server.repeater.send.assert_called_once_with(
+                    (('localhost', 1), 2), ('localhost', 1),
                     '2 OK\n')
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'3 EXPOSURE auto 20.0', socket), ('localhost', 1), server)
+            assert server.seqno == 3
+            assert server.camera.shutter_speed == 0
 
     def test_metering_handler():
         with patch.object(compoundpi.server, 'NetworkRepeater') as m:
             socket = Mock()
-            server = MagicMock()
+            server = mock_server()
             server.client_address = ('localhost', 1)
             server.seqno = 1
             handler = compoundpi.server.CameraRequestHandler(
                     (b'2 METERING spot', socket), ('localhost', 1), server)
             assert server.seqno == 2
             assert server.camera.meter_mode == 'spot'
-            m.assert_called_once_with(
-                    socket, ('localhost', 1),
+            server.repeater.send.assert_called_once_with(
+                    (('localhost', 1), 2), ('localhost', 1),
                     '2 OK\n')
 
     def test_iso_handler():
         with patch.object(compoundpi.server, 'NetworkRepeater') as m:
             socket = Mock()
-            server = MagicMock()
+            server = mock_server()
             server.client_address = ('localhost', 1)
             server.seqno = 1
             handler = compoundpi.server.CameraRequestHandler(
                     (b'2 ISO 400', socket), ('localhost', 1), server)
             assert server.seqno == 2
             assert server.camera.iso == 400
-            m.assert_called_once_with(
-                    socket, ('localhost', 1),
+            server.repeater.send.assert_called_once_with(
+                    (('localhost', 1), 2), ('localhost', 1),
                     '2 OK\n')
 
     def test_levels_handler():
         with patch.object(compoundpi.server, 'NetworkRepeater') as m:
             socket = Mock()
-            server = MagicMock()
+            server = mock_server()
             server.client_address = ('localhost', 1)
             server.seqno = 1
             handler = compoundpi.server.CameraRequestHandler(
-                    (b'2 LEVELS 1 2 3', socket), ('localhost', 1), server)
-            assert server.seqno == 2
+                    (b'2 BRIGHTNESS 1', socket), ('localhost', 1), server)
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'3 CONTRAST 2', socket), ('localhost', 1), server)
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'4 SATURATION 3', socket), ('localhost', 1), server)
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'5 EV -4', socket), ('localhost', 1), server)
+            assert server.seqno == 5
             assert server.camera.brightness == 1
             assert server.camera.contrast == 2
             assert server.camera.saturation == 3
-            m.assert_called_once_with(
-                    socket, ('localhost', 1),
-                    '2 OK\n')
+            assert server.camera.exposure_compensation == -4
+            server.repeater.send.assert_called_with(
+                    (('localhost', 1), 5), ('localhost', 1),
+                    '5 OK\n')
 
     def test_flip_handler():
         with patch.object(compoundpi.server, 'NetworkRepeater') as m:
             socket = Mock()
-            server = MagicMock()
+            server = mock_server()
             server.client_address = ('localhost', 1)
             server.seqno = 1
             handler = compoundpi.server.CameraRequestHandler(
@@ -453,31 +635,29 @@ with patch.dict('sys.modules', {
             assert server.seqno == 2
             assert server.camera.hflip == True
             assert server.camera.vflip == False
-            m.assert_called_once_with(
-                    socket, ('localhost', 1),
+            server.repeater.send.assert_called_once_with(
+                    (('localhost', 1), 2), ('localhost', 1),
                     '2 OK\n')
 
     def test_stream_generator():
         with patch.object(compoundpi.server, 'NetworkRepeater') as m:
             with patch.object(compoundpi.server.time, 'time') as now:
-                with patch.object(compoundpi.server.io, 'BytesIO') as stream:
-                    server = MagicMock()
-                    server.images = []
-                    now.return_value = 100.0
-                    stream.return_value = sentinel.stream
-                    handler = compoundpi.server.CameraRequestHandler(
-                            (b'2 ACK', Mock()), ('localhost', 1), server)
-                    for s in handler.stream_generator(2):
-                        assert s is sentinel.stream
-                    assert server.images == [
-                        (100.0, sentinel.stream),
-                        (100.0, sentinel.stream),
-                        ]
+                server = mock_server()
+                server.images = image_store([])
+                now.return_value = 100.0
+                handler = compoundpi.server.CameraRequestHandler(
+                        (b'2 ACK', Mock()), ('localhost', 1), server)
+                for s in handler.stream_generator(2):
+                    s.write(b'foo')
+                assert [
+                    (image.index, image.timestamp, image.size)
+                    for image in server.images
+                    ] == [(0, 100.0, 3), (1, 100.0, 3)]
 
     def test_capture_handler():
         with patch.object(compoundpi.server, 'NetworkRepeater') as m:
             socket = Mock()
-            server = MagicMock()
+            server = mock_server()
             server.client_address = ('localhost', 1)
             server.seqno = 1
             with patch.object(compoundpi.server.CameraRequestHandler, 'stream_generator') as gen:
@@ -488,46 +668,688 @@ with patch.dict('sys.modules', {
                 assert server.camera.led == True
                 server.camera.capture_sequence.assert_called_once_with(
                         sentinel.iterator, format='jpeg', use_video_port=True)
-                m.assert_called_once_with(
-                        socket, ('localhost', 1),
-                        '2 OK\n')
+                assert server.repeater.send.call_count == 1
+                args, kwargs = server.repeater.send.call_args
+                assert args[2].startswith('2 OK\nTIMESTAMP ')
 
     def test_capture_handler_with_sync():
         with patch.object(compoundpi.server, 'NetworkRepeater') as m:
             with patch.object(compoundpi.server.time, 'time') as now:
                 with patch.object(compoundpi.server.time, 'sleep') as sleep:
                     socket = Mock()
-                    server = MagicMock()
+                    server = mock_server()
                     server.client_address = ('localhost', 1)
                     server.seqno = 1
-                    now.return_value = 1000.0
+                    # The handler notes the time of receipt, calculates the
+                    # delay, then spins through the final readings until the
+                    # sync time
+                    now.side_effect = itertools.chain(
+                        [1000.0, 1000.0, 1049.995, 1049.999],
+                        itertools.repeat(1050.0))
                     with patch.object(compoundpi.server.CameraRequestHandler, 'stream_generator') as gen:
                         gen.return_value = sentinel.iterator
                         handler = compoundpi.server.CameraRequestHandler(
                                 (b'2 CAPTURE 1 0 1050.0', socket), ('localhost', 1), server)
                         assert server.seqno == 2
                         assert server.camera.led == True
-                        sleep.assert_called_once_with(50.0)
+                        sleep.assert_called_once_with(
+                                50.0 - compoundpi.server.CameraRequestHandler.spin_time)
                         server.camera.capture_sequence.assert_called_once_with(
                                 sentinel.iterator, format='jpeg', use_video_port=False)
-                        m.assert_called_once_with(
-                                socket, ('localhost', 1),
-                                '2 OK\n')
+                        server.repeater.send.assert_called_once_with(
+                                (('localhost', 1), 2), ('localhost', 1),
+                                '2 OK\nTIMESTAMP 1050.000000')
+
+    def test_sync_handler():
+        with patch.object(compoundpi.server.time, 'time') as now:
+            socket = Mock()
+            server = mock_server()
+            server.client_address = ('localhost', 1)
+            server.seqno = 1
+            now.side_effect = [1000.25, 1000.5]
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'2 SYNC', socket), ('localhost', 1), server)
+            server.repeater.send.assert_called_once_with(
+                    (('localhost', 1), 2), ('localhost', 1),
+                    '2 OK\nTIMESTAMP 1000.250000 1000.500000')
 
     def test_capture_handler_past_sync():
         with patch.object(compoundpi.server, 'NetworkRepeater') as m:
             with patch.object(compoundpi.server.time, 'time') as now:
                 with patch.object(compoundpi.server.time, 'sleep') as sleep:
                     socket = Mock()
-                    server = MagicMock()
+                    server = mock_server()
                     server.client_address = ('localhost', 1)
                     server.seqno = 1
                     now.return_value = 1000.0
                     with patch.object(compoundpi.server.CameraRequestHandler, 'stream_generator') as gen:
                         handler = compoundpi.server.CameraRequestHandler(
                                 (b'2 CAPTURE 1 0 900.0', socket), ('localhost', 1), server)
-                        assert m.call_count == 1
-                        args, kwargs = m.call_args
-                        assert args[0] == socket
+                        assert server.repeater.send.call_count == 1
+                        args, kwargs = server.repeater.send.call_args
+                        assert args[0] == (('localhost', 1), 2)
                         assert args[1] == ('localhost', 1)
                         assert args[2].startswith('2 ERROR\n')
+
+    def armed_capture(frames):
+        # Returns an ArmedCapture whose buffer contains the specified list of
+        # (timestamp, data) tuples; the mock camera's capture_sequence returns
+        # immediately so the capture thread has ended
+        camera = Mock()
+        armed = compoundpi.server.ArmedCapture(camera, 3, timeout=0.1)
+        armed._thread.join()
+        armed.running = True
+        outputs = armed.outputs()
+        stream = next(outputs)
+        with patch.object(compoundpi.server.time, 'time') as now:
+            for timestamp, data in frames:
+                stream.write(data)
+                now.return_value = timestamp
+                stream = next(outputs)
+        return armed
+
+    def test_armed_capture():
+        armed = armed_capture([
+            (1000.0, b'foo'), (1000.1, b'bar'), (1000.2, b'baz'), (1000.3, b'quux')])
+        # The buffer only retains the last 3 frames
+        taken, stream = armed.frame(1000.0)
+        assert taken == 1000.1
+        assert stream.getvalue() == b'bar'
+        taken, stream = armed.frame(1000.24)
+        assert taken == 1000.2
+        assert stream.getvalue() == b'baz'
+        with pytest.raises(IOError):
+            armed.frame(1000.5)
+
+    def test_arm_handler():
+        socket = Mock()
+        server = mock_server()
+        server.client_address = ('localhost', 1)
+        server.seqno = 1
+        with patch.object(compoundpi.server, 'ArmedCapture') as armed:
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'2 ARM 5', socket), ('localhost', 1), server)
+            armed.assert_called_once_with(server.camera, 5)
+            assert server.armed == armed.return_value
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'3 CAPTURE', socket), ('localhost', 1), server)
+            server.repeater.send.assert_called_with(
+                    (('localhost', 1), 3), ('localhost', 1),
+                    '3 ERROR\nCamera is armed')
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'4 DISARM', socket), ('localhost', 1), server)
+            armed.return_value.close.assert_called_once_with()
+            assert server.armed is None
+
+    def test_trigger_handler():
+        socket = Mock()
+        server = mock_server()
+        server.client_address = ('localhost', 1)
+        server.seqno = 1
+        server.images = image_store([])
+        server.armed = armed_capture([(1000.0, b'foo'), (1000.1, b'bar')])
+        handler = compoundpi.server.CameraRequestHandler(
+                (b'2 TRIGGER 1000.08', socket), ('localhost', 1), server)
+        server.repeater.send.assert_called_once_with(
+                (('localhost', 1), 2), ('localhost', 1),
+                '2 OK\nTIMESTAMP 1000.100000')
+        assert [
+            (image.index, image.timestamp, image.trigger,
+                image.stream.getvalue())
+            for image in server.images
+            ] == [(0, 1000.1, 1000.08, b'bar')]
+
+    def test_gpio_trigger():
+        server = compoundpi.server.CompoundPiUDPServer(
+            ('127.0.0.1', 0), compoundpi.server.CameraRequestHandler)
+        try:
+            server.worker = Mock()
+            server.worker.submit.side_effect = lambda func, *args: func(*args)
+            server.images = image_store([])
+            with patch.object(compoundpi.server.logging, 'warning') as warning:
+                server.gpio_trigger(17)
+                assert warning.call_count == 1
+                assert not server.worker.submit.called
+            server.armed = armed_capture([(1000.0, b'foo'), (1000.1, b'bar')])
+            with patch.object(compoundpi.server.time, 'time') as now:
+                now.return_value = 1000.08
+                server.gpio_trigger(17)
+            assert [
+                (image.index, image.timestamp, image.trigger,
+                    image.stream.getvalue())
+                for image in server.images
+                ] == [(0, 1000.1, 1000.08, b'bar')]
+        finally:
+            server.server_close()
+
+    def test_trigger_handler_unarmed():
+        socket = Mock()
+        server = mock_server()
+        server.client_address = ('localhost', 1)
+        server.seqno = 1
+        handler = compoundpi.server.CameraRequestHandler(
+                (b'2 TRIGGER', socket), ('localhost', 1), server)
+        server.repeater.send.assert_called_once_with(
+                (('localhost', 1), 2), ('localhost', 1),
+                '2 ERROR\nCamera is not armed')
+
+    def test_preview_stream():
+        import socket
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        camera = Mock()
+        try:
+            preview = compoundpi.server.PreviewStream(
+                camera, listener.getsockname(), (320, 240), 1000.0, 8000000,
+                50)
+            conn, addr = listener.accept()
+            try:
+                camera.start_recording.assert_called_once_with(
+                    preview, format='mjpeg', splitter_port=2,
+                    resize=(320, 240), bitrate=8000000, quality=50)
+                with patch.object(compoundpi.server.time, 'time') as now:
+                    now.return_value = 1000.0
+                    preview.write(b'\xff\xd8foo')
+                    preview.write(b'bar')
+                    now.return_value = 1000.5
+                    preview.write(b'\xff\xd8baz')
+                header = compoundpi.common.PREVIEW_HEADER
+                data = b''
+                while len(data) < header.size + 8:
+                    data += conn.recv(1024)
+                assert header.unpack(data[:header.size]) == (1000.0, 8)
+                assert data[header.size:] == b'\xff\xd8foobar'
+            finally:
+                preview.close()
+                conn.close()
+            camera.stop_recording.assert_called_once_with(splitter_port=2)
+            assert not preview._thread.is_alive()
+        finally:
+            listener.close()
+
+    def test_preview_handler():
+        socket = Mock()
+        server = mock_server()
+        server.client_address = ('localhost', 1)
+        server.seqno = 1
+        with patch.object(compoundpi.server, 'PreviewStream') as preview:
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'2 PREVIEW START 5000 320 240 5 1000000 50', socket),
+                    ('localhost', 1), server)
+            preview.assert_called_once_with(
+                server.camera, ('localhost', 5000), (320, 240), 5.0,
+                1000000, 50)
+            assert server.preview == preview.return_value
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'3 RESOLUTION 640 480', socket), ('localhost', 1), server)
+            server.repeater.send.assert_called_with(
+                    (('localhost', 1), 3), ('localhost', 1),
+                    '3 ERROR\nCamera is previewing')
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'4 PREVIEW STOP', socket), ('localhost', 1), server)
+            preview.return_value.close.assert_called_once_with()
+            assert server.preview is None
+
+    def test_preview_handler_invalid():
+        socket = Mock()
+        server = mock_server()
+        server.client_address = ('localhost', 1)
+        server.seqno = 1
+        with patch.object(compoundpi.server, 'PreviewStream') as preview:
+            for seqno, params, error in (
+                    (2, b'START 5000', 'Missing PREVIEW parameters'),
+                    (3, b'START 5000 320 240 0 1000000 50',
+                        'Invalid preview framerate 0.000000'),
+                    (4, b'START 5000 320 240 5 1000000 101',
+                        'Invalid preview quality 101'),
+                    (5, b'FOO', 'Invalid PREVIEW action FOO'),
+                    ):
+                handler = compoundpi.server.CameraRequestHandler(
+                        (b'%d PREVIEW %s' % (seqno, params), socket),
+                        ('localhost', 1), server)
+                server.repeater.send.assert_called_with(
+                        (('localhost', 1), seqno), ('localhost', 1),
+                        '%d ERROR\n%s' % (seqno, error))
+            assert not preview.called
+
+    def test_recording():
+        camera = Mock()
+        images = image_store([])
+        def split_recording(stream, splitter_port):
+            stream.write(b'segment')
+        camera.split_recording.side_effect = split_recording
+        recording = compoundpi.server.Recording(camera, images, 0.01, 1000000)
+        camera.start_recording.assert_called_once_with(
+            images[0], format='h264', splitter_port=1,
+            bitrate=1000000, inline_headers=True)
+        images[0].write(b'first')
+        while len(images) < 3:
+            time.sleep(0.01)
+        recording.close()
+        camera.stop_recording.assert_called_once_with(splitter_port=1)
+        assert all(image.complete for image in images)
+        assert all(image.format == 'h264' for image in images)
+        assert all(image.duration > 0.0 for image in images)
+        assert images[0].stream.getvalue() == b'first'
+        assert images[1].stream.getvalue() == b'segment'
+        assert images[0].timestamp == recording.started
+        assert images[1].timestamp == pytest.approx(
+            images[0].timestamp + images[0].duration)
+
+    def test_record_handler():
+        socket = Mock()
+        server = mock_server()
+        server.client_address = ('localhost', 1)
+        server.seqno = 1
+        with patch.object(compoundpi.server, 'Recording') as recording:
+            recording.return_value.started = 1000.0
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'2 RECORD 5 1000000', socket), ('localhost', 1), server)
+            recording.assert_called_once_with(
+                server.camera, server.images, 5.0, 1000000)
+            assert server.recording == recording.return_value
+            server.repeater.send.assert_called_with(
+                    (('localhost', 1), 2), ('localhost', 1),
+                    '2 OK\nTIMESTAMP 1000.000000')
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'3 RECORD', socket), ('localhost', 1), server)
+            server.repeater.send.assert_called_with(
+                    (('localhost', 1), 3), ('localhost', 1),
+                    '3 ERROR\nCamera is already recording')
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'4 FRAMERATE 60', socket), ('localhost', 1), server)
+            server.repeater.send.assert_called_with(
+                    (('localhost', 1), 4), ('localhost', 1),
+                    '4 ERROR\nCamera is recording')
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'5 STOP', socket), ('localhost', 1), server)
+            recording.return_value.close.assert_called_once_with()
+            assert server.recording is None
+
+    def test_send_handler_recording():
+        socket = Mock()
+        server = mock_server()
+        server.client_address = ('localhost', 1)
+        server.seqno = 1
+        server.images = image_store([])
+        server.images.create(1000.0, format='h264')
+        with patch.object(compoundpi.server.socket, 'socket') as sock:
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'2 SEND 0 5647', socket), ('localhost', 1), server)
+            assert not sock.called
+            server.repeater.send.assert_called_once_with(
+                    (('localhost', 1), 2), ('localhost', 1),
+                    '2 ERROR\nImage 0 is still being recorded')
+
+    def test_send_handler():
+        socket = Mock()
+        server = mock_server()
+        server.client_address = ('localhost', 1)
+        server.seqno = 1
+        server.images = image_store([(1000.0, b'foo'), (1001.0, b'quux')])
+        with patch.object(compoundpi.server.socket, 'socket') as sock:
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'2 SEND 1 5647', socket), ('localhost', 1), server)
+            sock.return_value.connect.assert_called_once_with(('localhost', 5647))
+            assert b''.join(
+                    bytes(args[0])
+                    for args, kwargs in sock.return_value.sendall.call_args_list
+                    ) == (
+                        compoundpi.common.SEND_HEADER.pack(1, 4, 0, 4) +
+                        b'quux' +
+                        compoundpi.common.SEND_TRAILER.pack(
+                            zlib.crc32(b'quux') & 0xFFFFFFFF))
+            sock.return_value.close.assert_called_once_with()
+            assert server.images[1].sent
+            assert not server.images[0].sent
+            server.repeater.send.assert_called_once_with(
+                    (('localhost', 1), 2), ('localhost', 1),
+                    '2 OK\n')
+
+    def test_send_handler_range():
+        socket = Mock()
+        server = mock_server()
+        server.client_address = ('localhost', 1)
+        server.seqno = 1
+        server.images = image_store([(1000.0, b'foobar')])
+        with patch.object(compoundpi.server.socket, 'socket') as sock:
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'2 SEND 0 5647 1 2', socket), ('localhost', 1), server)
+            assert b''.join(
+                    bytes(args[0])
+                    for args, kwargs in sock.return_value.sendall.call_args_list
+                    ) == (
+                        compoundpi.common.SEND_HEADER.pack(0, 6, 1, 2) +
+                        b'oo' +
+                        compoundpi.common.SEND_TRAILER.pack(
+                            zlib.crc32(b'oo') & 0xFFFFFFFF))
+            # The image isn't complete until a range reaching its end is sent
+            assert not server.images[0].sent
+            sock.reset_mock()
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'3 SEND 0 5647 3', socket), ('localhost', 1), server)
+            assert b''.join(
+                    bytes(args[0])
+                    for args, kwargs in sock.return_value.sendall.call_args_list
+                    ) == (
+                        compoundpi.common.SEND_HEADER.pack(0, 6, 3, 3) +
+                        b'bar' +
+                        compoundpi.common.SEND_TRAILER.pack(
+                            zlib.crc32(b'bar') & 0xFFFFFFFF))
+            assert server.images[0].sent
+            sock.reset_mock()
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'4 SEND 0 5647 7', socket), ('localhost', 1), server)
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'5 SEND 0 5647 3 4', socket), ('localhost', 1), server)
+            assert not sock.called
+            assert server.repeater.send.call_args_list[-2:] == [
+                ((
+                    (('localhost', 1), 4), ('localhost', 1),
+                    '4 ERROR\nInvalid offset 7 for image 0'), {}),
+                ((
+                    (('localhost', 1), 5), ('localhost', 1),
+                    '5 ERROR\nInvalid length 4 for image 0'), {}),
+                ]
+
+    def test_send_handler_clear():
+        socket = Mock()
+        server = mock_server()
+        server.client_address = ('localhost', 1)
+        server.seqno = 1
+        server.images = image_store([(1000.0, b'foo'), (1001.0, b'quux')])
+        trailer = compoundpi.common.SEND_TRAILER.pack(
+            zlib.crc32(b'quux') & 0xFFFFFFFF)
+        with patch.object(compoundpi.server.socket, 'socket') as sock:
+            # A wrong acknowledgement leaves the image in place
+            sock.return_value.recv.side_effect = [b'\x00\x00', b'\x00\x00']
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'2 SEND 1 5647 0 0 1', socket), ('localhost', 1), server)
+            assert sock.return_value.settimeout.call_args_list == [
+                ((5.0,), {}), ((None,), {})]
+            assert [image.index for image in server.images] == [0, 1]
+            sock.return_value.recv.side_effect = [trailer[:1], trailer[1:]]
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'3 SEND 1 5647 0 0 1', socket), ('localhost', 1), server)
+            assert [image.index for image in server.images] == [0]
+            sock.return_value.recv.side_effect = [b'']
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'4 SEND 0 5647 0 0 1', socket), ('localhost', 1), server)
+            assert [image.index for image in server.images] == [0]
+            assert server.repeater.send.call_args_list[-1] == (
+                ((('localhost', 1), 4), ('localhost', 1), '4 OK\n'), {})
+
+    def test_sendall_handler():
+        socket = Mock()
+        server = mock_server()
+        server.client_address = ('localhost', 1)
+        server.seqno = 1
+        server.images = image_store([
+            (1000.0, b'foo'), (1001.0, b'bar'), (1002.0, b'quux')])
+        def frame(index, data):
+            return (
+                compoundpi.common.SEND_HEADER.pack(
+                    index, len(data), 0, len(data)) +
+                data +
+                compoundpi.common.SEND_TRAILER.pack(
+                    zlib.crc32(data) & 0xFFFFFFFF))
+        with patch.object(compoundpi.server.socket, 'socket') as sock:
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'2 SENDALL 5647 0,2', socket), ('localhost', 1), server)
+            sock.return_value.connect.assert_called_once_with(('localhost', 5647))
+            assert b''.join(
+                    bytes(args[0])
+                    for args, kwargs in sock.return_value.sendall.call_args_list
+                    ) == frame(0, b'foo') + frame(2, b'quux')
+            sock.return_value.close.assert_called_once_with()
+            assert [image.sent for image in server.images] == [True, False, True]
+            server.repeater.send.assert_called_with(
+                    (('localhost', 1), 2), ('localhost', 1),
+                    '2 OK\n')
+            sock.reset_mock()
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'3 SENDALL 5647 1-3', socket), ('localhost', 1), server)
+            assert not sock.called
+            server.repeater.send.assert_called_with(
+                    (('localhost', 1), 3), ('localhost', 1),
+                    '3 ERROR\nImage 3 is missing or incomplete')
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'4 SENDALL 5647 1-4000000000', socket), ('localhost', 1),
+                    server)
+            assert not sock.called
+            server.repeater.send.assert_called_with(
+                    (('localhost', 1), 4), ('localhost', 1),
+                    '4 ERROR\nImage 3 is missing or incomplete')
+            # Only images whose receipt is confirmed are cleared
+            sock.return_value.recv.side_effect = [frame(0, b'foo')[-4:], b'']
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'5 SENDALL 5647 0,2 1', socket), ('localhost', 1), server)
+            assert [image.index for image in server.images] == [1, 2]
+            sock.return_value.recv.side_effect = [frame(2, b'quux')[-4:]]
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'6 SENDALL 5647 2 1', socket), ('localhost', 1), server)
+            assert [image.index for image in server.images] == [1]
+
+    def test_send_handler_stored_checksum():
+        socket = Mock()
+        server = mock_server()
+        server.client_address = ('localhost', 1)
+        server.seqno = 1
+        server.images = image_store([(1000.0, b'foo')])
+        # The trailer of a whole image is the checksum calculated as it was
+        # captured, so corruption since then is detected by the client
+        server.images[0].stream.seek(0)
+        server.images[0].stream.write(b'boo')
+        with patch.object(compoundpi.server.socket, 'socket') as sock:
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'2 SEND 0 5647', socket), ('localhost', 1), server)
+            assert b''.join(
+                    bytes(args[0])
+                    for args, kwargs in sock.return_value.sendall.call_args_list
+                    ) == (
+                        compoundpi.common.SEND_HEADER.pack(0, 3, 0, 3) +
+                        b'boo' +
+                        compoundpi.common.SEND_TRAILER.pack(
+                            zlib.crc32(b'foo') & 0xFFFFFFFF))
+
+    def test_send_stream_sendfile(tmpdir):
+        filename = str(tmpdir.join('image.jpg'))
+        with io.open(filename, 'w+b') as stream:
+            stream.write(b'foobar')
+            sock = Mock()
+            sock.fileno.return_value = 10
+            with patch.object(compoundpi.server.os, 'sendfile', create=True) as sendfile:
+                sendfile.side_effect = [3, 2]
+                compoundpi.server.CameraRequestHandler.send_stream.__func__(
+                        None, sock, stream, 1, 5)
+                assert sendfile.call_count == 2
+                sendfile.assert_called_with(10, stream.fileno(), 4, 2)
+                assert not sock.sendall.called
+
+    def test_send_stream_chunked(tmpdir):
+        filename = str(tmpdir.join('image.jpg'))
+        data = b'foobar' * 500000
+        with io.open(filename, 'w+b') as stream:
+            stream.write(data)
+            sock = Mock()
+            with patch.object(compoundpi.server, 'os') as os_mock:
+                del os_mock.sendfile
+                compoundpi.server.CameraRequestHandler.send_stream.__func__(
+                        None, sock, stream, 3, len(data) - 6)
+            # Without sendfile the file is read in bounded chunks
+            chunks = [args[0] for args, kwargs in sock.sendall.call_args_list]
+            assert len(chunks) == 3
+            assert max(len(chunk) for chunk in chunks) == 1048576
+            assert b''.join(chunks) == data[3:-3]
+
+    def test_send_stream_getvalue():
+        stream = io.BytesIO(b'foobar')
+        sock = Mock()
+        compoundpi.server.CameraRequestHandler.send_stream.__func__(
+                None, sock, stream, 1, 4)
+        (part,), kwargs = sock.sendall.call_args
+        assert bytes(part) == b'ooba'
+
+    def test_list_handler():
+        socket = Mock()
+        server = mock_server()
+        server.client_address = ('localhost', 1)
+        server.seqno = 1
+        server.images = image_store([(1000.0, b'foo'), (1001.0, b'quux')])
+        handler = compoundpi.server.CameraRequestHandler(
+                (b'2 LIST', socket), ('localhost', 1), server)
+        server.repeater.send.assert_called_once_with(
+                (('localhost', 1), 2), ('localhost', 1),
+                '2 OK\n'
+                'IMAGE 0 1000.000000 3 crc32=8c736521\n'
+                'IMAGE 1 1001.000000 4 crc32=ac6bc6e3')
+
+    def test_list_handler_trigger():
+        socket = Mock()
+        server = mock_server()
+        server.client_address = ('localhost', 1)
+        server.seqno = 1
+        server.images = image_store([(1000.0, b'foo')])
+        image = server.images.create(1001.0, trigger=1000.95)
+        image.write(b'quux')
+        image.finish()
+        handler = compoundpi.server.CameraRequestHandler(
+                (b'2 LIST', socket), ('localhost', 1), server)
+        server.repeater.send.assert_called_once_with(
+                (('localhost', 1), 2), ('localhost', 1),
+                '2 OK\n'
+                'IMAGE 0 1000.000000 3 crc32=8c736521\n'
+                'IMAGE 1 1001.000000 4 crc32=ac6bc6e3 trigger=1000.950000')
+
+    def test_list_handler_segments():
+        socket = Mock()
+        server = mock_server()
+        server.client_address = ('localhost', 1)
+        server.seqno = 1
+        server.images = image_store([])
+        image = server.images.create(1000.0, format='h264')
+        image.write(b'foo')
+        image.duration = 10.0
+        image.finish()
+        image = server.images.create(1010.0, format='h264')
+        image.write(b'ba')
+        handler = compoundpi.server.CameraRequestHandler(
+                (b'2 LIST', socket), ('localhost', 1), server)
+        server.repeater.send.assert_called_once_with(
+                (('localhost', 1), 2), ('localhost', 1),
+                '2 OK\n'
+                'IMAGE 0 1000.000000 3 crc32=8c736521 format=h264 '
+                'duration=10.000000\n'
+                'IMAGE 1 1010.000000 2 format=h264')
+
+    def test_clear_handler():
+        socket = Mock()
+        server = mock_server()
+        server.client_address = ('localhost', 1)
+        server.seqno = 1
+        server.images = image_store([(1000.0, b'foo'), (1001.0, b'quux')])
+        handler = compoundpi.server.CameraRequestHandler(
+                (b'2 CLEAR', socket), ('localhost', 1), server)
+        assert len(server.images) == 0
+        server.repeater.send.assert_called_once_with(
+                (('localhost', 1), 2), ('localhost', 1),
+                '2 OK\n')
+
+    def test_clear_handler_indexes():
+        socket = Mock()
+        server = mock_server()
+        server.client_address = ('localhost', 1)
+        server.seqno = 1
+        server.images = image_store([
+            (1000.0 + i, b'foo') for i in range(6)])
+        handler = compoundpi.server.CameraRequestHandler(
+                (b'2 CLEAR 0,2-3,9', socket), ('localhost', 1), server)
+        assert [image.index for image in server.images] == [1, 4, 5]
+        server.repeater.send.assert_called_with(
+                (('localhost', 1), 2), ('localhost', 1),
+                '2 OK\n')
+        for seqno, spec in ((3, b'1,x'), (4, b'5-4'), (5, b'-1')):
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'%d CLEAR %s' % (seqno, spec), socket),
+                    ('localhost', 1), server)
+            server.repeater.send.assert_called_with(
+                    (('localhost', 1), seqno), ('localhost', 1),
+                    '%d ERROR\nInvalid image indexes %s' % (seqno, spec))
+        assert [image.index for image in server.images] == [1, 4, 5]
+
+    def test_group_handler():
+        socket = Mock()
+        server = mock_server()
+        server.client_address = ('localhost', 1)
+        server.seqno = 1
+        server.groups = {'239.0.0.1'}
+        handler = compoundpi.server.CameraRequestHandler(
+                (b'2 GROUP JOIN 239.0.0.2', socket), ('localhost', 1), server)
+        server.join_group.assert_called_once_with('239.0.0.2')
+        server.groups.add('239.0.0.2')
+        handler = compoundpi.server.CameraRequestHandler(
+                (b'3 GROUP JOIN 239.0.0.2', socket), ('localhost', 1), server)
+        assert server.join_group.call_count == 1
+        handler = compoundpi.server.CameraRequestHandler(
+                (b'4 GROUP LEAVE 239.0.0.1', socket), ('localhost', 1), server)
+        server.leave_group.assert_called_once_with('239.0.0.1')
+        handler = compoundpi.server.CameraRequestHandler(
+                (b'5 GROUP', socket), ('localhost', 1), server)
+        server.repeater.send.assert_called_with(
+                (('localhost', 1), 5), ('localhost', 1),
+                '5 OK\nGROUP 239.0.0.1\nGROUP 239.0.0.2\n')
+
+    def test_group_handler_invalid():
+        socket = Mock()
+        server = mock_server()
+        server.client_address = ('localhost', 1)
+        server.seqno = 1
+        server.groups = set()
+        handler = compoundpi.server.CameraRequestHandler(
+                (b'2 GROUP JOIN 192.168.0.1', socket), ('localhost', 1), server)
+        assert not server.join_group.called
+        server.repeater.send.assert_called_once_with(
+                (('localhost', 1), 2), ('localhost', 1),
+                '2 ERROR\n192.168.0.1 is not a multicast address')
+
+    def test_configure_handler():
+        socket = Mock()
+        server = mock_server()
+        server.client_address = ('localhost', 1)
+        server.seqno = 1
+        server.camera.resolution = (1280, 720)
+        server.camera.framerate = 30
+        server.camera.awb_mode = 'auto'
+        server.camera.awb_gains = (1.0, 1.0)
+        server.camera.shutter_speed = 0
+        server.camera.exposure_speed = 33000
+        server.images = image_store([])
+        with patch.object(
+                compoundpi.server.CameraRequestHandler, 'do_status') as status:
+            status.return_value = 'FOO'
+            handler = compoundpi.server.CameraRequestHandler(
+                    (b'2 CONFIGURE resolution=1280x720 framerate=15 '
+                     b'awb_mode=off awb_red=1.5 awb_blue=1.25 iso=100 hflip=1',
+                     socket), ('localhost', 1), server)
+        assert server.camera.resolution == (1280, 720)
+        assert server.camera.framerate == 15
+        assert server.camera.awb_mode == 'off'
+        assert server.camera.awb_gains == (1.5, 1.25)
+        assert server.camera.iso == 100
+        assert server.camera.hflip == True
+        server.repeater.send.assert_called_once_with(
+                (('localhost', 1), 2), ('localhost', 1),
+                '2 OK\nFOO')
+
+    def test_configure_handler_invalid():
+        socket = Mock()
+        server = mock_server()
+        server.client_address = ('localhost', 1)
+        server.seqno = 1
+        server.camera.iso = 0
+        handler = compoundpi.server.CameraRequestHandler(
+                (b'2 CONFIGURE iso=100 foo=bar', socket), ('localhost', 1), server)
+        assert server.camera.iso == 0
+        args, kwargs = server.repeater.send.call_args
+        assert args[2] == '2 ERROR\nUnknown setting foo'
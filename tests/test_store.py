@@ -0,0 +1,168 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+
+# Copyright 2014 Dave Hughes <dave@waveform.org.uk>.
+#
+# This file is part of compoundpi.
+#
+# compoundpi is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# compoundpi is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# compoundpi.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    print_function,
+    division,
+    )
+str = type('')
+
+
+import io
+import zlib
+
+import pytest
+
+from compoundpi.store import ImageStore, MemoryBackend, RingBackend, FileBackend
+
+
+def fill(store, timestamp, data):
+    image = store.create(timestamp)
+    image.write(data)
+    image.finish()
+    return image
+
+def test_store_default():
+    store = ImageStore()
+    fill(store, 1000.0, b'foo')
+    fill(store, 1001.0, b'quux')
+    assert len(store) == 2
+    assert [(i.index, i.timestamp, i.size) for i in store] == [
+        (0, 1000.0, 3), (1, 1001.0, 4)]
+    assert store.usage('memory') == (7, 0)
+    assert store.usage('disk') == (0, 0)
+
+def test_store_bad_policy():
+    with pytest.raises(ValueError):
+        ImageStore(policy='foo')
+
+def test_store_bad_index():
+    store = ImageStore()
+    with pytest.raises(IndexError):
+        store[0]
+    with pytest.raises(IndexError):
+        store.remove(0)
+
+def test_store_size_while_writing():
+    store = ImageStore()
+    image = store.create(1000.0)
+    image.stream.write(b'foo')
+    assert image.size == 3
+
+def test_store_checksum():
+    store = ImageStore()
+    image = store.create(1000.0)
+    image.write(b'foo')
+    image.write(b'bar')
+    image.finish()
+    assert image.checksum == zlib.crc32(b'foobar') & 0xFFFFFFFF
+    assert image.stream.getvalue() == b'foobar'
+
+def test_store_clear_keeps_index():
+    store = ImageStore()
+    fill(store, 1000.0, b'foo')
+    fill(store, 1001.0, b'bar')
+    store.remove(0)
+    assert fill(store, 1002.0, b'baz').index == 2
+    store.clear()
+    assert len(store) == 0
+    assert fill(store, 1003.0, b'quux').index == 3
+
+def test_store_clear_keeps_incomplete():
+    store = ImageStore()
+    fill(store, 1000.0, b'foo')
+    segment = store.create(1001.0, format='h264')
+    segment.stream.write(b'bar')
+    assert not segment.complete
+    store.clear()
+    assert [(i.index, i.format) for i in store] == [(1, 'h264')]
+    assert not segment.stream.closed
+    segment.finish()
+    assert segment.complete
+    store.clear()
+    assert len(store) == 0
+
+def test_store_clear_indexes():
+    store = ImageStore()
+    for i in range(4):
+        fill(store, 1000.0 + i, b'foo')
+    store.clear({1, 3, 7})
+    assert [i.index for i in store] == [0, 2]
+    assert fill(store, 1004.0, b'bar').index == 4
+
+def test_store_refuse():
+    store = ImageStore([MemoryBackend(5)])
+    fill(store, 1000.0, b'foo')
+    fill(store, 1001.0, b'bar')
+    with pytest.raises(IOError):
+        store.create(1002.0)
+    assert len(store) == 2
+
+def test_store_spill(tmpdir):
+    store = ImageStore([MemoryBackend(3), FileBackend(str(tmpdir), 6)])
+    fill(store, 1000.0, b'foo')
+    spilled = fill(store, 1001.0, b'bar')
+    assert spilled.backend.kind == 'disk'
+    assert spilled.stream.fileno()
+    assert store.usage('memory') == (3, 3)
+    assert store.usage('disk') == (3, 6)
+    # The spill file is anonymous so nothing is left in the directory
+    assert tmpdir.listdir() == []
+    spilled.stream.seek(0)
+    assert spilled.stream.read() == b'bar'
+    fill(store, 1002.0, b'baz')
+    with pytest.raises(IOError):
+        store.create(1003.0)
+
+def test_store_evict():
+    store = ImageStore([MemoryBackend(6)], policy='evict')
+    first = fill(store, 1000.0, b'foo')
+    second = fill(store, 1001.0, b'bar')
+    with pytest.raises(IOError):
+        store.create(1002.0)
+    second.sent = True
+    first.sent = True
+    third = fill(store, 1002.0, b'baz')
+    assert [i.index for i in store] == [1, 2]
+    assert first.stream.closed
+
+def test_ring_backend():
+    store = ImageStore([RingBackend(2, 10)])
+    first = fill(store, 1000.0, b'foo')
+    second = fill(store, 1001.0, b'quux')
+    assert store.usage('memory') == (7, 20)
+    assert (first.stream.offset, first.size) == (0, 3)
+    assert (second.stream.offset, second.size) == (10, 4)
+    assert bytes(second.stream.getbuffer()) == b'quux'
+    second.stream.seek(1)
+    assert second.stream.read() == b'uux'
+    with pytest.raises(IOError):
+        store.create(1002.0)
+    store.remove(0)
+    third = fill(store, 1002.0, b'bar')
+    assert third.stream.offset == 0
+    assert bytes(third.stream.getbuffer()) == b'bar'
+
+def test_ring_backend_overflow():
+    store = ImageStore([RingBackend(1, 4)])
+    image = store.create(1000.0)
+    image.stream.write(b'foo')
+    with pytest.raises(IOError):
+        image.stream.write(b'ba')